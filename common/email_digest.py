@@ -0,0 +1,127 @@
+# Email digests
+# Rather than one email per message, an EmailDigest collects the messages going to each recipient and sends
+# them as one email once things go quiet, with limits on how many messages one email holds and how long
+# the first of them can be held back.
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+
+class _Batch:
+    __slots__ = ("from_address", "to_address", "entries", "first", "last")
+
+    def __init__(self, from_address, to_address, now):
+        self.from_address = from_address
+        self.to_address = to_address
+        self.entries = []  # of (time received, subject, body)
+        self.first = now
+        self.last = self.first
+
+
+class EmailDigest:
+    # sender is anything with send(from_address, to_address, subject, body), normally an EmailSender, and
+    # EmailDigest.send() takes the same arguments so it can stand in for one.
+    #
+    # A recipient's digest is sent when
+    #   - window_seconds pass without another message for that recipient,
+    #   - it holds max_messages messages, or
+    #   - its first message has waited max_latency_seconds (so a steady trickle can't hold mail back forever).
+    # Messages still waiting are sent by flush() and close(). A digest of one message is sent as it came,
+    # otherwise the subject is subject_format with {count} filled in.
+    # clock and wait(seconds) can be replaced to test without real time passing. wait is called from the worker
+    # thread and returns after seconds (None: no limit), or sooner when a message arrives or the digest is closing.
+    def __init__(self, sender, window_seconds=60.0, max_messages=20, max_latency_seconds=300.0,
+                 subject_format="{count} messages", clock=time.monotonic, wait=None):
+        self.sender = sender
+        self.subject_format = subject_format
+        self.window_seconds = float(window_seconds)
+        self.max_messages = max(1, int(max_messages))
+        self.max_latency_seconds = max(self.window_seconds, float(max_latency_seconds))
+        self.clock = clock
+
+        self.messages = 0
+        self.digests = 0
+
+        self._batches = {}  # key = (from address, to address), value = _Batch
+        self._lock = threading.Lock()
+        self._changed = threading.Event()  # Set when there's something new for the worker to look at
+        self.wait = wait or self._changed.wait
+        self._stopping = False
+        self._worker = threading.Thread(target=self._work, name="email-digest", daemon=True)
+        self._worker.start()
+
+    def send(self, from_address, to_address, subject, body) -> bool:
+        # Add a message to its recipient's digest
+        with self._lock:
+            if self._stopping:
+                return self.sender.send(from_address, to_address, subject, body)  # Too late for a digest
+            key = (from_address, to_address)
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = _Batch(from_address, to_address, self.clock())
+            batch.entries.append((time.time(), subject, body))
+            batch.last = self.clock()
+            self.messages += 1
+            full = len(batch.entries) >= self.max_messages
+            if full:
+                del self._batches[key]
+        if full:
+            return self._send_batch(batch)
+        self._changed.set()
+        return True
+
+    def flush(self):
+        # Send every digest now
+        with self._lock:
+            batches = list(self._batches.values())
+            self._batches = {}
+        for batch in batches:
+            self._send_batch(batch)
+
+    def close(self, timeout=5.0):
+        # Stop, sending whatever is waiting. The sender is left open (the caller closes it once this returns), and
+        # any messages sent after this go straight to it.
+        with self._lock:
+            self._stopping = True
+        self._changed.set()
+        self._worker.join(timeout)
+        self.flush()
+        log.info(f"Email digest closed: {self.messages} messages in {self.digests} emails")
+
+    # === Helpers and private functions
+
+    def _due(self, batch) -> float:
+        # When a batch should be sent (self.clock() time)
+        return min(batch.last + self.window_seconds, batch.first + self.max_latency_seconds)
+
+    def _work(self):
+        while True:
+            self._changed.clear()  # Before looking, so nothing that arrives after is missed
+            with self._lock:
+                if self._stopping:
+                    return
+                now = self.clock()
+                batches = [self._batches.pop(key) for key, batch in list(self._batches.items())
+                           if self._due(batch) <= now]
+                next_due = min((self._due(batch) for batch in self._batches.values()), default=None)
+            for batch in batches:
+                self._send_batch(batch)
+            if not batches:
+                self.wait(None if next_due is None else next_due - now)
+
+    def _send_batch(self, batch) -> bool:
+        self.digests += 1
+        if len(batch.entries) == 1:
+            (received, subject, body), = batch.entries
+            return self.sender.send(batch.from_address, batch.to_address, subject, body)
+
+        log.info(f"Sending digest of {len(batch.entries)} messages to {batch.to_address}")
+        parts = [f"{len(batch.entries)} messages:"]
+        for received, subject, body in batch.entries:
+            parts.append(f"--- {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(received))} {subject}\n{body}")
+        return self.sender.send(batch.from_address, batch.to_address,
+                                self.subject_format.format(count=len(batch.entries)), "\n\n".join(parts))
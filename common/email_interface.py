@@ -1,27 +1,268 @@
 # Send email using an external SMTP server
 
 import logging
+import queue
 import smtplib
+import threading
+import time
 from email.message import EmailMessage
 
+from common import email_spool
+
 log = logging.getLogger(__name__)
 # log.setLevel(logging.DEBUG)  # Set our own level separately
 
-def send_email(smtp_server, sender, password, from_address, to_address, subject, body):
+def _make_message(from_address, to_address, subject, body) -> EmailMessage:
     msg = EmailMessage()
     msg.set_content(body)
     msg['Subject'] = subject
     msg['From'] = from_address
     msg['To'] = to_address
+    return msg
+
+
+# What became of one attempt to send a message
+_SENT = "sent"
+_REFUSED = "refused"  # The server turned it down, trying again won't help
+_UNSENT = "unsent"  # Couldn't get it to the server, try again later
+
+
+class EmailSender:
+    # Sends email from a background thread, so callers (like a Meshtastic receive handler) never wait on the
+    # SMTP server. One SMTP session is kept open and reused while there is mail to send, closed after
+    # idle_seconds without any, and reopened (once per message) if the server drops it.
+    #
+    # Without a spool, messages wait in a bounded in-memory queue and a message that can't be sent is lost.
+    # With a spool (a common.email_spool.EmailSpool), each message is written to disk before send() returns
+    # and is only removed once the server has taken it. If the server can't be reached, the sender waits and
+    # tries the oldest message again, doubling the wait each time (from retry_seconds up to max_retry_seconds)
+    # so a long outage doesn't mean a steady stream of connection attempts. Messages are still sent one at a
+    # time over one connection after the server comes back, however many have built up.
+    #
+    # use_ssl=True connects with SMTP over SSL (normally port 465). Otherwise the connection starts in the
+    # clear (normally port 587 or 25) and is upgraded with STARTTLS if the server offers it.
+    # The login is skipped if no sender (username) is given, e.g. for a local relay.
+    def __init__(self, smtp_server, sender, password, port=465, use_ssl=True, max_queue=100, idle_seconds=60.0,
+                 timeout=30.0, spool=None, retry_seconds=5.0, max_retry_seconds=300.0):
+        self.smtp_server = smtp_server
+        self.sender = sender
+        self._password = password
+        self.port = int(port)
+        self.use_ssl = use_ssl
+        self.idle_seconds = float(idle_seconds)
+        self.timeout = float(timeout)
+        self.spool = spool
+        self.retry_seconds = float(retry_seconds)
+        self.max_retry_seconds = max(self.retry_seconds, float(max_retry_seconds))
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0  # Queue was full, or the message couldn't be spooled
+        self.connects = 0
+        self.retries = 0  # Times a spooled message had to wait for the server
+        self.last_latency = 0.0  # Seconds from send() until the server took the message
+        self.max_latency = 0.0
+
+        self._smtp = None
+        if spool is None:
+            self._queue = queue.Queue(maxsize=max(1, int(max_queue)))
+            self._worker = threading.Thread(target=self._work, name="email-sender", daemon=True)
+        else:
+            self._wakeup = threading.Event()
+            self._stopping = threading.Event()
+            self._worker = threading.Thread(target=self._work_spool, name="email-sender", daemon=True)
+        self._worker.start()
+
+    def send(self, from_address, to_address, subject, body) -> bool:
+        # Queue a message for sending. Returns False (and the message is dropped) if the queue is full, or
+        # if it couldn't be written to the spool.
+        msg = _make_message(from_address, to_address, subject, body)
+        if self.spool is not None:
+            try:
+                self.spool.put(msg)
+            except OSError as e:
+                self.dropped += 1
+                log.error(f"Unable to spool email to {to_address}: {e}")
+                return False
+            self._wakeup.set()
+            return True
+
+        try:
+            self._queue.put_nowait((time.monotonic(), msg))
+        except queue.Full:
+            self.dropped += 1
+            log.error(f"Email queue full, dropping email to {to_address}: {subject}")
+            return False
+        return True
+
+    def close(self, timeout=60.0):
+        # Without a spool, send whatever is still queued (waiting up to timeout seconds for it), then stop.
+        # With one, stop after the message being sent now; the rest stay spooled for next time.
+        if self.spool is not None:
+            self._stopping.set()
+            self._wakeup.set()
+        else:
+            try:
+                self._queue.put(None, timeout=timeout)  # Tells the worker to stop once it gets here
+            except queue.Full:
+                log.error("Email queue still full, abandoning queued email")
+        self._worker.join(timeout)
+        log.info(f"Email sender closed: {self.stats()}")
+
+    def stats(self) -> dict:
+        stats = {"sent": self.sent, "failed": self.failed, "dropped": self.dropped, "connects": self.connects,
+                 "retries": self.retries, "last_latency": round(self.last_latency, 3),
+                 "max_latency": round(self.max_latency, 3)}
+        if self.spool is not None:
+            pending = self.spool.pending()
+            stats["depth"] = len(pending)
+            stats["oldest_age"] = round(self.spool.oldest_age(pending), 1)
+        else:
+            stats["depth"] = self._queue.qsize()
+        return stats
+
+    # === Helpers and private functions
+
+    def _work(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.idle_seconds if self._smtp else None)
+            except queue.Empty:
+                log.debug("Email sender idle, closing SMTP connection")
+                self._disconnect()
+                continue
+            if item is None:
+                self._disconnect()
+                return
+            queued, msg = item
+            if self._send(msg) == _SENT:
+                self._count_sent(time.monotonic() - queued)
+            else:
+                self.failed += 1
+
+    def _work_spool(self):
+        delay = self.retry_seconds
+        while not self._stopping.is_set():
+            self._wakeup.clear()  # Before looking, so a message spooled after we look still wakes us
+            pending = self.spool.pending()
+            if not pending:
+                if not self._wakeup.wait(self.idle_seconds if self._smtp else None):
+                    log.debug("Email sender idle, closing SMTP connection")
+                    self._disconnect()
+                continue
 
-    # Send the message via SMTP over SSL connection
-    log.info(f"Sending email to {to_address}")
-    with smtplib.SMTP_SSL(smtp_server, 465) as smtp_server:
+            for name in pending:
+                if self._stopping.is_set():
+                    break
+                try:
+                    msg = self.spool.load(name)
+                except FileNotFoundError:
+                    continue
+                except Exception as e:
+                    log.error(f"Unable to read spooled email {name}: {e}")
+                    self.failed += 1
+                    self._spool_done(self.spool.reject, name)
+                    continue
+
+                result = self._send(msg)
+                if result == _SENT:
+                    self._count_sent(email_spool.spooled_age(name))
+                    self._spool_done(self.spool.remove, name)
+                    delay = self.retry_seconds
+                elif result == _REFUSED:
+                    self.failed += 1
+                    self._spool_done(self.spool.reject, name)
+                else:
+                    # Keep the message (and everything after it) for when the server is back
+                    self.retries += 1
+                    log.warning(f"Email not sent, retrying in {delay:.0f}s; {len(pending)} waiting, "
+                                f"oldest {self.spool.oldest_age(pending):.0f}s")
+                    self._stopping.wait(delay)
+                    delay = min(delay * 2, self.max_retry_seconds)
+                    break
+        self._disconnect()
+
+    def _spool_done(self, action, name):
+        # Remove or reject a spooled message. Failing to isn't a reason to stop sending the rest.
         try:
-            smtp_server.login(sender, password)
-            smtp_server.sendmail(from_address, to_address, msg.as_string())
-        except Exception as e:
-            log.error(f"Error sending email to {to_address}")
-            log.error(e)
+            action(name)
+        except OSError as e:
+            log.error(f"Unable to {action.__name__} spooled email {name}: {e}")
+
+    def _count_sent(self, latency):
+        self.sent += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def _send(self, msg) -> str:
+        log.info(f"Sending email to {msg['To']}")
+        start = time.monotonic()
+        for attempt in (1, 2):
+            try:
+                if self._smtp is None:
+                    self._connect()
+                self._smtp.send_message(msg)
+            except smtplib.SMTPRecipientsRefused as e:
+                # Refused only if every recipient got a permanent (5xx) refusal, otherwise try again later
+                permanent = all(code >= 500 for code, response in e.recipients.values())
+                return self._turned_down(msg, e, permanent)
+            except smtplib.SMTPResponseException as e:
+                if isinstance(e, smtplib.SMTPConnectError):
+                    error = e  # Greeting refused, treat it like any other connection problem
+                elif isinstance(e, smtplib.SMTPAuthenticationError):
+                    # Provider outage or changed credentials: not this message's fault, so keep it for later
+                    return self._turned_down(msg, e, False)
+                else:
+                    # 4xx replies (421 service unavailable, greylisting...) are temporary
+                    return self._turned_down(msg, e, e.smtp_code >= 500)
+            except smtplib.SMTPNotSupportedError as e:
+                return self._turned_down(msg, e, True)
+            except OSError as e:  # Includes SMTPServerDisconnected and socket errors
+                error = e
+            else:
+                log.info(f"Successfully sent email to {msg['To']} ({time.monotonic() - start:.2f}s)")
+                return _SENT
+
+            # Connection trouble: a kept-open session may simply have been dropped by the server, so
+            # reconnect and try once more
+            log.warning(f"SMTP connection problem sending to {msg['To']} (attempt {attempt}): {error}")
+            self._disconnect()
+        log.error(f"Error sending email to {msg['To']}: {error}")
+        return _UNSENT
+
+    def _turned_down(self, msg, error, permanent) -> str:
+        # The server answered with an error; reconnecting straight away won't help either way
+        self._disconnect()
+        if permanent:
+            log.error(f"Email to {msg['To']} refused: {error}")
+            return _REFUSED
+        log.warning(f"Email to {msg['To']} temporarily refused: {error}")
+        return _UNSENT
+
+    def _connect(self):
+        log.debug(f"Connecting to SMTP server {self.smtp_server}:{self.port}")
+        if self.use_ssl:
+            smtp = smtplib.SMTP_SSL(self.smtp_server, self.port, timeout=self.timeout)
         else:
-            log.info(f"Successfully sent email to {to_address}")
+            smtp = smtplib.SMTP(self.smtp_server, self.port, timeout=self.timeout)
+            smtp.ehlo()
+            if smtp.has_extn("starttls"):
+                smtp.starttls()
+                smtp.ehlo()
+        try:
+            if self.sender:
+                smtp.login(self.sender, self._password)
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+        self.connects += 1
+
+    def _disconnect(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except Exception:
+            self._smtp.close()  # Connection already gone, just clean up
+        self._smtp = None
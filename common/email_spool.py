@@ -0,0 +1,77 @@
+# On-disk outbox for email
+# Each message waiting to be sent is one file in the spool directory, so mail survives an SMTP outage or a
+# restart. Files are named after the time they were spooled (plus a sequence number), which keeps them in
+# arrival order and tells us how long the oldest one has been waiting. Messages the server refused go in
+# the "failed" subdirectory rather than being retried.
+
+import email
+import email.policy
+import itertools
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+SPOOL_SUFFIX = ".eml"
+FAILED_DIRECTORY = "failed"
+
+
+class EmailSpool:
+    def __init__(self, directory):
+        self.directory = directory
+        self.failed_directory = os.path.join(directory, FAILED_DIRECTORY)
+        os.makedirs(self.failed_directory, exist_ok=True)
+        self._sequence = itertools.count()
+        log.info(f"Email spool {directory}: {len(self.pending())} messages waiting")
+
+    def put(self, msg) -> str:
+        # Write a message (an EmailMessage) to the spool and return its name. The message is written to a
+        # temporary file and renamed into place, so a crash never leaves a partly written message to be sent.
+        name = f"{time.time_ns():020d}-{next(self._sequence):06d}{SPOOL_SUFFIX}"
+        path = os.path.join(self.directory, name)
+        temp_path = os.path.join(self.directory, f".{name}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(msg.as_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        log.debug(f"Spooled {name}")
+        return name
+
+    def pending(self) -> list:
+        # Names of the messages waiting to be sent, oldest first
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SPOOL_SUFFIX))
+
+    def load(self, name):
+        with open(os.path.join(self.directory, name), "rb") as f:
+            return email.message_from_binary_file(f, policy=email.policy.default)
+
+    def remove(self, name):
+        # The message was sent
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def reject(self, name):
+        # The message can't be sent, keep it out of the way for someone to look at
+        os.replace(os.path.join(self.directory, name), os.path.join(self.failed_directory, name))
+        log.warning(f"Moved unsendable email {name} to {self.failed_directory}")
+
+    def depth(self) -> int:
+        return len(self.pending())
+
+    def oldest_age(self, pending=None) -> float:
+        # Seconds the oldest waiting message has been in the spool (0 if none are waiting)
+        pending = self.pending() if pending is None else pending
+        return spooled_age(pending[0]) if pending else 0.0
+
+
+def spooled_age(name) -> float:
+    # Seconds since a message was spooled, from its name
+    try:
+        return max(0.0, (time.time_ns() - int(name.split("-", 1)[0])) / 1e9)
+    except ValueError:
+        return 0.0
@@ -0,0 +1,238 @@
+# Apply a configuration profile to many devices at once
+# A profile is a JSON file holding part of a device configuration, in the protobuf JSON format that the
+# Meshtastic CLI uses (field names as in the protobufs, enums by name, bytes as base64):
+#   {"localConfig": {"lora": {"region": "US", "hop_limit": 3}},
+#    "moduleConfig": {"mqtt": {"enabled": false}},
+#    "channels": [{"index": 1, "role": "SECONDARY", "settings": {"name": "ops", "psk": "<base64 key>"}}]}
+# Settings not in the profile are left as they are on each device.
+#
+# Every device is configured on a thread of its own (up to max_parallel at once) in one settings transaction,
+# so it reboots once at the end. Devices that already match the profile aren't written to and don't reboot.
+
+import json
+import logging
+import queue
+import threading
+import time
+
+from google.protobuf import json_format
+from meshtastic.protobuf import channel_pb2, localonly_pb2
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+# Device results
+STATUS_APPLIED = "applied"  # Written and committed, the device is rebooting
+STATUS_UNCHANGED = "unchanged"  # Already matched the profile, nothing written
+STATUS_FAILED = "failed"
+STATUS_TIMED_OUT = "timed out"  # Gave up waiting; the device may still have been configured
+
+MAX_CHANNELS = 8
+_config_sections = {"localConfig": localonly_pb2.LocalConfig, "moduleConfig": localonly_pb2.LocalModuleConfig}
+
+
+class ProfileError(Exception):
+    pass
+
+
+class DeviceResult:
+    __slots__ = ("name", "status", "error", "categories", "channels", "seconds")
+
+    def __init__(self, name, status, error=None, categories=(), channels=(), seconds=0.0):
+        self.name = name
+        self.status = status
+        self.error = error
+        self.categories = list(categories)  # Categories written
+        self.channels = list(channels)  # Channel indexes written
+        self.seconds = seconds
+
+    def __str__(self):
+        text = f"{self.name}: {self.status}"
+        written = self.categories + [f"channel {index}" for index in self.channels]
+        if written:
+            text += f" ({', '.join(written)})"
+        if self.error:
+            text += f": {self.error}"
+        return f"{text} in {self.seconds:.1f}s"
+
+
+def load_profile(path) -> dict:
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ProfileError(f"Can't read profile {path}: {e}")
+    validate_profile(profile)
+    return profile
+
+
+def validate_profile(profile):
+    # Raise ProfileError if a profile isn't something apply_profile can use
+    if not isinstance(profile, dict):
+        raise ProfileError("A profile must be a JSON object")
+    unknown = set(profile) - set(_config_sections) - {"channels"}
+    if unknown:
+        raise ProfileError(f"Unknown profile sections: {', '.join(sorted(unknown))}")
+    if not any(profile.values()):
+        raise ProfileError("The profile has no settings or channels")
+
+    for section, message_type in _config_sections.items():
+        categories = profile.get(section, {})
+        if not isinstance(categories, dict):
+            raise ProfileError(f"{section} must be an object of categories")
+        fields = message_type.DESCRIPTOR.fields_by_name
+        for category, settings in categories.items():
+            if category not in fields or fields[category].message_type is None:
+                raise ProfileError(f"{section} has no category {category}")
+            if not isinstance(settings, dict):
+                raise ProfileError(f"{section}.{category} must be an object of settings")
+            _parse(settings, _copy(getattr(message_type(), category)), f"{section}.{category}")
+
+    channels = profile.get("channels", [])
+    if not isinstance(channels, list):
+        raise ProfileError("channels must be a list")
+    indexes = set()
+    for channel in channels:
+        index = channel.get("index") if isinstance(channel, dict) else None
+        if not isinstance(index, int) or not 0 <= index < MAX_CHANNELS:
+            raise ProfileError(f"Every channel needs an index from 0 to {MAX_CHANNELS - 1}")
+        if index in indexes:
+            raise ProfileError(f"Channel {index} is in the profile more than once")
+        indexes.add(index)
+        _parse(channel, channel_pb2.Channel(), f"channel {index}")
+
+
+def apply_profile(profile, interfaces, timeout=120.0, max_parallel=8, on_progress=None) -> list:
+    # Apply a (validated) profile to devices, given as a dict of key = device name, value = interface.
+    # Blocks until every device has finished or had timeout seconds, and returns a DeviceResult for each.
+    # on_progress(device name, text) is called from the device threads.
+    timeout = float(timeout)
+    max_parallel = max(1, int(max_parallel))
+    waiting = list(interfaces.items())
+    running = {}  # key = device name, value = time.monotonic() it started
+    finished = queue.Queue()
+    results = {}
+
+    def report(name, text):
+        log.debug(f"{name}: {text}")
+        if on_progress:
+            try:
+                on_progress(name, text)
+            except Exception as e:
+                log.error(f"Error reporting progress for {name}: {e}")
+
+    def work(name, interface):
+        started = time.monotonic()
+        try:
+            result = _apply_to_device(name, interface, profile, report)
+        except (Exception, SystemExit) as e:  # meshtastic's our_exit() raises SystemExit for some errors
+            log.error(f"Error configuring {name}: {e}")
+            result = DeviceResult(name, STATUS_FAILED, error=f"{type(e).__name__}: {e}")
+        result.seconds = time.monotonic() - started
+        finished.put(result)
+
+    log.info(f"Applying profile to {len(waiting)} devices, {max_parallel} at a time")
+    while waiting or running:
+        while waiting and len(running) < max_parallel:
+            name, interface = waiting.pop(0)
+            running[name] = time.monotonic()
+            report(name, "starting")
+            threading.Thread(target=work, args=(name, interface), name=f"fleet-{name}", daemon=True).start()
+
+        next_deadline = min(running.values()) + timeout
+        try:
+            result = finished.get(timeout=max(0.0, next_deadline - time.monotonic()))
+        except queue.Empty:
+            now = time.monotonic()
+            for name, started in list(running.items()):
+                if started + timeout <= now:
+                    del running[name]  # Its thread carries on (or stays stuck) on its own
+                    results[name] = DeviceResult(name, STATUS_TIMED_OUT, seconds=now - started)
+                    report(name, STATUS_TIMED_OUT)
+            continue
+        if result.name not in running:
+            continue  # Finished after it had timed out
+        del running[result.name]
+        results[result.name] = result
+        report(result.name, result.status)
+
+    results = [results[name] for name in interfaces]
+    log.info(format_report(results))
+    return results
+
+
+def format_report(results) -> str:
+    counts = {}
+    for result in results:
+        counts[result.status] = counts.get(result.status, 0) + 1
+    summary = ", ".join(f"{counts.get(status, 0)} {status}" for status in
+                        (STATUS_APPLIED, STATUS_UNCHANGED, STATUS_FAILED, STATUS_TIMED_OUT))
+    return "\n".join([f"Profile applied to {len(results)} devices: {summary}"] + [str(result) for result in results])
+
+
+# === Helpers and private functions
+
+def _parse(values, message, what):
+    # Merge JSON values into a protobuf message
+    try:
+        json_format.ParseDict(values, message)
+    except json_format.ParseError as e:
+        raise ProfileError(f"{what}: {e}")
+    return message
+
+
+def _apply_to_device(name, interface, profile, report) -> DeviceResult:
+    node = interface.localNode
+    if node is None or node.localConfig is None:
+        return DeviceResult(name, STATUS_FAILED, error="No configuration has been read from the device")
+
+    # Work out what the profile changes on this device, on copies of its configuration
+    report(name, "checking")
+    categories = []  # of (config, category name, new category settings)
+    for section, config in (("localConfig", node.localConfig), ("moduleConfig", node.moduleConfig)):
+        for category, settings in profile.get(section, {}).items():
+            current = getattr(config, category)
+            new = _parse(settings, _copy(current), f"{section}.{category}")
+            if new != current:
+                categories.append((config, category, new))
+    channels = []  # of (index, new channel)
+    for channel in profile.get("channels", []):
+        index = channel["index"]
+        if not node.channels or index >= len(node.channels):
+            return DeviceResult(name, STATUS_FAILED, error=f"Channel {index} hasn't been read from the device")
+        new = _parse(channel, _copy(node.channels[index]), f"channel {index}")
+        if new != node.channels[index]:
+            channels.append((index, new))
+
+    if not categories and not channels:
+        return DeviceResult(name, STATUS_UNCHANGED)
+
+    # Write them. If anything goes wrong, the transaction isn't committed and our copy of the configuration is
+    # put back the way it was (the device drops the uncommitted changes when it next reboots).
+    originals = [(getattr(config, category), _copy(getattr(config, category))) for config, category, new in categories]
+    originals += [(node.channels[index], _copy(node.channels[index])) for index, new in channels]
+    try:
+        node.beginSettingsTransaction()
+        for config, category, new in categories:
+            report(name, f"writing {category}")
+            getattr(config, category).CopyFrom(new)
+            node.writeConfig(category)
+        for index, new in channels:
+            report(name, f"writing channel {index}")
+            node.channels[index].CopyFrom(new)
+            node.writeChannel(index)
+        report(name, "committing")
+        node.commitSettingsTransaction()
+    except (Exception, SystemExit):
+        for current, original in originals:
+            current.CopyFrom(original)
+        raise
+
+    return DeviceResult(name, STATUS_APPLIED, categories=[category for config, category, new in categories],
+                        channels=[index for index, new in channels])
+
+
+def _copy(message):
+    copy = type(message)()
+    copy.CopyFrom(message)
+    return copy
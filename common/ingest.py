@@ -0,0 +1,195 @@
+# Packet ingestion pipeline
+# Meshtastic pub/sub callbacks run on the device's reader thread, and anything slow they do holds up reading
+# the radio. An IngestPipeline lets those callbacks just drop items in a bounded queue and return. A worker
+# thread takes items off the queue, runs them through a parse function and hands them on in batches.
+#
+# The consumer (normally the GUI) acknowledges each batch with batch_done(). Only max_pending_batches can be
+# unacknowledged at once, so a slow consumer makes items back up in the queue, where the queue policy decides
+# what gives, rather than piling up without limit further downstream. The reader thread never waits.
+
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+# What happens when an item arrives and the queue is full
+POLICY_DROP_NEWEST = "drop_newest"  # Drop the arriving item
+POLICY_DROP_OLDEST = "drop_oldest"  # Drop the oldest queued item to make room
+POLICY_COALESCE = "coalesce"  # Items with a key replace a queued item with the same key (full or not).
+                              # When full, the oldest keyed item is dropped to make room; unkeyed items (text
+                              # messages) are only dropped once there are no keyed ones left to drop.
+queue_policies = [POLICY_DROP_NEWEST, POLICY_DROP_OLDEST, POLICY_COALESCE]
+
+
+class IngestPipeline:
+    # parse(item) runs on the worker thread and returns what to deliver (None = nothing to deliver).
+    # deliver(list of parsed items) also runs on the worker thread, so for the GUI it should just post an event.
+    def __init__(self, parse, deliver, max_queue=1000, policy=POLICY_COALESCE, batch_size=100,
+                 batch_seconds=0.05, max_pending_batches=2):
+        if policy not in queue_policies:
+            raise ValueError(f"policy must be one of {str(queue_policies)}")
+        self.parse = parse
+        self.deliver = deliver
+        self.max_queue = max(1, int(max_queue))
+        self.policy = policy
+        self.batch_size = max(1, int(batch_size))
+        self.batch_seconds = float(batch_seconds)  # How long a batch waits to fill up once it has something in it
+        self.max_pending_batches = max(1, int(max_pending_batches))
+
+        self.submitted = 0
+        self.dropped = 0
+        self.dropped_unkeyed = 0  # Of those dropped, how many had no key
+        self.coalesced = 0
+        self.parse_errors = 0
+        self.delivered = 0  # Items delivered
+        self.batches = 0
+        self.max_depth = 0
+
+        self._queue = collections.deque()  # of [key, item] entries
+        self._keyed = {}  # key = coalescing key, value = its entry in self._queue
+        self._pending_batches = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._stopping = False
+        self._worker = threading.Thread(target=self._work, name="ingest-worker", daemon=True)
+        self._worker.start()
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def submit(self, item, key=None) -> bool:
+        # Queue an item, never blocking. With the coalesce policy, an item with a key replaces a queued item
+        # with the same key (keeping its place in the queue). Returns False if the item was dropped.
+        with self._lock:
+            if self._stopping:
+                return False
+            self.submitted += 1
+            if key is not None and self.policy == POLICY_COALESCE:
+                entry = self._keyed.get(key)
+                if entry is not None:
+                    entry[1] = item
+                    self.coalesced += 1
+                    return True
+
+            if len(self._queue) >= self.max_queue:
+                if self.policy == POLICY_COALESCE and self._keyed:
+                    # _keyed is in queue order, so this is the oldest keyed entry
+                    self._drop_entry(next(iter(self._keyed.values())))
+                elif self.policy == POLICY_DROP_NEWEST or (self.policy == POLICY_COALESCE and key is not None):
+                    self._count_drop(key)
+                    return False
+                else:
+                    self._drop_entry(self._queue[0])
+
+            entry = [key, item]
+            self._queue.append(entry)
+            if key is not None and self.policy == POLICY_COALESCE:
+                self._keyed[key] = entry
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._changed.notify()
+        return True
+
+    def batch_done(self):
+        # The consumer has finished with a delivered batch
+        with self._lock:
+            self._pending_batches = max(0, self._pending_batches - 1)
+            self._changed.notify()
+
+    def close(self, timeout=5.0):
+        # Stop the worker. Items still queued are discarded.
+        with self._lock:
+            self._stopping = True
+            self._changed.notify()
+        self._worker.join(timeout)
+        log.info(f"Ingest pipeline closed: {self.stats()}")
+
+    def stats(self) -> dict:
+        return {"submitted": self.submitted, "delivered": self.delivered, "batches": self.batches,
+                "dropped": self.dropped, "dropped_unkeyed": self.dropped_unkeyed, "coalesced": self.coalesced,
+                "parse_errors": self.parse_errors, "depth": self.depth, "max_depth": self.max_depth}
+
+    # === Helpers and private functions
+
+    def _drop_entry(self, entry):
+        # Take a queued entry out of the queue. Caller must hold self._lock.
+        if entry is self._queue[0]:
+            self._queue.popleft()
+        else:
+            for index, queued in enumerate(self._queue):
+                if queued is entry:
+                    del self._queue[index]
+                    break
+        key = entry[0]
+        if key is not None:
+            self._keyed.pop(key, None)
+        self._count_drop(key)
+
+    def _count_drop(self, key):
+        # Caller must hold self._lock
+        self.dropped += 1
+        if key is None:
+            self.dropped_unkeyed += 1
+            if self.dropped_unkeyed == 1 or self.dropped_unkeyed % 100 == 0:
+                log.error(f"Ingest queue full ({self.max_queue} items) with no keyed items left to drop, "
+                          f"{self.dropped_unkeyed} unkeyed items dropped so far")
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            log.warning(f"Ingest queue full ({self.max_queue} items), {self.dropped} items dropped so far")
+
+    def _next_batch(self) -> list:
+        # Wait for the consumer to have room for a batch and for items to arrive, then take up to batch_size of
+        # them. Returns None when stopping.
+        with self._lock:
+            while not self._stopping and (self._pending_batches >= self.max_pending_batches or not self._queue):
+                self._changed.wait()
+            if self._stopping:
+                return None
+
+            # Give a burst a moment to fill the batch out
+            deadline = time.monotonic() + self.batch_seconds
+            while not self._stopping and len(self._queue) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                key, item = self._queue.popleft()
+                if key is not None:
+                    self._keyed.pop(key, None)
+                batch.append(item)
+            return batch
+
+    def _work(self):
+        while True:
+            items = self._next_batch()
+            if items is None:
+                return
+
+            batch = []
+            for item in items:
+                try:
+                    parsed = self.parse(item)
+                except Exception as e:
+                    self.parse_errors += 1
+                    log.error(f"Error parsing ingested item: {e}")
+                    continue
+                if parsed is not None:
+                    batch.append(parsed)
+            if not batch:
+                continue
+
+            with self._lock:
+                self._pending_batches += 1
+            try:
+                self.deliver(batch)
+            except Exception as e:
+                log.error(f"Error delivering ingested batch: {e}")
+                self.batch_done()
+                continue
+            self.delivered += len(batch)
+            self.batches += 1
@@ -0,0 +1,67 @@
+# Read CSV message logs from the end backward
+# Lets a caller load just the newest messages in a large log, and page in older ones later on.
+
+import csv
+import io
+import logging
+import os
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+max_row_bytes = 64 * 1024  # A "row" longer than this is assumed to be damage in the file, not a message
+
+
+def read_rows_backward(filename, fieldnames, end_offset=None, block_size=64 * 1024):
+    # Generator yielding (offset, row dict) newest first, for every row that starts before end_offset
+    # (default: the end of the file). offset is where the row starts, so passing it back in as end_offset
+    # resumes the scan with the next older row.
+    #
+    # Message text can contain newlines, so a row may span several physical lines. The logs quote every
+    # field, so a complete row has an even number of quote characters and parses to len(fieldnames) fields.
+    # Lines are collected (working backward) until they make up such a row.
+    pending = None  # Later lines of a row that spans more than one line
+    for offset, line in _lines_backward(filename, end_offset, block_size):
+        line = line.rstrip(b"\r")
+        if pending is None:
+            if not line:
+                continue
+            candidate = line
+        else:
+            candidate = line + b"\n" + pending
+
+        if candidate.count(b'"') % 2 == 0:
+            fields = next(csv.reader(io.StringIO(candidate.decode("utf-8", errors="replace"))), [])
+            if len(fields) == len(fieldnames):
+                yield offset, dict(zip(fieldnames, fields))
+                pending = None
+                continue
+
+        if len(candidate) > max_row_bytes:
+            log.warning(f"Skipping unreadable data before offset {offset} in {filename}")
+            pending = None
+        else:
+            pending = candidate
+
+
+def _lines_backward(filename, end_offset, block_size):
+    # Generator yielding (offset, line bytes without the newline) from end_offset back to the start of the file
+    with open(filename, "rb") as f:
+        if end_offset is None:
+            end_offset = f.seek(0, os.SEEK_END)
+        pos = end_offset
+        carry = b""  # Start of the earliest line seen so far, which may continue into the block before it
+        while pos > 0:
+            read_size = min(block_size, pos)
+            pos -= read_size
+            f.seek(pos)
+            block = f.read(read_size) + carry
+            lines = block.split(b"\n")
+            carry = lines[0]
+            line_end = pos + len(block)
+            for line in reversed(lines[1:]):
+                line_start = line_end - len(line)
+                yield line_start, line
+                line_end = line_start - 1  # Step over the newline
+        if carry or end_offset > 0:
+            yield 0, carry
@@ -0,0 +1,108 @@
+# Buffered, group-committing writer for CSV log files
+# Keeps each log file open and writes rows in batches, rather than doing an open/write/close for every row.
+# Rows are flushed when enough of them have piled up, when they have been waiting long enough, and on close.
+
+import csv
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+# Durability settings: when buffered rows get fsync'd to disk
+FSYNC_NEVER = "never"  # Flush to the OS but never fsync (fastest, a power failure can lose recent rows)
+FSYNC_FLUSH = "flush"  # fsync once per group flush
+FSYNC_ALWAYS = "always"  # Flush and fsync every row (slowest, nothing is ever left in a buffer)
+fsync_policies = [FSYNC_NEVER, FSYNC_FLUSH, FSYNC_ALWAYS]
+
+
+class LogWriter:
+    # One writer serves any number of log files, keyed by file name. Safe to call from any thread.
+    def __init__(self, flush_rows=50, flush_seconds=2.0, fsync=FSYNC_FLUSH, buffer_size=64 * 1024):
+        if fsync not in fsync_policies:
+            raise ValueError(f"fsync must be one of {str(fsync_policies)}")
+        self.flush_rows = max(1, int(flush_rows))  # Flush a file once this many rows are waiting
+        self.flush_seconds = float(flush_seconds)  # ... or once the oldest waiting row is this old (0 = no timer)
+        self.fsync = fsync
+        self.buffer_size = buffer_size
+
+        self.rows_written = 0
+        self.flush_count = 0
+        self.fsync_count = 0
+
+        self._files = {}  # key = file name, value = _OpenLog
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher = None
+        if self.flush_seconds > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="log-writer-flush", daemon=True)
+            self._flusher.start()
+
+    def write(self, filename, fieldnames, row):
+        # Append one row (a dict keyed by fieldnames) to the named CSV file
+        with self._lock:
+            open_log = self._files.get(filename)
+            if open_log is None:
+                log.debug(f"Opening log file {filename}")
+                open_log = _OpenLog(filename, fieldnames, self.buffer_size)
+                self._files[filename] = open_log
+            open_log.writer.writerow(row)
+            open_log.pending += 1
+            self.rows_written += 1
+
+            if self.fsync == FSYNC_ALWAYS or open_log.pending >= self.flush_rows:
+                self._flush_file(open_log)
+
+    def flush(self, filename=None):
+        # Flush one file, or all of them if no file name is given
+        with self._lock:
+            if filename is None:
+                for open_log in self._files.values():
+                    self._flush_file(open_log)
+            elif filename in self._files:
+                self._flush_file(self._files[filename])
+
+    def close(self):
+        # Flush and close every file and stop the flush timer. The writer can still be used afterward,
+        # files will simply be reopened (and the timer will not run)
+        self._stop.set()
+        if self._flusher and self._flusher is not threading.current_thread():
+            self._flusher.join()
+        self._flusher = None
+        with self._lock:
+            for open_log in self._files.values():
+                self._flush_file(open_log)
+                open_log.file.close()
+            self._files = {}
+        log.info(f"Log writer closed: {self.rows_written} rows, {self.flush_count} flushes, "
+                 f"{self.fsync_count} fsyncs")
+
+    # === Helpers and private functions
+
+    def _flush_file(self, open_log):
+        # Caller must hold self._lock
+        if open_log.pending == 0:
+            return
+        try:
+            open_log.file.flush()
+            self.flush_count += 1
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(open_log.file.fileno())
+                self.fsync_count += 1
+        except OSError as e:
+            log.error(f"Error flushing log file {open_log.filename}: {e}")
+        open_log.pending = 0
+
+    def _flush_loop(self):
+        # Background timer: flush anything that has been waiting for flush_seconds
+        while not self._stop.wait(self.flush_seconds):
+            self.flush()
+
+
+class _OpenLog:
+    def __init__(self, filename, fieldnames, buffer_size):
+        self.filename = filename
+        self.file = open(filename, "a", buffering=buffer_size)
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, quoting=csv.QUOTE_ALL)
+        self.pending = 0  # Rows written since the last flush
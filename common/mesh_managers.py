@@ -1,10 +1,15 @@
+import collections
 import logging
+import queue
+import threading
+import time
 from pubsub import pub
 
 import meshtastic.mesh_interface
 from common import serial_port
 from common import tcp
 from common import ble
+from common.reconnect import ReconnectSupervisor
 
 log = logging.getLogger(__name__)
 # log.setLevel(logging.DEBUG)  # Set our own logging level separately from the root
@@ -15,15 +20,21 @@ class InterfaceError(Exception):
 class Unimplemented(Exception):
     pass
 
+class DiscoveryTimeout(InterfaceError):
+    pass
+
 
 # noinspection PyMethodMayBeStatic
 class DeviceManager:
     # Manage a set of Meshtastic devices across several interface types.
     supported_interface_types = ["ble", "tcp", "serial"]
+    discovery_timeouts = {"ble": 20.0, "tcp": 5.0, "serial": 10.0}  # Seconds; a BLE scan alone takes about 10
+    default_discovery_timeout = 10.0
 
     def __init__(self):
         log.debug("Initializing mesh manager")
         super().__init__()
+        self.reconnect_supervisor = None  # See enable_auto_reconnect()
         pub.subscribe(self.onConnectionUp, "meshtastic.connection.established")
         pub.subscribe(self.onConnectionDown, "meshtastic.connection.lost")
 
@@ -35,34 +46,87 @@ class DeviceManager:
     # noinspection PyUnusedLocal
     def onConnectionDown(self, interface, topic=pub.AUTO_TOPIC):
         log.info(f"Connection lost on interface {interface.getShortName()}")
+        if self.reconnect_supervisor:
+            self.reconnect_supervisor.connection_lost(interface)
         return
 
-    def find_all_available_devices(self, interface_types=None) -> list:
+    def enable_auto_reconnect(self, on_reconnected=None, on_state_change=None, **options):
+        # From now on, devices connected through connect_to_specific_device are reconnected automatically if
+        # their connection is lost. See common.reconnect.ReconnectSupervisor for the callbacks and options.
+        self.reconnect_supervisor = ReconnectSupervisor(self.connect_to_specific_device, on_reconnected,
+                                                        on_state_change, **options)
+
+    def is_reconnecting(self, interface) -> bool:
+        # True if a lost interface will be (or is being) reconnected automatically
+        return bool(self.reconnect_supervisor and self.reconnect_supervisor.is_watched(interface))
+
+    def connect_supervised(self, interface_type, address):
+        # Connect to a device in the background and keep it connected, retrying until the first connect works.
+        # Needs enable_auto_reconnect(); its on_reconnected callback hears about the connection.
+        if not self.reconnect_supervisor:
+            raise InterfaceError("connect_supervised needs auto reconnect to be enabled")
+        if interface_type not in self.supported_interface_types:
+            raise InterfaceError(f"interface_type must be one of {str(self.supported_interface_types)}")
+        self.reconnect_supervisor.supervise(interface_type, address)
+
+    def forget_device(self, interface):
+        # Call before closing an interface on purpose, so it isn't reconnected
+        if self.reconnect_supervisor:
+            self.reconnect_supervisor.unwatch(interface)
+
+    def find_all_available_devices(self, interface_types=None, timeouts=None) -> list:
         # Find all available mesh nodes on the listed interface types
         # Returns a list of tuples: (type, address, name)
+        # All the types are searched at once (see iter_available_devices). If some of them fail or take too long,
+        # the devices the others found are still returned; InterfaceError is raised only if every type failed.
 
-        if interface_types is None:
-            interface_types = self.supported_interface_types
-        else:
-            if not isinstance(interface_types, list):
-                raise InterfaceError("interface_type must be a list")
-            if not all(y in self.supported_interface_types for y in interface_types):
-                raise InterfaceError(f"interface_type must be one of {str(self.supported_interface_types)}")
+        devices = []  # List of all available devices on all requested types
+        errors = []
+        searched = 0  # Types searched without an error
+        for i_type, devs, error in self.iter_available_devices(interface_types, timeouts):
+            devices.extend(devs)
+            if error is None:
+                searched += 1
+            elif not isinstance(error, Unimplemented):  # Ignore unimplemented for now
+                errors.append(f"{i_type}: {error}")
+        if errors and not searched:
+            raise InterfaceError(f"Unable to find devices: {'; '.join(errors)}")
+        return devices
+
+    def iter_available_devices(self, interface_types=None, timeouts=None):
+        # Search the listed interface types for devices all at once, yielding (type, list of (type, address, name)
+        # tuples, exception or None) for each type as its search finishes, quickest first.
+        # A type that hasn't finished in its timeout (seconds; timeouts is a dict by type, defaulting to
+        # discovery_timeouts) is given up on and yielded with a DiscoveryTimeout. Its search is left to finish
+        # in the background, since a scan can't be interrupted.
+
+        interface_types = self._checked_interface_types(interface_types)
+        timeouts = {**self.discovery_timeouts, **(timeouts or {})}
+        timeouts = {i_type: timeouts.get(i_type, self.default_discovery_timeout) for i_type in interface_types}
 
-        # For each interface type, find all devices
         log.debug(f"Finding available devices for {interface_types}")
-        devices = []  # List of all available devices on all requested types
+        # Daemon threads rather than a thread pool, so a scan that never returns can't keep the program from exiting
+        results = queue.Queue()
+        start = time.monotonic()
         for i_type in interface_types:
+            threading.Thread(target=self._find_devices_into, args=(i_type, results), name=f"discover-{i_type}",
+                             daemon=True).start()
+        deadlines = {i_type: start + timeouts[i_type] for i_type in interface_types}
+        while deadlines:
             try:
-                devs = self.find_devices_on_type(i_type)
-                devices.extend(devs)
-            except Unimplemented:
-                pass  # Ignore unimplemented for now
-            except Exception as e:
-                log.error(f"Exception raised while trying to find devices on type {i_type}: {e}")
-                raise
-
-        return devices
+                i_type, devs, error = results.get(timeout=max(0.0, min(deadlines.values()) - time.monotonic()))
+            except queue.Empty:
+                now = time.monotonic()
+                for i_type in [i_type for i_type, deadline in deadlines.items() if deadline <= now]:
+                    del deadlines[i_type]
+                    log.warning(f"Gave up finding {i_type} devices after {timeouts[i_type]:.0f}s")
+                    yield i_type, [], DiscoveryTimeout(f"No response in {timeouts[i_type]:.0f} seconds")
+                continue
+            if deadlines.pop(i_type, None) is None:
+                continue  # Already given up on
+            if error is None:
+                log.debug(f"Found {len(devs)} {i_type} devices in {time.monotonic() - start:.1f}s")
+            yield i_type, devs, error
 
     def find_devices_on_type(self, interface_type: str) -> list:
         # Find all available devices on a specific interface type
@@ -102,10 +166,156 @@ class DeviceManager:
         else:
             raise InterfaceError("Unknown interface type")  # Should not reach this (belt and suspenders)
 
+        if interface and self.reconnect_supervisor:
+            self.reconnect_supervisor.watch(interface, interface_type, address)
         return interface
 
-    def connect_to_first_device_on_type(self, interface_type: str):
-        pass
+    def connect_to_first_device_on_type(self, interface_type: str, timeout=None):
+        # Connect to all the devices found on one interface type at once, and keep whichever finishes connecting
+        # first. The others are closed as they finish. Returns the MeshInterface, or None if none could be
+        # connected (within timeout seconds, if given).
+        if interface_type not in self.supported_interface_types:
+            raise InterfaceError(f"interface_type must be one of {str(self.supported_interface_types)}")
+        return self._race_connect(self._found_devices([interface_type]), timeout)
+
+    def connect_to_first_available_device(self, type_list:list, timeout=None, priority_grace=2.0):
+        # Like connect_to_first_device_on_type, across several interface types: all of them are searched at once,
+        # and connecting to each type's devices starts as soon as that type's search finishes, so a fast type
+        # doesn't wait for a slow one (BLE). type_list is in order of preference: once a device has connected, one
+        # of a type earlier in the list that connects within priority_grace seconds is kept instead. A device of
+        # the first type is kept as soon as it connects.
+        type_list = self._checked_interface_types(type_list)
+        rank = {i_type: n for n, i_type in enumerate(type_list)}
+        return self._race_connect(self._found_devices(type_list), timeout, lambda device: rank[device[0]],
+                                  priority_grace)
 
-    def connect_to_first_available_device(self, type_list:list):
-        pass
+    # === Helpers and private functions
+
+    def _found_devices(self, interface_types):
+        # Devices on these types, as each type's search finishes
+        for i_type, devs, error in self.iter_available_devices(interface_types):
+            yield from devs
+
+    def _race_connect(self, candidates, timeout, rank=None, grace=0.0):
+        # Connect to every (type, address, name) in candidates at once, returning the first interface to finish
+        # connecting (or None). candidates can be a slow generator; it's read on its own thread, and each
+        # device is tried as soon as it arrives. A connection can't be abandoned halfway, so the ones that lose
+        # the race are closed when they finish, in the background.
+        # rank(device) is a device's priority, lower is better. After the first connection, the race goes on for up
+        # to grace seconds while a better ranked device could still connect, and the best ranked one is kept.
+        rank = rank or (lambda device: 0)
+        results = queue.Queue()  # of (what happened, device, interface, error)
+        won = threading.Event()
+
+        def attempt(device):
+            try:
+                interface = self.connect_to_specific_device(device[0], device[1])
+                error = None
+            except Exception as e:
+                interface = None
+                error = e
+            results.put(("done", device, interface, error))
+
+        def feed():
+            try:
+                for device in candidates:
+                    if won.is_set():
+                        break
+                    results.put(("started", device, None, None))
+                    threading.Thread(target=attempt, args=(device,), name=f"connect-{device[1]}", daemon=True).start()
+            except Exception as e:
+                log.error(f"Error finding devices to connect to: {e}")
+            results.put(("fed", None, None, None))
+
+        def better_possible():
+            # A better ranked device than the winner could still connect
+            best = rank(winner[0])
+            return best > 0 and (not fed or any(count for r, count in running.items() if r < best))
+
+        threading.Thread(target=feed, name="connect-race", daemon=True).start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        running = collections.Counter()  # key = rank, value = attempts in progress
+        fed = False
+        winner = None  # (device, interface)
+        while not fed or sum(running.values()):
+            if winner is not None:
+                if not better_possible():
+                    break
+                deadline = grace_deadline if deadline is None else min(deadline, grace_deadline)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                break
+            try:
+                what, device, interface, error = results.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if what == "started":
+                running[rank(device)] += 1
+            elif what == "fed":
+                fed = True
+            else:
+                running[rank(device)] -= 1
+                if not interface:
+                    log.info(f"Unable to connect to {device[0]} device {device[1]}: {error or 'no interface'}")
+                elif winner is None:
+                    winner = (device, interface)
+                    grace_deadline = time.monotonic() + grace
+                elif rank(device) < rank(winner[0]):
+                    self._discard_connection(*winner, f"{device[0]} device {device[1]} is preferred")
+                    winner = (device, interface)
+                else:
+                    self._discard_connection(device, interface, "another device connected first")
+
+        won.set()
+        running = sum(running.values())
+        if not fed or running:
+            threading.Thread(target=self._close_race_losers, args=(results, running, fed), name="connect-race-losers",
+                             daemon=True).start()
+        if winner is None:
+            log.warning("No device could be connected")
+            return None
+        log.info(f"Kept {winner[0][0]} device {winner[0][1]}")
+        return winner[1]
+
+    def _close_race_losers(self, results, running, fed):
+        # Close the connections that lost a race as they finish
+        while not fed or running:
+            what, device, interface, error = results.get()
+            if what == "started":
+                running += 1
+            elif what == "fed":
+                fed = True
+            else:
+                running -= 1
+                if interface:
+                    self._discard_connection(device, interface, "another device connected first")
+
+    def _discard_connection(self, device, interface, reason):
+        # Close a connection that lost a race, in the background
+        log.info(f"Closing {device[0]} device {device[1]}, {reason}")
+        self.forget_device(interface)
+        threading.Thread(target=self._close_quietly, args=(interface,), daemon=True).start()
+
+    def _close_quietly(self, interface):
+        try:
+            interface.close()
+        except Exception as e:
+            log.debug(f"Error closing interface: {e}")
+
+    def _find_devices_into(self, interface_type, results):
+        # Runs on a discovery thread
+        try:
+            results.put((interface_type, self.find_devices_on_type(interface_type), None))
+        except Exception as e:
+            if not isinstance(e, Unimplemented):
+                log.error(f"Exception raised while trying to find devices on type {interface_type}: {e}")
+            results.put((interface_type, [], e))
+
+    def _checked_interface_types(self, interface_types) -> list:
+        if interface_types is None:
+            return self.supported_interface_types
+        if not isinstance(interface_types, list):
+            raise InterfaceError("interface_type must be a list")
+        if not all(y in self.supported_interface_types for y in interface_types):
+            raise InterfaceError(f"interface_type must be one of {str(self.supported_interface_types)}")
+        return interface_types
@@ -0,0 +1,187 @@
+# In-memory message buffers
+
+import calendar
+import logging
+import sys
+import time
+from array import array
+from datetime import datetime
+from functools import lru_cache
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+
+# === Message records
+# Messages are compact slotted objects rather than dicts. Node and channel names are interned, so every message
+# from a node shares one copy of its name, and timestamps are integers (see timestamp_to_seconds).
+# The "timestamp" property renders the timestamp the way the message logs and lists show it, so
+# ObjectListView columns can use "timestamp" as an attribute getter.
+
+timestamp_format = "%Y-%m-%d %H:%M:%S"
+
+
+class ChannelMessage:
+    __slots__ = ("time", "sender", "message")
+
+    def __init__(self, timestamp, sender, message):
+        self.time = timestamp_to_seconds(timestamp)
+        self.sender = sys.intern(sender)
+        self.message = message
+
+    @property
+    def timestamp(self):
+        return seconds_to_timestamp(self.time)
+
+
+class DirectMessage:
+    # Either from_node or to_node is the remote node, depending on which way the message went
+    __slots__ = ("time", "from_node", "to_node", "message")
+
+    def __init__(self, timestamp, from_node, to_node, message):
+        self.time = timestamp_to_seconds(timestamp)
+        self.from_node = sys.intern(from_node)
+        self.to_node = sys.intern(to_node)
+        self.message = message
+
+    @property
+    def timestamp(self):
+        return seconds_to_timestamp(self.time)
+
+
+def timestamp_to_seconds(timestamp) -> int:
+    # Timestamps are local wall-clock times, counted in seconds as if local time were UTC. That round-trips the
+    # text timestamps in the message logs exactly (DST changes and all) and still sorts chronologically.
+    # Accepts log text ("YYYY-MM-DD HH:MM:SS"), a datetime, or seconds already.
+    if isinstance(timestamp, int):
+        return timestamp
+    if isinstance(timestamp, datetime):
+        return calendar.timegm(timestamp.timetuple())
+    try:
+        # Fast path for the log format: the date part is cached, the time of day is simple arithmetic
+        return (_date_to_seconds(timestamp[:10]) +
+                int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19]))
+    except (ValueError, TypeError):
+        log.warning(f"Unrecognized message timestamp {timestamp}")
+        return 0
+
+
+def seconds_to_timestamp(seconds) -> str:
+    return time.strftime(timestamp_format, time.gmtime(seconds))
+
+
+@lru_cache(maxsize=4096)
+def _date_to_seconds(date):
+    return calendar.timegm(time.strptime(date, "%Y-%m-%d"))
+
+
+class DirectMessageTable:
+    # Every direct message is stored exactly once, in one append-only table. The per-device view ("all direct
+    # messages on this device") and the per-conversation view ("messages between this device and that remote
+    # node") are arrays of row numbers into the table, so a message costs one integer in each view.
+    #
+    # Views are in display order (oldest first), which is not necessarily row order: history paged in from the
+    # log is appended to the table but goes at the front of a view. Each view can be trimmed to a maximum
+    # length; a message is dropped from the table once no view holds it, and the table is compacted once
+    # dropped rows outnumber live ones.
+    def __init__(self):
+        self.rows = []  # DirectMessage records (None once no view holds them)
+        self._refs = bytearray()  # Number of views holding each row
+        self._dropped = 0  # Number of None rows
+        self._device_views = {}  # key = device shortname, value = array of row numbers
+        self._conversation_views = {}  # key = (device shortname, remote shortname), value = array of row numbers
+
+    def append(self, device, remote, message) -> int:
+        # Add a new (newest) message to the device and conversation views, return its row number
+        row = len(self.rows)
+        self.rows.append(message)
+        self._refs.append(2)
+        self._device_view(device).append(row)
+        self._conversation_view(device, remote).append(row)
+        return row
+
+    def prepend_device(self, device, messages):
+        # Add older messages (oldest first) to the front of a device view
+        self._device_view(device)[:0] = self._add_rows(messages)
+
+    def prepend_conversation(self, device, remote, messages):
+        # Add older messages (oldest first) to the front of a conversation view
+        self._conversation_view(device, remote)[:0] = self._add_rows(messages)
+
+    def trim_device(self, device, keep) -> int:
+        # Drop all but the newest <keep> messages from a device view. Returns the number dropped.
+        return self._trim(self._device_views.get(device), keep)
+
+    def trim_conversation(self, device, remote, keep) -> int:
+        # Drop all but the newest <keep> messages from a conversation view. Returns the number dropped.
+        return self._trim(self._conversation_views.get((device, remote)), keep)
+
+    # The message lists start at index <start> of the view; a negative start counts back from the newest message
+    def device_messages(self, device, start=0) -> list:
+        rows = self.rows
+        return [rows[row] for row in self._device_views.get(device, array("q"))[start:]]
+
+    def conversation_messages(self, device, remote, start=0) -> list:
+        rows = self.rows
+        return [rows[row] for row in self._conversation_views.get((device, remote), array("q"))[start:]]
+
+    def device_length(self, device) -> int:
+        return len(self._device_views.get(device, ()))
+
+    def conversation_length(self, device, remote) -> int:
+        return len(self._conversation_views.get((device, remote), ()))
+
+    def resident_count(self) -> int:
+        # Number of messages actually held in memory
+        return len(self.rows) - self._dropped
+
+    # === Helpers and private functions
+
+    def _add_rows(self, messages):
+        first_row = len(self.rows)
+        self.rows.extend(messages)
+        self._refs.extend(b"\x01" * len(messages))
+        return array("q", range(first_row, len(self.rows)))
+
+    def _trim(self, view, keep) -> int:
+        if view is None or len(view) <= keep:
+            return 0
+        excess = len(view) - keep
+        for row in view[:excess]:
+            self._refs[row] -= 1
+            if self._refs[row] == 0:
+                self.rows[row] = None
+                self._dropped += 1
+        del view[:excess]
+
+        if self._dropped > len(self.rows) // 2:
+            self._compact()
+        return excess
+
+    def _compact(self):
+        # Renumber the live rows and rewrite the views to match
+        log.debug(f"Compacting direct message table, dropping {self._dropped} of {len(self.rows)} rows")
+        new_numbers = array("q", bytes(8 * len(self.rows)))
+        live_rows = []
+        for row, message in enumerate(self.rows):
+            if message is not None:
+                new_numbers[row] = len(live_rows)
+                live_rows.append(message)
+        self._refs = bytearray(self._refs[row] for row, message in enumerate(self.rows) if message is not None)
+        self.rows = live_rows
+        self._dropped = 0
+        for views in (self._device_views, self._conversation_views):
+            for key, view in views.items():
+                views[key] = array("q", (new_numbers[row] for row in view))
+
+    def _device_view(self, device):
+        view = self._device_views.get(device)
+        if view is None:
+            view = self._device_views[device] = array("q")
+        return view
+
+    def _conversation_view(self, device, remote):
+        view = self._conversation_views.get((device, remote))
+        if view is None:
+            view = self._conversation_views[(device, remote)] = array("q")
+        return view
@@ -0,0 +1,246 @@
+# Embedded SQLite message store
+# An alternative to keeping every channel and direct message in memory. Messages are indexed by
+# (device, channel, timestamp) and (device, remote, timestamp) so a view can fetch just the rows it shows.
+
+import csv
+import logging
+import os
+import sqlite3
+import threading
+
+from common.message_buffers import ChannelMessage, DirectMessage
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+_schema = """
+CREATE TABLE IF NOT EXISTS channel_messages (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    sender TEXT,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS channel_messages_by_channel ON channel_messages (device, channel, timestamp);
+
+CREATE TABLE IF NOT EXISTS direct_messages (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    remote TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    from_node TEXT,
+    to_node TEXT,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS direct_messages_by_device ON direct_messages (device, timestamp);
+CREATE INDEX IF NOT EXISTS direct_messages_by_remote ON direct_messages (device, remote, timestamp);
+
+CREATE TABLE IF NOT EXISTS imported_logs (
+    filename TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    head BLOB NOT NULL,  -- The start of the log, in case a new log gets the old one's inode
+    offset INTEGER NOT NULL  -- Where the next import of the log starts
+);
+"""
+
+_head_bytes = 256
+
+# Imported rows that are already in the store (e.g. the GUI wrote them to both) are skipped
+_import_channel_row = """
+INSERT INTO channel_messages (device, channel, timestamp, sender, message)
+SELECT :device, :channel, :timestamp, :sender, :message
+WHERE NOT EXISTS (SELECT 1 FROM channel_messages WHERE device = :device AND channel = :channel
+                  AND timestamp = :timestamp AND sender IS :sender AND message IS :message)
+"""
+_import_direct_row = """
+INSERT INTO direct_messages (device, remote, timestamp, from_node, to_node, message)
+SELECT :device, :remote, :timestamp, :from, :to, :message
+WHERE NOT EXISTS (SELECT 1 FROM direct_messages WHERE device = :device AND remote = :remote
+                  AND timestamp = :timestamp AND from_node IS :from AND to_node IS :to AND message IS :message)
+"""
+
+
+class StoredChannelMessage(ChannelMessage):
+    # A ChannelMessage read from the store, with its row id
+    __slots__ = ("id",)
+
+    def __init__(self, row_id, timestamp, sender, message):
+        ChannelMessage.__init__(self, timestamp, sender, message)
+        self.id = row_id
+
+
+class StoredDirectMessage(DirectMessage):
+    # A DirectMessage read from the store, with its row id
+    __slots__ = ("id",)
+
+    def __init__(self, row_id, timestamp, from_node, to_node, message):
+        DirectMessage.__init__(self, timestamp, from_node, to_node, message)
+        self.id = row_id
+
+
+class MessageStore:
+    # Timestamps are stored as "YYYY-MM-DD HH:MM:SS" text, which sorts chronologically.
+    # Query results are lists of the same records the in-memory message buffers hold (with their row ids added,
+    # see StoredChannelMessage and StoredDirectMessage), oldest first.
+    def __init__(self, filename):
+        log.info(f"Opening message store {filename}")
+        self.filename = filename
+        # The GUI thread does the work, but allow other threads in and serialize them with a lock
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_schema)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # === Adding messages
+
+    def add_channel_message(self, device, channel, timestamp, sender, message):
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO channel_messages (device, channel, timestamp, sender, message) "
+                             "VALUES (?, ?, ?, ?, ?)", (device, channel, str(timestamp), sender, message))
+
+    def add_direct_message(self, device, remote, timestamp, from_node, to_node, message):
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO direct_messages (device, remote, timestamp, from_node, to_node, message) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", (device, remote, str(timestamp), from_node, to_node, message))
+
+    # Importing message logs. The store remembers how far into each log it has imported, so each import picks up
+    # just the rows added since (by msg_forward, or by the GUI while MESSAGE_DB was unset). A log that has been
+    # replaced or truncated since is imported from the start again.
+
+    def import_channel_log(self, filename, fieldnames) -> int:
+        # Import the rows added to a channel message CSV log since it was last imported. Returns the number imported.
+        count = self._import_log(filename, fieldnames, _import_channel_row)
+        log.info(f"Imported {count} channel messages from {filename}")
+        return count
+
+    def import_direct_log(self, filename, fieldnames) -> int:
+        # Import the rows added to a direct message CSV log since it was last imported. Returns the number imported.
+        count = self._import_log(filename, fieldnames, _import_direct_row)
+        log.info(f"Imported {count} direct messages from {filename}")
+        return count
+
+    # === Querying messages
+    # Each query returns at most <limit> of the newest messages, optionally only those older than <before>
+    # (a timestamp), so older history can be paged in a window at a time.
+
+    def channel_messages(self, device, channel, limit, before=None) -> list:
+        rows = self._newest("SELECT id, timestamp, sender, message FROM channel_messages "
+                            "WHERE device = ? AND channel = ?", (device, channel), limit, before)
+        return [StoredChannelMessage(*row) for row in rows]
+
+    def direct_messages(self, device, limit, before=None) -> list:
+        rows = self._newest("SELECT id, timestamp, from_node, to_node, message FROM direct_messages "
+                            "WHERE device = ?", (device,), limit, before)
+        return [StoredDirectMessage(*row) for row in rows]
+
+    def conversation_messages(self, device, remote, limit, before=None) -> list:
+        rows = self._newest("SELECT id, timestamp, from_node, to_node, message FROM direct_messages "
+                            "WHERE device = ? AND remote = ?", (device, remote), limit, before)
+        return [StoredDirectMessage(*row) for row in rows]
+
+    # Messages added after the one with row id after_id, in the order they were added. A view that shows the
+    # newest messages uses these to pick up new ones without querying its whole window again.
+    # Messages are never deleted, so row ids only grow and these are range scans of the rows added since.
+    # The unary + keeps SQLite from using a (device, ...) index instead, which would walk the whole view.
+
+    def channel_messages_after(self, device, channel, after_id) -> list:
+        rows = self._after("SELECT id, timestamp, sender, message FROM channel_messages "
+                           "WHERE id > ? AND +device = ? AND +channel = ?", (after_id, device, channel))
+        return [StoredChannelMessage(*row) for row in rows]
+
+    def direct_messages_after(self, device, after_id) -> list:
+        rows = self._after("SELECT id, timestamp, from_node, to_node, message FROM direct_messages "
+                           "WHERE id > ? AND +device = ?", (after_id, device))
+        return [StoredDirectMessage(*row) for row in rows]
+
+    def conversation_messages_after(self, device, remote, after_id) -> list:
+        rows = self._after("SELECT id, timestamp, from_node, to_node, message FROM direct_messages "
+                           "WHERE id > ? AND +device = ? AND +remote = ?", (after_id, device, remote))
+        return [StoredDirectMessage(*row) for row in rows]
+
+    # === Counting messages (from the indexes, without reading any messages)
+
+    def channel_count(self, device, channel) -> int:
+        return self._count("SELECT COUNT(*) FROM channel_messages WHERE device = ? AND channel = ?",
+                           (device, channel))
+
+    def direct_count(self, device) -> int:
+        return self._count("SELECT COUNT(*) FROM direct_messages WHERE device = ?", (device,))
+
+    def conversation_count(self, device, remote) -> int:
+        return self._count("SELECT COUNT(*) FROM direct_messages WHERE device = ? AND remote = ?", (device, remote))
+
+    # === Helpers and private functions
+
+    def _import_log(self, filename, fieldnames, insert) -> int:
+        path = os.path.abspath(filename)
+        with open(filename, "rb") as lf:
+            stat = os.fstat(lf.fileno())
+            with self._lock:
+                imported = self._db.execute("SELECT inode, head, offset FROM imported_logs WHERE filename = ?",
+                                            (path,)).fetchone()
+            start = 0
+            if imported:
+                inode, head, offset = imported
+                if inode == stat.st_ino and offset <= stat.st_size and lf.read(len(head)) == head:
+                    start = offset
+            end = _last_line_end(lf, start, stat.st_size)  # Leave out a row that is still being written
+            lf.seek(0)
+            head = lf.read(min(end, _head_bytes))
+            lf.seek(start)
+            rows = csv.DictReader(_decoded_lines(lf, end), fieldnames=fieldnames)
+            with self._lock, self._db:
+                count = self._db.executemany(insert, rows).rowcount
+                self._db.execute("INSERT OR REPLACE INTO imported_logs (filename, inode, head, offset) "
+                                 "VALUES (?, ?, ?, ?)", (path, stat.st_ino, head, end))
+        return count
+
+    def _after(self, select, params):
+        with self._lock:
+            return self._db.execute(select + " ORDER BY id", params).fetchall()
+
+    def _count(self, select, params) -> int:
+        with self._lock:
+            return self._db.execute(select, params).fetchone()[0]
+
+    def _newest(self, select, params, limit, before):
+        if before is not None:
+            select += " AND timestamp < ?"
+            params += (str(before),)
+        select += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        params += (int(limit),)
+        with self._lock:
+            rows = self._db.execute(select, params).fetchall()
+        rows.reverse()  # Oldest first, the way the views show them
+        return rows
+
+
+def _last_line_end(f, start, size, block_size=64 * 1024) -> int:
+    # The offset just past the last newline at or after start in an open (binary) file, or start if there isn't one
+    pos = size
+    while pos > start:
+        read_size = min(block_size, pos - start)
+        pos -= read_size
+        f.seek(pos)
+        newline = f.read(read_size).rfind(b"\n")
+        if newline >= 0:
+            return pos + newline + 1
+    return start
+
+
+def _decoded_lines(f, end):
+    # The lines of an open (binary) file from where it is now up to offset end, as text for the csv module
+    pos = f.tell()
+    for line in f:
+        pos += len(line)
+        if pos > end:
+            return
+        yield line.decode("utf-8", errors="replace")
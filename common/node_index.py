@@ -0,0 +1,114 @@
+# Lookup index over a device's node database
+# interface.nodes is keyed by node ID only, so finding a node by shortname (what the message logs and lists
+# hold) or by node number (what some packets carry) means scanning every node. A NodeIndex keeps all three
+# keys current so each lookup is a dict access.
+
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+
+class NodeIndex:
+    # Shortnames aren't unique: two nodes can pick the same one. Every node with a given shortname is kept,
+    # and a lookup by shortname returns the one heard from most recently (see nodes_with_shortname() to get
+    # them all). Node updates arrive on the Meshtastic reader thread and lookups come from the GUI thread,
+    # so both go through a lock.
+    def __init__(self, nodes=None):
+        self._lock = threading.Lock()
+        self._by_id = {}  # key = node ID ("!1234abcd"), value = node dict
+        self._by_num = {}  # key = node number, value = node dict
+        self._by_shortname = {}  # key = shortname, value = tuple of node IDs with that shortname
+        if nodes:
+            self.load(nodes)
+
+    def load(self, nodes):
+        # (Re)build the index from a node database, a dict of node dicts like interface.nodes
+        with self._lock:
+            self._by_id = {}
+            self._by_num = {}
+            self._by_shortname = {}
+            for node in list(nodes.values()):  # The reader thread may be adding nodes as we go
+                self._add(node)
+        log.debug(f"Indexed {len(self._by_id)} nodes")
+
+    def update(self, node):
+        # Add or update one node dict (as delivered by meshtastic.node.updated)
+        with self._lock:
+            self._remove(_node_id(node), node.get("num"))
+            self._add(node)
+
+    def remove(self, node_id):
+        with self._lock:
+            self._remove(node_id, None)
+
+    # === Lookups
+
+    def by_id(self, node_id):
+        return self._by_id.get(node_id)
+
+    def by_num(self, node_num):
+        return self._by_num.get(node_num)
+
+    def by_shortname(self, shortname):
+        # The node with this shortname, or the most recently heard one if more than one node has it
+        with self._lock:
+            node_ids = self._by_shortname.get(shortname, ())
+            if len(node_ids) == 1:
+                return self._by_id[node_ids[0]]
+            nodes = [self._by_id[node_id] for node_id in node_ids]
+        if not nodes:
+            return None
+        return max(nodes, key=lambda node: node.get("lastHeard") or 0)
+
+    def nodes_with_shortname(self, shortname) -> list:
+        with self._lock:
+            return [self._by_id[node_id] for node_id in self._by_shortname.get(shortname, ())]
+
+    def shortname(self, node_id=None, node_num=None):
+        # Shortname of the node with this ID or (failing that) number, or None if it isn't known
+        node = self._by_id.get(node_id) or self._by_num.get(node_num)
+        if node is None:
+            return None
+        return node.get("user", {}).get("shortName")
+
+    def __len__(self):
+        return len(self._by_id)
+
+    # === Helpers and private functions
+    # Callers must hold self._lock
+
+    def _add(self, node):
+        node_id = _node_id(node)
+        if node_id is None:
+            if node.get("num") is not None:
+                self._by_num[node["num"]] = node  # Can still be found by number
+            return
+        self._by_id[node_id] = node
+        if node.get("num") is not None:
+            self._by_num[node["num"]] = node
+        shortname = node.get("user", {}).get("shortName")
+        if shortname:
+            node_ids = self._by_shortname.get(shortname, ())
+            if node_ids:
+                log.info(f"Shortname {shortname} is shared by nodes {', '.join(node_ids + (node_id,))}")
+            self._by_shortname[shortname] = node_ids + (node_id,)
+
+    def _remove(self, node_id, node_num):
+        old = self._by_id.pop(node_id, None)
+        if old is not None:
+            if old.get("num") is not None and self._by_num.get(old["num"]) is old:
+                del self._by_num[old["num"]]
+            shortname = old.get("user", {}).get("shortName")
+            node_ids = tuple(other_id for other_id in self._by_shortname.get(shortname, ()) if other_id != node_id)
+            if node_ids:
+                self._by_shortname[shortname] = node_ids
+            else:
+                self._by_shortname.pop(shortname, None)
+        if node_num is not None:
+            self._by_num.pop(node_num, None)
+
+
+def _node_id(node):
+    return node.get("user", {}).get("id")
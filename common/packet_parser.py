@@ -0,0 +1,94 @@
+# Text message packet parsing, shared by the GUI and msg_forward
+# Turns a meshtastic.receive.text packet into a TextMessage: which device got it, on what channel, who sent it,
+# and whether it was sent to us directly or broadcast. The receiving device's own node ID and shortname are
+# cached per interface, rather than asked of the interface for every packet.
+
+import logging
+import weakref
+from enum import Enum, unique
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+
+_empty = {}  # Shared read-only default for lookups
+
+
+@unique
+class MessageType(Enum):  # Define constants for message type, since they will be used in several places
+    DIRECT_MESSAGE = "Direct"  # A message sent directly to a node
+    BROADCAST_MESSAGE = "Broadcast"  # A message sent to "^all" on a channel
+    PASSTHRU_MESSAGE = "Passthru"  # A message destined for another specific node; we should never see this
+
+
+class TextMessage:
+    # from_shortname and from_longname are None if the sender isn't in the device's node database.
+    # rx_time is the packet's receive time in seconds since the epoch, or None if it didn't have one.
+    __slots__ = ("device", "device_id", "channel", "message_type", "from_id", "from_num", "from_shortname",
+                 "from_longname", "to_id", "text", "rx_time")
+
+    def __init__(self, device, device_id, channel, message_type, from_id, from_num, from_shortname, from_longname,
+                 to_id, text, rx_time):
+        self.device = device
+        self.device_id = device_id
+        self.channel = channel
+        self.message_type = message_type
+        self.from_id = from_id
+        self.from_num = from_num
+        self.from_shortname = from_shortname
+        self.from_longname = from_longname
+        self.to_id = to_id
+        self.text = text
+        self.rx_time = rx_time
+
+
+class PacketParser:
+    def __init__(self):
+        # key = id(interface), value = (weak reference to the interface, (node ID, shortname)).
+        # Keyed by id() rather than a WeakKeyDictionary, which would make a new weak reference for every lookup.
+        self._identities = {}
+
+    def parse(self, packet, interface, node_index=None) -> TextMessage:
+        # Parse one text message packet. The sender is looked up in node_index (a common.node_index.NodeIndex)
+        # if one is given, otherwise in the interface's own node database.
+        device_id, device = self.identity(interface)
+
+        channel = getattr(packet.get("raw"), "channel", "Unknown")
+        decoded = packet.get("decoded")
+        text = decoded.get("text", "Unknown text") if decoded else "Unknown text"
+
+        from_id = packet.get("fromId")
+        from_num = packet.get("from")
+        if node_index is not None:
+            node = node_index.by_id(from_id) or node_index.by_num(from_num)
+        else:
+            node = (interface.nodes or _empty).get(from_id) or (interface.nodesByNum or _empty).get(from_num)
+        user = node.get("user", _empty) if node else _empty
+
+        to_id = packet.get("toId", "Unknown ToId")
+        if to_id == device_id:
+            message_type = MessageType.DIRECT_MESSAGE
+        elif to_id == "^all":
+            message_type = MessageType.BROADCAST_MESSAGE
+        else:
+            message_type = MessageType.PASSTHRU_MESSAGE  # Belt and suspenders, we shouldn't see one of these
+
+        rx_time = packet.get("rxTime")
+        return TextMessage(device, device_id, channel, message_type, from_id, from_num, user.get("shortName"),
+                           user.get("longName"), to_id, text, int(rx_time) if rx_time else None)
+
+    def identity(self, interface) -> tuple:
+        # (node ID, shortname) of the device behind an interface
+        entry = self._identities.get(id(interface))
+        if entry is not None and entry[0]() is interface:
+            return entry[1]
+
+        my_node_info = interface.getMyNodeInfo() or {}
+        identity = (my_node_info.get("user", {}).get("id", "unknown"), interface.getShortName())
+        if identity[0] != "unknown":  # Don't cache what the interface didn't know yet
+            self._identities[id(interface)] = (weakref.ref(interface), identity)
+        return identity
+
+    def forget(self, interface):
+        # Drop the cached identity, e.g. after the device's owner settings were changed
+        self._identities.pop(id(interface), None)
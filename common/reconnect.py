@@ -0,0 +1,264 @@
+# Automatic reconnection to devices whose connection was lost
+# A radio drops its connection whenever it reboots, including the reboots that saving some settings or
+# resetting the node database cause. A ReconnectSupervisor watches the devices it's told about and, when one
+# is lost, keeps trying to connect to it again from a thread of its own.
+#
+# Attempts back off exponentially with jitter (so devices lost together don't all retry together). After
+# failure_threshold failures in a row the circuit "opens": attempts drop to one every cooldown seconds until
+# one succeeds, rather than hammering a device that's gone for good.
+
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+# Device states
+STATE_CONNECTED = "connected"
+STATE_RECONNECTING = "reconnecting"
+STATE_OPEN = "open"  # Circuit open: too many failures, trying only once every cooldown seconds
+
+
+class _Device:
+    __slots__ = ("interface_type", "address", "interface", "state", "reconnects", "attempts", "failures",
+                 "downtime", "down_since", "thread")
+
+    def __init__(self, interface_type, address, interface):
+        self.interface_type = interface_type
+        self.address = address
+        self.interface = interface
+        self.state = STATE_CONNECTED
+        self.reconnects = 0
+        self.attempts = 0
+        self.failures = 0  # In a row
+        self.downtime = 0.0  # Seconds disconnected, in total, not counting a current outage
+        self.down_since = None
+        self.thread = None
+
+
+class ReconnectSupervisor:
+    # connect(interface_type, address) makes a new connection and returns its interface (a false value or an
+    # exception means it failed), normally DeviceManager.connect_to_specific_device.
+    # on_reconnected(interface_type, address, old interface (None after supervise()), new interface) and
+    # on_state_change(interface_type, address, state) are called from the reconnecting thread.
+    # clock, wait(seconds) and random can be replaced to test without real time passing; wait returns True
+    # if the supervisor is stopping.
+    def __init__(self, connect, on_reconnected=None, on_state_change=None, base_delay=2.0, max_delay=120.0,
+                 jitter=0.5, failure_threshold=6, cooldown=300.0, close_timeout=10.0, clock=time.monotonic,
+                 wait=None, random=random.random):
+        self.connect = connect
+        self.on_reconnected = on_reconnected
+        self.on_state_change = on_state_change
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self.jitter = min(1.0, max(0.0, float(jitter)))
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown = float(cooldown)
+        self.close_timeout = float(close_timeout)
+        self.clock = clock
+        self.random = random
+
+        self._stopping = threading.Event()
+        self.wait = wait or self._stopping.wait
+        self._devices = {}  # key = (interface type, address), value = _Device
+        self._lock = threading.Lock()
+
+    def watch(self, interface, interface_type, address):
+        # Start (or carry on) supervising the device behind a newly connected interface
+        with self._lock:
+            device = self._devices.get((interface_type, address))
+            if device is None:
+                self._devices[(interface_type, address)] = _Device(interface_type, address, interface)
+            else:
+                device.interface = interface
+
+    def supervise(self, interface_type, address):
+        # Start supervising a device that isn't connected yet: connect to it in the background, straight away, and
+        # keep trying as for a lost connection until it connects. on_reconnected is called with no old interface.
+        key = (interface_type, address)
+        with self._lock:
+            if key in self._devices or self._stopping.is_set():
+                return
+            device = self._devices[key] = _Device(interface_type, address, None)
+            device.state = STATE_RECONNECTING
+            self._start_reconnect(key, device, immediate=True)
+        log.info(f"Connecting to {interface_type} device {address}")
+
+    def unwatch(self, interface) -> bool:
+        # Stop supervising an interface, e.g. because it's being closed on purpose. A reconnect in progress
+        # gives up at its next attempt. Returns False if the interface wasn't being supervised.
+        with self._lock:
+            key = self._key(interface)
+            if key is None:
+                return False
+            del self._devices[key]
+        return True
+
+    def is_watched(self, interface) -> bool:
+        with self._lock:
+            return self._key(interface) is not None
+
+    def connection_lost(self, interface) -> bool:
+        # Start reconnecting to the device behind a lost interface. Returns False if it isn't being supervised.
+        with self._lock:
+            key = self._key(interface)
+            if key is None or self._stopping.is_set():
+                return False
+            device = self._devices[key]
+            if device.thread is not None:
+                return True  # Already on it
+            self._start_reconnect(key, device)
+        log.info(f"Lost {device.interface_type} device {device.address}, reconnecting")
+        return True
+
+    def stop(self, timeout=5.0) -> bool:
+        # Stop reconnecting, waiting up to timeout seconds in all for reconnects in progress to finish: one waiting
+        # for its next attempt gives up, and one that connects now closes its new connection. Connected interfaces
+        # are left open, see interfaces(). Returns False if some reconnects were still in progress at the timeout.
+        self._stopping.set()
+        return self.join(timeout)
+
+    def interfaces(self) -> list:
+        # The interfaces of the supervised devices that are connected now. Once stop() has returned True, these are
+        # all the connections left open.
+        with self._lock:
+            return [device.interface for device in self._devices.values()
+                    if device.state == STATE_CONNECTED and device.thread is None]
+
+    def join(self, timeout=None) -> bool:
+        # Wait (up to timeout seconds in all) for reconnects in progress to finish. Returns False if some haven't.
+        with self._lock:
+            threads = [device.thread for device in self._devices.values() if device.thread is not None]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in threads)
+
+    def stats(self) -> dict:
+        # key = address, value = dict of state, reconnects, attempts, failures in a row and downtime in seconds
+        # (including any current outage)
+        now = self.clock()
+        stats = {}
+        with self._lock:
+            for device in self._devices.values():
+                downtime = device.downtime
+                if device.down_since is not None:
+                    downtime += now - device.down_since
+                stats[device.address] = {"state": device.state, "reconnects": device.reconnects,
+                                         "attempts": device.attempts, "failures": device.failures,
+                                         "downtime": round(downtime, 1)}
+        return stats
+
+    # === Helpers and private functions
+
+    def _key(self, interface):
+        # Caller must hold self._lock
+        if interface is None:
+            return None
+        for key, device in self._devices.items():
+            if device.interface is interface:
+                return key
+        return None
+
+    def _start_reconnect(self, key, device, immediate=False):
+        # Caller must hold self._lock
+        device.down_since = self.clock()
+        device.thread = threading.Thread(target=self._reconnect, args=(key, device, immediate),
+                                         name=f"reconnect-{device.address}", daemon=True)
+        device.thread.start()
+
+    def _delay(self, failures) -> float:
+        # How long to wait before the next attempt, after this many failures in a row
+        if failures >= self.failure_threshold:
+            return self.cooldown
+        delay = min(self.max_delay, self.base_delay * (2 ** failures))
+        return delay * (1.0 - self.jitter * self.random())
+
+    def _set_state(self, device, state):
+        if device.state == state:
+            return
+        device.state = state
+        if self.on_state_change:
+            try:
+                self.on_state_change(device.interface_type, device.address, state)
+            except Exception as e:
+                log.error(f"Error reporting reconnect state for {device.address}: {e}")
+
+    def _current(self, key, device) -> bool:
+        # Still supervising this device (it hasn't been unwatched or replaced)
+        with self._lock:
+            return self._devices.get(key) is device and not self._stopping.is_set()
+
+    def _reconnect(self, key, device, immediate=False):
+        old_interface = device.interface
+        if old_interface is not None:
+            self._close_quietly(old_interface)
+        self._set_state(device, STATE_RECONNECTING)
+        try:
+            while self._current(key, device):
+                delay = 0.0 if immediate else self._delay(device.failures)
+                immediate = False
+                log.debug(f"Reconnecting to {device.address} in {delay:.1f}s")
+                if self.wait(delay) or not self._current(key, device):
+                    return
+
+                device.attempts += 1
+                try:
+                    interface = self.connect(device.interface_type, device.address)
+                except Exception as e:
+                    interface = None
+                    log.info(f"Reconnect to {device.address} failed: {e}")
+                if interface:
+                    break
+
+                device.failures += 1
+                if device.failures == self.failure_threshold:
+                    log.warning(f"Reconnect to {device.address} failed {device.failures} times in a row, "
+                                f"trying every {self.cooldown:.0f}s from now on")
+                if device.failures >= self.failure_threshold:
+                    self._set_state(device, STATE_OPEN)
+            else:
+                return
+
+            with self._lock:
+                # Check and claim under the lock, so stop() or unwatch() can't come in between
+                current = self._devices.get(key) is device and not self._stopping.is_set()
+                if current:
+                    device.interface = interface
+                    if old_interface is not None:
+                        device.reconnects += 1
+                    outage = self.clock() - device.down_since
+                    device.downtime += outage
+                    device.down_since = None
+                    device.failures = 0
+            if not current:
+                self._close_quietly(interface)  # Unwatched or stopped while we were connecting
+                return
+            if old_interface is None:
+                log.info(f"Connected to {device.address} after {outage:.1f}s")
+            else:
+                log.info(f"Reconnected to {device.address} after {outage:.1f}s (reconnect {device.reconnects}, "
+                         f"{device.downtime:.1f}s down in total)")
+            self._set_state(device, STATE_CONNECTED)
+            if self.on_reconnected:
+                try:
+                    self.on_reconnected(device.interface_type, device.address, old_interface, interface)
+                except Exception as e:
+                    log.error(f"Error reporting reconnect of {device.address}: {e}")
+        finally:
+            with self._lock:
+                device.thread = None
+
+    def _close_quietly(self, interface):
+        # Clean up an interface that has stopped working. close() can hang (BLE), so don't wait on it for long.
+        def close():
+            try:
+                interface.close()
+            except Exception as e:
+                log.debug(f"Error closing lost interface: {e}")
+
+        closer = threading.Thread(target=close, name="reconnect-close", daemon=True)
+        closer.start()
+        closer.join(self.close_timeout)
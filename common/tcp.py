@@ -1,5 +1,7 @@
 # Interface to a node connected via tcp
+import asyncio
 import logging
+import time
 
 import meshtastic.tcp_interface
 import meshtastic.util
@@ -14,7 +16,8 @@ def make_connection_and_return(address):
     log.info(f"Connecting to {address}")
     interface = None
     try:
-        interface = meshtastic.tcp_interface.TCPInterface(address)
+        host, port = _split_address(address)
+        interface = meshtastic.tcp_interface.TCPInterface(host, portNumber=port)
         log.info(f"TCP interface to {interface.getShortName()} initialized")
     except Exception as e:
         log.info(f"ERROR: Could not connect via TCP: {e}")
@@ -23,14 +26,66 @@ def make_connection_and_return(address):
 
 def scan_all_devices() -> list:
     # Return a list of tuples: ("tcp", device address, device name (address again)) or empty list
+    # Unless TCP_PROBE is false, only devices that accept a connection within TCP_PROBE_TIMEOUT seconds are listed
     if "TCP_DEVICES" not in shared.config:
         log.warning("No TCP_DEVICES key found in configuration file")
         return []
 
     log.info("Scanning for TCP devices")
-    dev_list = []
-    for dev in shared.config["TCP_DEVICES"].split(","):
-        # TODO: basic IP address / hostname sanity checking
-        dev_list.append(("tcp", dev, dev))  # Return the device address or DNS hostname for both address and shortname
+    # TODO: basic IP address / hostname sanity checking
+    addresses = [dev.strip() for dev in shared.config["TCP_DEVICES"].split(",") if dev.strip()]
+    if shared.config.get("TCP_PROBE", "true").lower() != "false":
+        results = probe_devices(addresses, float(shared.config.get("TCP_PROBE_TIMEOUT", 2.0)))
+        addresses = [address for address, reachable, latency, error in results if reachable]
+    # Return the device address or DNS hostname for both address and shortname
+    dev_list = [("tcp", dev, dev) for dev in addresses]
     log.info(f"Found {len(dev_list)} TCP device(s)")
     return dev_list
+
+def probe_devices(addresses, timeout=2.0) -> list:
+    # Try connecting to every address ("host" or "host:port", port defaulting to the Meshtastic API port) at once.
+    # Returns a list of tuples in the same order: (address, reachable, connect time in seconds or None, error or
+    # None). Name lookups run in parallel too, so the whole probe takes about one timeout however many there are.
+    if not addresses:
+        return []
+    start = time.monotonic()
+    results = asyncio.run(_probe_all(addresses, timeout))
+    reachable = sum(1 for result in results if result[1])
+    log.info(f"Probed {len(addresses)} TCP device(s) in {time.monotonic() - start:.2f}s, {reachable} reachable")
+    return results
+
+# === Helpers and private functions
+
+async def _probe_all(addresses, timeout):
+    return await asyncio.gather(*(_probe(address, timeout) for address in addresses))
+
+async def _probe(address, timeout):
+    host, port = _split_address(address)
+    start = time.monotonic()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except asyncio.TimeoutError:
+        log.info(f"TCP device {address} did not answer in {timeout:.1f}s")
+        return address, False, None, f"no answer in {timeout:.1f}s"
+    except OSError as e:  # Includes name lookup failures
+        log.info(f"TCP device {address} is not reachable: {e}")
+        return address, False, None, str(e)
+    latency = time.monotonic() - start
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    log.debug(f"TCP device {address} answered in {latency * 1000:.0f}ms")
+    return address, True, latency, None
+
+def _split_address(address) -> tuple:
+    # "host", "host:port" or "[IPv6 address]:port" to (host, port)
+    if address.startswith("["):
+        host, _, rest = address[1:].partition("]")
+        port = rest[1:] if rest.startswith(":") else ""
+    elif address.count(":") == 1:
+        host, port = address.split(":")
+    else:
+        host, port = address, ""  # Plain host name, IPv4 or bare IPv6 address
+    return host, int(port) if port else meshtastic.tcp_interface.DEFAULT_TCP_PORT
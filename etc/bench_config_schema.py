@@ -0,0 +1,75 @@
+# Benchmark: device configuration grid loads, descriptor walk vs. compiled schema
+# The descriptor walk is what the Device Configuration panel used to do on every reload: look up every category
+# and setting by name in the protobuf descriptors and rebuild the label and value lists of every enum setting.
+# The schema is compiled once per message type; after that a reload only reads the values. Making the wx
+# properties isn't timed, it costs the same either way.
+# Run from the repository root: python -m etc.bench_config_schema [reload count]
+
+import sys
+import time
+
+from meshtastic.protobuf import localonly_pb2
+
+from gui.config_schema import config_schema
+
+
+def descriptor_walk(config):
+    settings = []
+    for cat in config.DESCRIPTOR.fields_by_name.keys():
+        if cat == "version":
+            continue
+        category_settings = getattr(config, cat)
+        for key in category_settings.DESCRIPTOR.fields_by_name:
+            if key == "version":
+                continue
+            value = getattr(category_settings, key)
+            choices = None
+            if isinstance(value, int) and not isinstance(value, bool):
+                enum_type = category_settings.DESCRIPTOR.fields_by_name[key].enum_type
+                if enum_type:
+                    choices = ([name for name in enum_type.values_by_name],
+                               [enum_type.values_by_name[name].number for name in enum_type.values_by_name])
+            settings.append((f"{cat}_{key}", value, choices))
+    return settings
+
+
+def schema_walk(config):
+    settings = []
+    for category in config_schema(config):
+        category_settings = getattr(config, category.name)
+        for setting in category.settings:
+            settings.append((setting.property_name, getattr(category_settings, setting.name), setting.labels))
+    return settings
+
+
+def main():
+    reload_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    configs = [localonly_pb2.LocalConfig(), localonly_pb2.LocalModuleConfig()]
+
+    start = time.perf_counter()
+    for config in configs:
+        config_schema(config)
+    compile_time = time.perf_counter() - start
+    setting_count = sum(len(schema_walk(config)) for config in configs)
+    print(f"{setting_count} settings, {reload_count:,} reloads of both grids "
+          f"(schemas compiled once in {compile_time * 1e3:.2f} ms)")
+
+    start = time.perf_counter()
+    for i in range(reload_count):
+        for config in configs:
+            descriptor_walk(config)
+    walk_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(reload_count):
+        for config in configs:
+            schema_walk(config)
+    schema_time = time.perf_counter() - start
+
+    print(f"  descriptor walk: {walk_time * 1e6 / reload_count:10.1f} us/reload")
+    print(f"  compiled schema: {schema_time * 1e6 / reload_count:10.1f} us/reload")
+    print(f"  speedup: {walk_time / schema_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
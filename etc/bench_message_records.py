@@ -0,0 +1,56 @@
+# Memory benchmark: per-message dicts vs. compact message records
+# Builds the same set of channel messages both ways and reports what each costs.
+# Run from the repository root: python -m etc.bench_message_records [message count]
+
+import sys
+import time
+import tracemalloc
+
+from common.message_buffers import ChannelMessage
+
+SENDERS = [f"N{n:03d}" for n in range(200)]  # A busy mesh's worth of distinct senders
+
+
+def make_rows(count):
+    # Rows as they come out of the channel message log: every field a fresh string
+    for i in range(count):
+        day = 1 + (i // 86400) % 28
+        seconds = i % 86400
+        yield (f"2025-01-{day:02d} {seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}",
+               "".join(SENDERS[i % len(SENDERS)]),  # join() makes a new string, like the csv module does
+               f"Message number {i}")
+
+
+def build_dicts(count):
+    return [{"timestamp": timestamp, "sender": sender, "message": message}
+            for timestamp, sender, message in make_rows(count)]
+
+
+def build_records(count):
+    return [ChannelMessage(timestamp, sender, message) for timestamp, sender, message in make_rows(count)]
+
+
+def measure(builder, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    messages = builder(count)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del messages
+    return current, elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f"{count:,} channel messages")
+    results = {}
+    for name, builder in [("dicts", build_dicts), ("records", build_records)]:
+        size, elapsed = measure(builder, count)
+        results[name] = size
+        print(f"{name:>8}: {size / 2**20:8.1f} MiB ({size / count:6.1f} bytes/message), built in {elapsed:.2f}s")
+    print(f"records use {results['records'] / results['dicts']:.0%} of the memory of dicts")
+
+
+if __name__ == "__main__":
+    main()
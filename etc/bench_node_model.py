@@ -0,0 +1,82 @@
+# Benchmark: node list updates, full rebuild vs. keyed node model
+# The full rebuild is what the Nodes panel used to do on every node update: make a row for every node in the
+# device's node database and hand the whole list to the control, which copies and (if sorted) sorts it.
+# The keyed model updates only the affected row. The wx control itself isn't timed, but it scales the same way:
+# SetObjects redraws the whole list, RefreshObject redraws one row.
+# Run from the repository root: python -m etc.bench_node_model [node count] [update count]
+
+import random
+import sys
+import time
+
+from gui.node_model import NodeListModel, NODE_ADDED, NODE_CHANGED
+
+
+def make_node(num, version=0):
+    return {"num": num,
+            "user": {"id": f"!{num:08x}", "shortName": f"N{num % 10000:04d}", "longName": f"Node {num} v{version}"},
+            "deviceMetrics": {"batteryLevel": random.randint(0, 100), "voltage": 4.1},
+            "lastHeard": 1700000000 + num}
+
+
+def full_rebuild(nodes):
+    node_data = []
+    for nodeid, data in nodes.items():
+        node_data.append({
+            "nodeid": nodeid,
+            "name": data.get("user", {}).get("shortName", "????"),
+            "longname": data.get("user", {}).get("longName", "Unknown"),
+        })
+    shown = node_data[:]  # SetObjects copies the list
+    shown.sort(key=lambda row: row["name"].lower())  # ... and sorts it, if the list is sorted by a column
+    return shown
+
+
+def make_updates(node_count, update_count):
+    # Mostly telemetry (nothing shown changes), some renames, a few new nodes
+    updates = []
+    next_num = node_count
+    for i in range(update_count):
+        roll = random.random()
+        if roll < 0.02:
+            num, version = next_num, 0
+            next_num += 1
+        else:
+            num, version = random.randrange(node_count), 1 if roll < 0.12 else 0
+        updates.append((f"!{num:08x}", make_node(num, version)))
+    return updates
+
+
+def main():
+    node_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    update_count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    random.seed(1)
+    nodes = {f"!{num:08x}": make_node(num) for num in range(node_count)}
+    updates = make_updates(node_count, update_count)
+    print(f"{node_count:,} nodes, {update_count:,} node updates")
+
+    rebuild_nodes = dict(nodes)
+    start = time.perf_counter()
+    for nodeid, node in updates:
+        rebuild_nodes[nodeid] = node
+        full_rebuild(rebuild_nodes)
+    rebuild_time = time.perf_counter() - start
+
+    model = NodeListModel()
+    model.load(nodes)
+    counts = {}
+    start = time.perf_counter()
+    for nodeid, node in updates:
+        change, row = model.update(nodeid, node)
+        counts[change] = counts.get(change, 0) + 1
+    model_time = time.perf_counter() - start
+
+    print(f"  full rebuild: {rebuild_time * 1e6 / update_count:10.1f} us/update")
+    print(f"   keyed model: {model_time * 1e6 / update_count:10.1f} us/update "
+          f"({counts.get(NODE_ADDED, 0)} rows added, {counts.get(NODE_CHANGED, 0)} rows redrawn, "
+          f"the rest untouched)")
+    print(f"  speedup: {rebuild_time / model_time:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Micro-benchmark: text packets parsed per second
+# Compares the inline parsing msg_forward and the GUI used to do (asking the interface for its own node info on
+# every packet, probing interface.nodes and then interface.nodesByNum for the sender) with common.packet_parser,
+# both with the interface's node database and with a NodeIndex as the GUI uses.
+# Run from the repository root: python -m etc.bench_packet_parser [packet count]
+
+import logging
+import random
+import sys
+import time
+
+from common.node_index import NodeIndex
+from common.packet_parser import PacketParser
+
+log = logging.getLogger(__name__)
+
+NODE_COUNT = 500
+
+
+class FakeRaw:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeInterface:
+    # Just enough of meshtastic.mesh_interface.MeshInterface, with its identity lookups done the same way
+    def __init__(self, node_count):
+        self.nodes = {}
+        self.nodesByNum = {}
+        for num in range(1, node_count + 1):
+            node = {"num": num, "user": {"id": f"!{num:08x}", "shortName": f"N{num:03d}", "longName": f"Node {num}"}}
+            self.nodes[node["user"]["id"]] = node
+            self.nodesByNum[num] = node
+        self.my_node_num = 1
+
+    def getMyNodeInfo(self):
+        # Like the real one, this formats the whole node database for a debug message on every call
+        # (the f-string is built whether or not debug logging is on)
+        log.debug(f"self.nodesByNum:{self.nodesByNum}")
+        return self.nodesByNum.get(self.my_node_num)
+
+    def getMyUser(self):
+        node_info = self.getMyNodeInfo()
+        if node_info is not None:
+            return node_info.get("user")
+        return None
+
+    def getShortName(self):
+        user = self.getMyUser()
+        if user is not None:
+            return user.get("shortName", None)
+        return None
+
+
+def make_packets(count):
+    packets = []
+    for i in range(count):
+        num = random.randint(2, NODE_COUNT)
+        packet = {"from": num, "fromId": f"!{num:08x}" if i % 10 else None,  # Some packets lack fromId
+                  "toId": "!00000001" if i % 4 == 0 else "^all", "rxTime": 1700000000 + i,
+                  "raw": FakeRaw(i % 3), "decoded": {"text": f"Message {i}"}}
+        packets.append(packet)
+    return packets
+
+
+def parse_inline(packet, interface):
+    # What both onIncomingMessage handlers did before the shared parser
+    my_node_id = interface.getMyNodeInfo().get("user", {}).get("id", "unknown")
+    my_shortname = interface.getShortName()
+    if "raw" in packet and hasattr(packet["raw"], "channel"):
+        channel = packet["raw"].channel
+    else:
+        channel = "Unknown"
+    text_message = packet.get("decoded", {}).get("text", "Unknown text")
+    from_id = packet.get("fromId", None)
+    from_num = packet.get("from", None)
+    from_shortname = None
+    if from_id in interface.nodes:
+        from_shortname = interface.nodes[from_id].get("user", {}).get("shortName", None)
+    if not from_shortname:
+        if from_num in interface.nodesByNum:
+            from_shortname = interface.nodesByNum[from_num].get("user", {}).get("shortName", None)
+    to_id = packet.get("toId", "Unknown ToId")
+    direct = to_id == my_node_id
+    return my_shortname, channel, from_shortname, direct, text_message
+
+
+def measure(name, parse, packets):
+    start = time.perf_counter()
+    for packet in packets:
+        parse(packet)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>24}: {len(packets) / elapsed:12,.0f} packets/s ({elapsed * 1e6 / len(packets):.2f} us/packet)")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    random.seed(1)
+    interface = FakeInterface(NODE_COUNT)
+    packets = make_packets(count)
+    parser = PacketParser()
+    node_index = NodeIndex(interface.nodes)
+    print(f"{count:,} packets, {NODE_COUNT} nodes")
+    measure("inline", lambda packet: parse_inline(packet, interface), packets[:1000])  # Slow, use fewer
+    measure("PacketParser", lambda packet: parser.parse(packet, interface), packets)
+    measure("PacketParser + NodeIndex", lambda packet: parser.parse(packet, interface, node_index), packets)
+
+
+if __name__ == "__main__":
+    main()
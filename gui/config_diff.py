@@ -0,0 +1,74 @@
+# Field level differences between device configurations
+# The Device Configuration panel keeps a snapshot of localConfig and moduleConfig as loaded from the device.
+# Comparing the edited configuration with it tells us exactly which settings changed, so only the categories
+# that really differ get written, and whether any of the changes make the device reboot.
+
+import logging
+
+from gui.config_schema import config_schema
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+# The settings the firmware reboots for, in the categories where it doesn't reboot for the rest.
+# Changing anything in a category not listed here (and any moduleConfig category) reboots the device.
+REBOOT_FIELDS = {
+    "device": {"button_gpio", "buzzer_gpio", "role", "disable_triple_click", "rebroadcast_mode"},
+    "lora": {"use_preset", "region", "modem_preset", "bandwidth", "spread_factor", "coding_rate", "tx_power",
+             "frequency_offset", "override_frequency", "channel_num", "sx126x_rx_boosted_gain"},
+}
+
+
+class FieldChange:
+    __slots__ = ("category", "name", "old", "new")
+
+    def __init__(self, category, name, old, new):
+        self.category = category
+        self.name = name
+        self.old = old
+        self.new = new
+
+    @property
+    def requires_reboot(self) -> bool:
+        reboot_fields = REBOOT_FIELDS.get(self.category)
+        return reboot_fields is None or self.name in reboot_fields
+
+    def __str__(self):
+        return f"{self.category}.{self.name}: {self.old} -> {self.new}"
+
+
+def take_snapshot(config):
+    # A copy of a configuration protobuf that later edits won't touch
+    snapshot = type(config)()
+    snapshot.CopyFrom(config)
+    return snapshot
+
+
+def diff_config(snapshot, config) -> list:
+    # The settings that differ between a snapshot and a configuration, as a list of FieldChange
+    changes = []
+    for category in config_schema(config):
+        old_settings = getattr(snapshot, category.name)
+        new_settings = getattr(config, category.name)
+        for setting in category.settings:
+            old = getattr(old_settings, setting.name)
+            new = getattr(new_settings, setting.name)
+            if old != new:
+                changes.append(FieldChange(category.name, setting.name, old, new))
+    log.debug(f"Found {len(changes)} changed settings")
+    return changes
+
+
+def changed_categories(changes) -> list:
+    # The categories the changes are in, in order, once each
+    return list(dict.fromkeys(change.category for change in changes))
+
+
+def requires_reboot(changes) -> bool:
+    return any(change.requires_reboot for change in changes)
+
+
+def update_snapshot(snapshot, config, categories):
+    # The device now has these categories as they are in config
+    for category in categories:
+        getattr(snapshot, category).CopyFrom(getattr(config, category))
@@ -0,0 +1,114 @@
+# Property grid schemas for device configuration protobufs
+# localConfig and moduleConfig are protocol buffers: config.category.setting (e.g. localConfig.bluetooth.fixed_pin).
+# Working out what kind of property each setting needs means walking the protobuf descriptors, and enum settings
+# need their label and value lists. That only depends on the message type, not the device, so it's done once per
+# message type and cached here; the device configuration panel builds its grids from the result.
+"""
+A bit about the descriptor and the enum types contained therein:
+A "field" in this context is the setting name (e.g. 'baud')
+
+fields_by_name[field_name].enum_type is None if the field is not an enum type
+enum_types_by_name keys are the names of the fields that are enum types (not used in this code but could be handy)
+
+config.DESCRIPTOR.fields_by_name[field_name].enum_type:
+   .values_by_name: keys are the text values for just this field
+   .values_by_name['text'].number is the int value of the text e.g. .values_by_name["BAUD_DEFAULT"].number = 0
+   .values_by_number[int].name looks up the name of the int val e.g. values_by_number[0] = "BAUD_DEFAULT"
+"""
+
+import logging
+import threading
+
+from google.protobuf.descriptor import FieldDescriptor
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+# Setting kinds, which decide the property type
+KIND_BOOL = "bool"
+KIND_ENUM = "enum"
+KIND_INT = "int"
+KIND_STRING = "string"
+KIND_OTHER = "other"  # Floats, bytes, lists, nested messages: shown as a string for now
+
+_int_types = {FieldDescriptor.CPPTYPE_INT32, FieldDescriptor.CPPTYPE_INT64, FieldDescriptor.CPPTYPE_UINT32,
+              FieldDescriptor.CPPTYPE_UINT64}
+_skipped_fields = {"version"}  # Not settings, at either level (gotta love the exception)
+
+
+class SettingSchema:
+    # property_name is unique across the whole config. There are duplicate setting names across categories, but
+    # property names must be unique, so it's made from both (e.g. security_is_managed). The label (the visible
+    # text) is the setting name.
+    __slots__ = ("name", "property_name", "kind", "labels", "values", "choices")
+
+    def __init__(self, name, property_name, kind, labels=(), values=()):
+        self.name = name
+        self.property_name = property_name
+        self.kind = kind
+        self.labels = labels  # Enum settings: value names, in descriptor order
+        self.values = values  # and their numbers
+        self.choices = None  # Enum settings: the panel's wxpg.PGChoices for labels and values, made when first needed
+
+
+class CategorySchema:
+    __slots__ = ("name", "settings")
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings  # tuple of SettingSchema
+
+
+_schemas = {}  # key = protobuf message full name, value = tuple of CategorySchema
+_lock = threading.Lock()
+
+
+def config_schema(config) -> tuple:
+    # The categories and settings of a configuration protobuf (e.g. localConfig), compiled on first use
+    descriptor = config.DESCRIPTOR
+    schema = _schemas.get(descriptor.full_name)
+    if schema is None:
+        with _lock:
+            schema = _schemas.get(descriptor.full_name)
+            if schema is None:
+                schema = _schemas[descriptor.full_name] = _compile(descriptor)
+    return schema
+
+
+# === Helpers and private functions
+
+def _compile(descriptor) -> tuple:
+    categories = []
+    for category_field in descriptor.fields:
+        if category_field.name in _skipped_fields or category_field.message_type is None:
+            continue
+        settings = tuple(_compile_setting(category_field.name, field) for field in category_field.message_type.fields
+                         if field.name not in _skipped_fields)
+        categories.append(CategorySchema(category_field.name, settings))
+    log.debug(f"Compiled schema for {descriptor.full_name}: {len(categories)} categories, "
+              f"{sum(len(category.settings) for category in categories)} settings")
+    return tuple(categories)
+
+
+def _compile_setting(category, field) -> SettingSchema:
+    property_name = f"{category}_{field.name}"
+    if _is_repeated(field):
+        return SettingSchema(field.name, property_name, KIND_OTHER)
+    if field.cpp_type == FieldDescriptor.CPPTYPE_BOOL:
+        return SettingSchema(field.name, property_name, KIND_BOOL)
+    if field.cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+        enum_values = field.enum_type.values
+        return SettingSchema(field.name, property_name, KIND_ENUM, tuple(value.name for value in enum_values),
+                             tuple(value.number for value in enum_values))
+    if field.cpp_type in _int_types:
+        return SettingSchema(field.name, property_name, KIND_INT)
+    if field.cpp_type == FieldDescriptor.CPPTYPE_STRING and field.type != FieldDescriptor.TYPE_BYTES:
+        return SettingSchema(field.name, property_name, KIND_STRING)
+    return SettingSchema(field.name, property_name, KIND_OTHER)
+
+
+def _is_repeated(field) -> bool:
+    is_repeated = getattr(field, "is_repeated", None)  # Newer protobuf releases; label is deprecated there
+    if is_repeated is not None:
+        return bool(is_repeated)
+    return field.label == FieldDescriptor.LABEL_REPEATED
@@ -0,0 +1,67 @@
+# Background workers for slow device operations
+# Connecting to a device downloads its whole node database and configuration, which can take many seconds, and
+# closing a BLE device can hang outright. DeviceWorkers runs these jobs off the GUI thread, one worker thread
+# per device: jobs for the same device run in order, and different devices don't wait for each other.
+
+import logging
+import queue
+import threading
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+
+class DeviceWorkers:
+    # A device's worker thread exits after idle_seconds with nothing to do, and is started again by the next job.
+    def __init__(self, idle_seconds=30.0):
+        self.idle_seconds = idle_seconds
+        self._workers = {}  # key = device key (address), value = job queue
+        self._lock = threading.Lock()
+
+    def submit(self, key, function, *args):
+        # Run function(*args) on the worker for this device
+        with self._lock:
+            jobs = self._workers.get(key)
+            if jobs is None:
+                jobs = self._workers[key] = queue.Queue()
+                threading.Thread(target=self._work, args=(key, jobs), name=f"device-{key}", daemon=True).start()
+            jobs.put((function, args))
+
+    # === Helpers and private functions
+
+    def _work(self, key, jobs):
+        while True:
+            try:
+                function, args = jobs.get(timeout=self.idle_seconds)
+            except queue.Empty:
+                with self._lock:
+                    if jobs.empty():  # Nothing was submitted while we were timing out
+                        del self._workers[key]
+                        return
+                continue
+            try:
+                function(*args)
+            except Exception as e:
+                log.error(f"Error in device job for {key}: {e}")
+
+
+def close_with_timeout(interface, timeout) -> bool:
+    # Close an interface, giving up after timeout seconds. Returns False if close() didn't finish, in which case
+    # it's left to finish (or not) on its own thread; that thread won't keep the application from exiting.
+    # Exceptions from close() are raised to the caller.
+    error = []
+
+    def close():
+        try:
+            interface.close()
+        except Exception as e:
+            error.append(e)
+
+    closer = threading.Thread(target=close, name="device-close", daemon=True)
+    closer.start()
+    closer.join(timeout)
+    if closer.is_alive():
+        return False
+    if error:
+        raise error[0]
+    return True
@@ -4,6 +4,7 @@ import wx.lib.newevent
 
 set_status_bar, EVT_SET_STATUS_BAR = wx.lib.newevent.NewEvent()
 refresh_panel, EVT_REFRESH_PANEL = wx.lib.newevent.NewEvent()
+refresh_messages, EVT_REFRESH_MESSAGES = wx.lib.newevent.NewEvent()
 update_connection_status, EVT_UPDATE_CONNECTION_STATUS = wx.lib.newevent.NewEvent()
 process_received_message, EVT_PROCESS_RECEIVED_MESSAGE = wx.lib.newevent.NewEvent()
 add_device, EVT_ADD_DEVICE = wx.lib.newevent.NewEvent()
@@ -13,4 +14,11 @@ node_updated, EVT_NODE_UPDATED = wx.lib.newevent.NewEvent()
 child_closed, EVT_CHILD_CLOSED = wx.lib.newevent.NewEvent()
 refresh_specific_panel, EVT_REFRESH_SPECIFIC_PANEL = wx.lib.newevent.NewEvent()
 fake_device_disconnect, EVT_FAKE_DEVICE_DISCONNECT = wx.lib.newevent.NewEvent()
-disconnect_device, EVT_DISCONNECT_DEVICE = wx.lib.newevent.NewEvent()
\ No newline at end of file
+disconnect_device, EVT_DISCONNECT_DEVICE = wx.lib.newevent.NewEvent()
+ingest_batch, EVT_INGEST_BATCH = wx.lib.newevent.NewEvent()
+devices_discovered, EVT_DEVICES_DISCOVERED = wx.lib.newevent.NewEvent()
+discovery_finished, EVT_DISCOVERY_FINISHED = wx.lib.newevent.NewEvent()
+device_progress, EVT_DEVICE_PROGRESS = wx.lib.newevent.NewEvent()
+device_job_done, EVT_DEVICE_JOB_DONE = wx.lib.newevent.NewEvent()
+fleet_progress, EVT_FLEET_PROGRESS = wx.lib.newevent.NewEvent()
+fleet_done, EVT_FLEET_DONE = wx.lib.newevent.NewEvent()
@@ -1,6 +1,8 @@
 # Meshtastic client GUI
 import logging
 import csv
+import os
+import sys
 from datetime import datetime
 
 import dotenv
@@ -8,6 +10,13 @@ import wx
 from pubsub import pub
 
 from gui import shared
+from common.ingest import IngestPipeline, queue_policies
+from common.log_writer import LogWriter
+from common.packet_parser import PacketParser, MessageType
+from common.message_store import MessageStore
+from common.log_reader import read_rows_backward
+from common.message_buffers import ChannelMessage, DirectMessage
+from gui.refresh_scheduler import RefreshScheduler
 from panels.app_config import AppConfigPanel
 from panels.device_config import DevConfigPanel
 from panels.devices import DevicesPanel
@@ -15,8 +24,8 @@ from panels.nodes import NodesPanel
 from panels.channel_messages import ChannelMessagesPanel
 from panels.direct_messages import DirectMessagesPanel
 from gui.gui_events import EVT_SET_STATUS_BAR, process_received_message, EVT_ANNOUNCE_NEW_DEVICE, add_device, node_updated, \
-    refresh_panel, EVT_REFRESH_SPECIFIC_PANEL, EVT_FAKE_DEVICE_DISCONNECT, remove_device, fake_device_disconnect, \
-    EVT_DISCONNECT_DEVICE, disconnect_device, EVT_REMOVE_DEVICE
+    EVT_REFRESH_SPECIFIC_PANEL, EVT_FAKE_DEVICE_DISCONNECT, remove_device, fake_device_disconnect, \
+    EVT_DISCONNECT_DEVICE, disconnect_device, EVT_REMOVE_DEVICE, EVT_INGEST_BATCH, ingest_batch
 
 
 class MainFrame(wx.Frame):
@@ -25,6 +34,7 @@ class MainFrame(wx.Frame):
         wx.Frame.__init__(self, parent, wx.ID_ANY, "AB8OJ Meshtastic Client", size=(800, 600))  # TODO: size tweaking
         self.CreateStatusBar()
         self.Bind(EVT_SET_STATUS_BAR, self.setStatusBar)
+        shared.refresh_scheduler = RefreshScheduler(self, float(shared.config.get("REFRESH_RATE_HZ", 10)))
 
         # === Menus
         # Note that some IDs don't display in these menus if the host platform provides it in another menu (e.g. Mac)
@@ -75,6 +85,17 @@ class MainFrame(wx.Frame):
 
         self.Show(True)
 
+        # Pub/sub handlers just queue packets and node updates, a worker parses them and posts them here in batches
+        ingest_policy = shared.config.get("INGEST_POLICY", "coalesce")
+        if ingest_policy not in queue_policies:
+            log.error(f"INGEST_POLICY must be one of {str(queue_policies)}, using coalesce")
+            ingest_policy = "coalesce"
+        self.packet_parser = PacketParser()
+        self.ingest = IngestPipeline(self._parse_ingested, self._deliver_ingested,
+                                     max_queue=int(shared.config.get("INGEST_QUEUE_SIZE", 1000)), policy=ingest_policy)
+        self.Bind(EVT_INGEST_BATCH, self.onIngestBatch)
+        self.Bind(wx.EVT_CLOSE, self.onClose)
+
         pub.subscribe(self.onIncomingMessage, "meshtastic.receive.text")
         pub.subscribe(self.onNodeUpdated, "meshtastic.node.updated")
 
@@ -101,6 +122,13 @@ class MainFrame(wx.Frame):
         # TODO: Exit confirmation if configured to do so
         self.Close(True)
 
+    def onClose(self, event):
+        log.debug("Main frame close event")
+        pub.unsubscribe(self.onIncomingMessage, "meshtastic.receive.text")
+        pub.unsubscribe(self.onNodeUpdated, "meshtastic.node.updated")
+        self.ingest.close()
+        event.Skip()
+
     # === Toolbar events
 
     # noinspection PyUnusedLocal
@@ -148,6 +176,8 @@ class MainFrame(wx.Frame):
 
     def announceNewDevice(self, event):
         log.debug(f"Announce new device: {event.name}")
+        shared.forget_node_index(event.name)  # Start from the new connection's node database
+        shared.get_node_index(event.name, event.interface)
         # send events to children that need to know about new devices
         wx.PostEvent(self.panel_pointers["chm"], add_device(name=event.name, interface=event.interface))
         wx.PostEvent(self.panel_pointers["dm"], add_device(name=event.name, interface=event.interface))
@@ -156,6 +186,8 @@ class MainFrame(wx.Frame):
 
     def fake_device_disconnect(self, event):
         log.debug(f"Fake device disconnect: {event.name}")
+        shared.message_log_writer.flush()
+        shared.forget_node_index(event.name)
         # If a device disconnection isn't likely to go through the pub/sub topic, fake it here
         wx.PostEvent(self.panel_pointers["devices"], fake_device_disconnect(name=event.name, interface=event.interface))
         wx.PostEvent(self.panel_pointers["chm"], remove_device(name=event.name, interface=event.interface))
@@ -165,6 +197,8 @@ class MainFrame(wx.Frame):
 
     def real_device_disconnect(self, event):
         log.debug(f"Real device disconnect: {event.name}")
+        shared.message_log_writer.flush()
+        shared.forget_node_index(event.name)
         # Send events to children that need to know when a device disconnects
         wx.PostEvent(self.panel_pointers["chm"], remove_device(name=event.name, interface=event.interface))
         wx.PostEvent(self.panel_pointers["dm"], remove_device(name=event.name, interface=event.interface))
@@ -181,142 +215,209 @@ class MainFrame(wx.Frame):
         # A child panel is asking another child panel to refresh
         panel_name = event.panel_name
         if panel_name in self.panel_pointers:
-            wx.PostEvent(self.panel_pointers[panel_name], refresh_panel())
+            shared.refresh_scheduler.mark_dirty(self.panel_pointers[panel_name])
         else:
             log.error(f"Invalid panel name received from EVT_REFRESH_SPECIFIC_PANEL: {panel_name}")
 
     # === Meshtastic pub/sub topic handlers
     """
     IMPORTANT NOTE: See README.md for important details about handling Meshtastic pub/sub messages.
+    These run on the device's reader thread, so they only queue what they get for the ingest worker.
     """
 
     def onIncomingMessage(self, packet, interface):
-        # TODO: Implement wantAck (see https://deepwiki.com/meshtastic/Meshtastic-Apple/2.2-mesh-packets)
         log.debug("Incoming message")
-        my_shortname = interface.getShortName()
-        my_node_id = interface.getMyNodeInfo().get("user", {}).get("id", "unknown")
+        self.ingest.submit(("text", packet, interface))
 
-        if "raw" in packet and hasattr(packet["raw"], "channel"):
-            channel = str(packet["raw"].channel)
-        else:
-            channel = "Unknown"
-            log.debug("Unknown channel")
-
-        text_message = packet.get("decoded", {}).get("text", "Unknown text")
-
-        from_id = packet.get("fromId", None)
-        from_num = packet.get("from", None)
-        from_shortname = None
-        # Start by looking up the sender's shortname in interface.nodes
-        if from_id in interface.nodes:
-            from_shortname = interface.nodes[from_id].get("user", {}).get("shortName", None)
-            log.debug("fromId found in interface.nodes")
-        # If we didn't get shortname from interface.nodes, try interface.nodesByNum
-        if not from_shortname:
-            if from_num in interface.nodesByNum:
-                from_shortname = interface.nodesByNum[from_num].get("user", {}).get("shortName", None)
-                log.debug("from node found in interface.nodesByNum")
-        # Didn't get it either place
+    def onNodeUpdated(self, node, interface):
+        # Updates to the same node can be merged while they wait (see INGEST_POLICY)
+        nodenum = node.get("num", None)
+        self.ingest.submit(("node", node, interface), key=(id(interface), nodenum) if nodenum is not None else None)
+
+    # === Ingest pipeline
+
+    def _parse_ingested(self, item):
+        # Runs on the ingest worker thread. Returns a list of (panel name, event) to deliver, or None.
+        kind, data, interface = item
+        if kind == "text":
+            return self._parse_incoming_message(data, interface)
+        return self._parse_node_update(data, interface)
+
+    def _deliver_ingested(self, batch):
+        # Runs on the ingest worker thread
+        wx.PostEvent(self, ingest_batch(items=batch))
+
+    def onIngestBatch(self, event):
+        log.debug(f"Ingest batch of {len(event.items)}")
+        try:
+            for deliveries in event.items:
+                for panel_name, panel_event in deliveries:
+                    self.panel_pointers[panel_name].GetEventHandler().ProcessEvent(panel_event)
+        finally:
+            self.ingest.batch_done()
+
+    def _parse_incoming_message(self, packet, interface):
+        # TODO: Implement wantAck (see https://deepwiki.com/meshtastic/Meshtastic-Apple/2.2-mesh-packets)
+        my_shortname = self.packet_parser.identity(interface)[1]
+        message = self.packet_parser.parse(packet, interface, shared.get_node_index(my_shortname, interface))
+        channel = str(message.channel)
+
+        from_shortname = message.from_shortname
         if not from_shortname:
             from_shortname = "????"
-            log.debug("Did not find node in either interface.nodes or interface.nodesByNum")
+            log.debug("Did not find sender in the device's node index")
 
-        to_id = packet.get("toId", "Unknown ToId")
-
-        rx_timestamp = packet.get("rxTime", None)
-        if rx_timestamp:
-            rx_time = datetime.fromtimestamp(int(rx_timestamp))
+        if message.rx_time:
+            rx_time = datetime.fromtimestamp(message.rx_time)
         else:
             rx_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             log.debug("No rx timestamp found in packet")
 
-        if to_id == my_node_id:
+        if message.message_type == MessageType.DIRECT_MESSAGE:
             log.debug("Direct message")
-            wx.PostEvent(self.panel_pointers["dm"], process_received_message(device=my_shortname, channel=channel,
-                                                                  sender=from_shortname, timestamp=rx_time,
-                                                                  message=text_message))
-            wx.PostEvent(self.panel_pointers["node"], process_received_message(device=my_shortname, channel=channel,
-                                                                 sender=from_shortname, timestamp=rx_time,
-                                                                 message=text_message))
-        elif to_id == "^all":
+            return [("dm", process_received_message(device=my_shortname, channel=channel, sender=from_shortname,
+                                                    timestamp=rx_time, message=message.text)),
+                    ("node", process_received_message(device=my_shortname, channel=channel, sender=from_shortname,
+                                                      timestamp=rx_time, message=message.text))]
+        elif message.message_type == MessageType.BROADCAST_MESSAGE:
             log.debug("Broadcast message")
-            wx.PostEvent(self.panel_pointers["chm"], process_received_message(device=my_shortname, channel=channel,
-                                                                  sender=from_shortname, timestamp=rx_time,
-                                                                  message=text_message))
+            return [("chm", process_received_message(device=my_shortname, channel=channel, sender=from_shortname,
+                                                     timestamp=rx_time, message=message.text))]
         else:
-            log.error(f"to_id {to_id} is neither my noode ID nor ^all, that should not have happened")
+            log.error(f"to_id {message.to_id} is neither my noode ID nor ^all, that should not have happened")
+            return None
 
-        return
-
-    def onNodeUpdated(self, node, interface):
-        my_shortname = interface.getShortName()
+    def _parse_node_update(self, node, interface):
+        my_shortname = self.packet_parser.identity(interface)[1]
         nodeid = node.get("user", {}).get("id", None)
         nodenum = node.get("num", None)
         log.debug(f"Node update message from nodeid {nodeid} nodenum {nodenum}")
-        wx.PostEvent(self.panel_pointers["node"], node_updated(device=my_shortname, nodeid=nodeid, nodenum=nodenum,
-                                                               node=node, interface=interface))
-        return
+        # Node updates and packets go through the same queue, so the index is current for the next packet
+        shared.get_node_index(my_shortname, interface).update(node)
+        return [("node", node_updated(device=my_shortname, nodeid=nodeid, nodenum=nodenum, node=node,
+                                      interface=interface))]
 
 def _load_channel_message_log():
     log.debug("Loading channel message log")
+    filename = shared.config.get("CHANNEL_MESSAGE_LOG", "channel-messages.csv")
     try:
-        lf = open(shared.config.get("CHANNEL_MESSAGE_LOG", "channel-messages.csv"), "r")
+        lf = open(filename, "r")
     except FileNotFoundError:
         log.info("Channel message log file not found, it will be created by incoming messages")
         return
 
     with lf:
-        reader = csv.DictReader(lf, fieldnames=["device", "channel", "timestamp", "sender", "message"])
+        if shared.message_load_limit:
+            reader = _read_log_tail(filename, shared.channel_log_fields, "channel",
+                                    lambda r: ("channel", r["device"], r["channel"]))
+        else:
+            reader = csv.DictReader(lf, fieldnames=shared.channel_log_fields)
         for row in reader:
-            device = row["device"]
-            channel = row["channel"]
+            device = sys.intern(row["device"])
+            channel = sys.intern(row["channel"])
             timestamp = row["timestamp"]
             sender = row["sender"]
             message = row["message"]
-            if device not in shared.channel_messages:
-                shared.channel_messages[device] = {}
-            if channel not in shared.channel_messages[device]:
-                shared.channel_messages[device][channel] = []
-            shared.channel_messages[device][channel].append({"timestamp": timestamp, "sender": sender,
-                                                         "message":message})
+            shared.add_channel_message(device, channel, ChannelMessage(timestamp, sender, message))
 
     lf.close()
 
 def _load_direct_message_log():
     log.debug("Loading direct message log")
+    filename = shared.config.get("DIRECT_MESSAGE_LOG", "direct-messages.csv")
     try:
-        lf = open(shared.config.get("DIRECT_MESSAGE_LOG", "direct-messages.csv"), "r")
+        lf = open(filename, "r")
     except FileNotFoundError:
         log.info("Direct message log file not found, it will be created by incoming messages")
         return
 
     with lf:
-        reader = csv.DictReader(lf, fieldnames=["device", "remote", "timestamp", "from", "to", "message"])
+        if shared.message_load_limit:
+            reader = _read_log_tail(filename, shared.direct_log_fields, "direct", lambda r: ("direct", r["device"]))
+        else:
+            reader = csv.DictReader(lf, fieldnames=shared.direct_log_fields)
         for row in reader:
-            device = row["device"]
-            remote = row["remote"]
+            device = sys.intern(row["device"])
+            remote = sys.intern(row["remote"])
             timestamp = row["timestamp"]
             from_shortname = row["from"]
             to_shortname = row["to"]
             message = row["message"]
-            if device not in shared.direct_messages:
-                shared.direct_messages[device] = []
-            if device not in shared.node_conversations:
-                shared.node_conversations[device] = {}
-            if remote not in shared.node_conversations[device]:
-                shared.node_conversations[device][remote] = []
-            shared.direct_messages[device].append({"timestamp": timestamp, "from": from_shortname,
-                                                         "to": to_shortname, "message":message})
-            shared.node_conversations[device][remote].append({"timestamp": timestamp, "from": from_shortname,
-                                                   "to": to_shortname, "message": message})
+            shared.add_direct_message(device, remote, DirectMessage(timestamp, from_shortname, to_shortname, message))
 
     lf.close()
 
+def _read_log_tail(filename, fieldnames, kind, view_key) -> list:
+    # Read the newest message_load_limit rows per view (view_key(row) names the view), scanning backward from
+    # the end of the log but no further than MESSAGE_LOAD_BYTES. Returns the rows oldest first, and leaves
+    # history cursors behind so each view can page in the rest of its history later.
+    log.debug(f"Reading the tail of {filename}")
+    max_bytes = int(shared.config.get("MESSAGE_LOAD_BYTES", 8 * 1024 * 1024))
+    end_offset = os.path.getsize(filename)
+    stop_offset = end_offset  # Rows before this offset have not been looked at
+    view_counts = {}
+    rows = []
+    for offset, row in read_rows_backward(filename, fieldnames):
+        if end_offset - offset > max_bytes:
+            break
+        stop_offset = offset
+        key = view_key(row)
+        count = view_counts.get(key, 0)
+        if count < shared.message_load_limit:
+            rows.append(row)
+            view_counts[key] = count + 1
+            if count + 1 == shared.message_load_limit:
+                shared.history_cursors[key] = offset  # This view is full, the rest of its history is older
+    else:
+        stop_offset = 0
+    shared.unread_log_offsets[kind] = stop_offset
+
+    log.info(f"Loaded {len(rows)} of the newest messages from {filename} for {len(view_counts)} views")
+    rows.reverse()
+    return rows
+
+def _start_message_log_writer():
+    # Message logs are written through one buffered writer. LOG_FSYNC is the durability knob:
+    # "never", "flush" (fsync once per group flush) or "always" (flush and fsync every message)
+    shared.message_log_writer = LogWriter(flush_rows=int(shared.config.get("LOG_FLUSH_ROWS", 50)),
+                                          flush_seconds=float(shared.config.get("LOG_FLUSH_SECONDS", 2.0)),
+                                          fsync=shared.config.get("LOG_FSYNC", "flush"))
+
+def _open_message_store(filename):
+    # Open the SQLite message store and bring it up to date with the CSV message logs: a brand-new store imports
+    # them whole, an existing one just the rows added since it was last opened (by msg_forward, or while
+    # MESSAGE_DB was unset). While the store is open, new messages go to both the store and the logs.
+    shared.message_store = MessageStore(filename)
+    shared.message_window = int(shared.config.get("MESSAGE_WINDOW", shared.message_window))
+
+    log.info("Importing new rows from the message logs")
+    try:
+        shared.message_store.import_channel_log(shared.config.get("CHANNEL_MESSAGE_LOG", "channel-messages.csv"),
+                                                shared.channel_log_fields)
+    except FileNotFoundError:
+        log.info("Channel message log file not found, nothing to import")
+    try:
+        shared.message_store.import_direct_log(shared.config.get("DIRECT_MESSAGE_LOG", "direct-messages.csv"),
+                                               shared.direct_log_fields)
+    except FileNotFoundError:
+        log.info("Direct message log file not found, nothing to import")
+
 def main():
-    # Load saved message logs into the message buffers
-    log.debug("Loading saved message logs")
-    _load_channel_message_log()
-    _load_direct_message_log()
+    shared.message_page_size = int(shared.config.get("MESSAGE_PAGE_SIZE", shared.message_page_size))
+    if shared.config.get("MESSAGE_DB"):
+        # Messages are queried from the store as needed, nothing to load up front
+        _open_message_store(shared.config["MESSAGE_DB"])
+    else:
+        # Load saved message logs into the message buffers, or just their newest messages if a limit is set
+        log.debug("Loading saved message logs")
+        shared.message_load_limit = int(shared.config.get("MESSAGE_LOAD_LIMIT", 0))
+        shared.max_channel_messages = int(shared.config.get("MAX_CHANNEL_MESSAGES", shared.max_channel_messages))
+        shared.max_direct_messages = int(shared.config.get("MAX_DIRECT_MESSAGES", shared.max_direct_messages))
+        shared.max_conversation_messages = int(shared.config.get("MAX_CONVERSATION_MESSAGES",
+                                                                 shared.max_conversation_messages))
+        _load_channel_message_log()
+        _load_direct_message_log()
+    _start_message_log_writer()
 
     # Fire up the app
     log.info("Starting GUI")
@@ -326,7 +427,13 @@ def main():
 
     # TODO: disconnect from any connected devices
     log.info("Exiting GUI")
+    shared.refresh_scheduler.stop()
     client_app.Destroy()
+    shared.message_log_writer.close()  # Flush anything still buffered
+    if shared.message_store:
+        shared.message_store.close()
+    else:
+        log.info(f"Message buffers at exit: {shared.message_counts()}")
     # TODO: other cleanup here
 
 # === Main program ===
@@ -0,0 +1,59 @@
+# Node list model
+# Keeps one row per node, keyed by node ID, so a node update only touches that node's row instead of the node
+# list being rebuilt from the interface's whole node database. No wx in here, the panel applies the changes.
+
+import logging
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+# What update() did to the model
+NODE_ADDED = "added"
+NODE_CHANGED = "changed"  # A column the list shows has changed
+NODE_UNCHANGED = "unchanged"  # Nothing the list shows has changed (e.g. a telemetry or position update)
+
+
+class NodeRow:
+    # One row of the node list. Attribute names are the node list's column getters.
+    __slots__ = ("nodeid", "name", "longname")
+
+    def __init__(self, nodeid, node):
+        self.nodeid = nodeid
+        self.name, self.longname = _names(node)
+
+
+class NodeListModel:
+    def __init__(self):
+        self.rows = {}  # key = node ID, value = NodeRow
+
+    def load(self, nodes) -> list:
+        # Replace the model with the nodes in a node database (interface.nodes). Returns the rows.
+        self.rows = {nodeid: NodeRow(nodeid, node) for nodeid, node in nodes.items()}
+        return list(self.rows.values())
+
+    def clear(self):
+        self.rows = {}
+
+    def update(self, nodeid, node) -> tuple:
+        # Add or update one node. Returns (NODE_ADDED/NODE_CHANGED/NODE_UNCHANGED, row).
+        row = self.rows.get(nodeid)
+        if row is None:
+            row = self.rows[nodeid] = NodeRow(nodeid, node)
+            return NODE_ADDED, row
+        names = _names(node)
+        if names == (row.name, row.longname):
+            return NODE_UNCHANGED, row
+        row.name, row.longname = names
+        return NODE_CHANGED, row
+
+    def remove(self, nodeid):
+        # Remove one node. Returns its row, or None if it wasn't in the model.
+        return self.rows.pop(nodeid, None)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def _names(node) -> tuple:
+    user = node.get("user", {})
+    return user.get("shortName", "????"), user.get("longName", "Unknown")
@@ -1,12 +1,14 @@
 import logging
-import csv
 from datetime import datetime
 
 import wx
-from ObjectListView3 import ObjectListView, ColumnDefn
+from ObjectListView3 import ColumnDefn
 
+from common.message_buffers import ChannelMessage
 from gui import shared
-from gui.gui_events import EVT_REFRESH_PANEL, EVT_PROCESS_RECEIVED_MESSAGE, EVT_ADD_DEVICE, EVT_REMOVE_DEVICE
+from gui.gui_events import EVT_REFRESH_PANEL, EVT_PROCESS_RECEIVED_MESSAGE, EVT_ADD_DEVICE, EVT_REMOVE_DEVICE, \
+    EVT_REFRESH_MESSAGES, refresh_messages
+from gui.panels.message_list import MessageList
 
 log = logging.getLogger(__name__)
 # log.setLevel(logging.DEBUG)  # Set our own level separately
@@ -38,7 +40,7 @@ class ChannelMessagesPanel(wx.Panel):
         sizer.Add(self.msg_channel_list, 1, wx.TOP | wx.BOTTOM, 5)
 
         self.messages_label = wx.StaticText(self, wx.ID_ANY, "Messages")
-        self.messages = ObjectListView(self, wx.ID_ANY, style=wx.LC_REPORT | wx.SUNKEN_BORDER)
+        self.messages = MessageList(self, wx.ID_ANY, style=wx.LC_REPORT | wx.SUNKEN_BORDER)
         self.messages.SetColumns([
             ColumnDefn("Timestamp", "left", 150, "timestamp", isEditable=False),
             ColumnDefn("Sender", "left", 50, "sender", isEditable=False),
@@ -47,6 +49,8 @@ class ChannelMessagesPanel(wx.Panel):
         self.messages.SetEmptyListMsg("No messages")
         self.Bind(wx.EVT_LIST_ITEM_SELECTED, self.onMessageSelected, self.messages)
         self.Bind(wx.EVT_LIST_ITEM_DESELECTED, self.onMessageDeselected, self.messages)
+        self.messages.Bind(wx.EVT_SCROLLWIN, self.onMessageListScroll)
+        self.messages.Bind(wx.EVT_MOUSEWHEEL, self.onMessageListScroll)
         sizer.Add(self.messages_label, 0, flag=wx.LEFT)
         sizer.Add(self.messages, 4, wx.EXPAND | wx.TOP | wx.BOTTOM, 5)
 
@@ -64,6 +68,7 @@ class ChannelMessagesPanel(wx.Panel):
         sizer.Fit(self)
 
         self.Bind(EVT_REFRESH_PANEL, self.refresh_panel_event)
+        self.Bind(EVT_REFRESH_MESSAGES, self.refresh_messages_event)
         self.Bind(EVT_PROCESS_RECEIVED_MESSAGE, self.receive_message_event)
         self.Bind(EVT_ADD_DEVICE, self.add_device_event)
         self.Bind(EVT_REMOVE_DEVICE, self.remove_device_event)
@@ -76,6 +81,7 @@ class ChannelMessagesPanel(wx.Panel):
     def onDevicePickerChoice(self, evt):
         log.debug("Device picker choice event")
         # TODO: How to handle channels with still-unread messages
+        self._release_messages_view()
         self.selected_device = self.msg_device_picker.GetString(evt.GetSelection())
 
         # If a channel is selected, deselect it so the message list for that channel gets cleared
@@ -95,20 +101,20 @@ class ChannelMessagesPanel(wx.Panel):
         log.debug("Channel selected event")
         # TODO: un-highlight the channel when selected
         # It seems like this could fire before the first device selection event
+        self._release_messages_view()
         selected_index = evt.GetIndex()
         if selected_index == -1:
             self.selected_channel = None
         else:
             self.selected_channel = str(self.msg_channel_list.GetItemText(selected_index, 1))
-        if self.selected_channel not in shared.channel_messages[self.selected_device]:
-            shared.channel_messages[self.selected_device][self.selected_channel] = []
-        self.messages.SetObjects(shared.channel_messages[self.selected_device][self.selected_channel])
+        self.messages.SetObjects(shared.get_channel_messages(self.selected_device, self.selected_channel))
         if self.messages.GetItemCount() > 0:
             self.messages.EnsureVisible(self.messages.GetItemCount() - 1)
 
     # noinspection PyUnusedLocal
     def onChannelDeselected(self, evt):
         log.debug("Channel deselected event")
+        self._release_messages_view()
         self.messages.SetObjects([])
 
     # noinspection PyUnusedLocal
@@ -122,6 +128,10 @@ class ChannelMessagesPanel(wx.Panel):
     def onMessageDeselected(self, evt):
         self.messages_label.SetLabel("Messages")
 
+    def onMessageListScroll(self, evt):
+        evt.Skip()  # Let the list scroll first, then see if it got to the top
+        wx.CallAfter(self._load_older_if_scrolled_to_top)
+
     # noinspection PyUnusedLocal
     def onSendButton(self, evt):
         log.debug("Send button event")
@@ -143,7 +153,7 @@ class ChannelMessagesPanel(wx.Panel):
             return
 
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        message_dict = {"timestamp": now, "sender": self.selected_device, "message": text_to_send}
+        message = ChannelMessage(now, self.selected_device, text_to_send)
 
         channel_index = self.msg_channel_list.GetFirstSelected()
         if channel_index == -1:
@@ -162,14 +172,13 @@ class ChannelMessagesPanel(wx.Panel):
                                  style=wx.OK | wx.ICON_ERROR).ShowModal()
             return
 
-        shared.channel_messages[self.selected_device][self.selected_channel].append(message_dict)
-        self.messages.SetObjects(shared.channel_messages[self.selected_device][self.selected_channel])
-        self.messages.EnsureVisible(self.messages.GetItemCount() - 1)
+        shared.add_channel_message(self.selected_device, self.selected_channel, message)
+        self._show_new_messages()
         self.send_text.Clear()
 
         log_dict = {"device": self.selected_device, "channel": self.selected_channel,
                     "timestamp": now, "sender": self.selected_device, "message": text_to_send}
-        self._log_message(log_dict)
+        shared.log_channel_message(log_dict)
 
     # noinspection PyUnusedLocal
     def refresh_panel_event(self, event):
@@ -185,6 +194,12 @@ class ChannelMessagesPanel(wx.Panel):
             self.msg_channel_list.DeleteAllItems()  # Make sure channel list is cleared if no selected device
         self.Layout()
 
+    # noinspection PyUnusedLocal
+    def refresh_messages_event(self, event):
+        log.debug("Refresh messages event")
+        if self.selected_device and self.selected_channel is not None:
+            self._show_new_messages()
+
     def add_device_event(self, evt):
         log.debug(f"Add device event for {evt.name}")
         device_name = evt.name
@@ -201,13 +216,6 @@ class ChannelMessagesPanel(wx.Panel):
             self.selected_device = device_name
             self.msg_device_picker.Select(0)
 
-        # Add the new device and channels to the channel message buffer if needed
-        if device_name not in shared.channel_messages:
-            shared.channel_messages[device_name] = {}
-        for chan in channel_list:
-            if chan.settings.name not in shared.channel_messages[device_name]:
-                shared.channel_messages[device_name][chan.settings.name] = []
-
         # Populate the channel list
         for chan in channel_list:
             if chan.role != 0:
@@ -221,6 +229,7 @@ class ChannelMessagesPanel(wx.Panel):
         if index != wx.NOT_FOUND:
             self.msg_device_picker.Delete(index)
         if self.selected_device == device_name:
+            self._release_messages_view()
             self.selected_device = None
             self.msg_channel_list.DeleteAllItems()
             self.selected_channel = None
@@ -239,24 +248,35 @@ class ChannelMessagesPanel(wx.Panel):
         # Translate channel index from message packet to channel name
         channel = self.msg_channel_list.GetItemText(int(channel_number), 1)
 
-        if device not in shared.channel_messages:
-            shared.channel_messages[device] = {}
-        if channel not in shared.channel_messages[device]:
-            shared.channel_messages[device][channel] = []
-        message_dict = {"timestamp": timestamp, "sender": sender, "message": text}
-        shared.channel_messages[device][channel].append(message_dict)
+        shared.add_channel_message(device, channel, ChannelMessage(timestamp, sender, text))
         if device == self.selected_device and channel == self.selected_channel:
-            self.messages.SetObjects(shared.channel_messages[device][channel])
-            self.messages.EnsureVisible(self.messages.GetItemCount() - 1)
+            shared.refresh_scheduler.mark_dirty(self, refresh_messages)
 
         log_dict = {"device": device, "channel": channel, "timestamp": timestamp, "sender": sender, "message": text}
-        self._log_message(log_dict)
+        shared.log_channel_message(log_dict)
 
     # === Helpers and private functions
 
-    @staticmethod
-    def _log_message(message_dict):
-        log.debug("Logging message")
-        with (open(shared.config.get("CHANNEL_MESSAGE_LOG", "channel-messages.csv"), "a") as lf):
-            csv.DictWriter(lf, fieldnames=["device", "channel", "timestamp", "sender", "message"],
-                           quoting=csv.QUOTE_ALL).writerow(message_dict)
+    def _release_messages_view(self):
+        # The message list is about to stop showing this channel, so its buffer can be trimmed again
+        if self.selected_device and self.selected_channel is not None:
+            shared.release_channel_view(self.selected_device, self.selected_channel)
+
+    def _show_new_messages(self):
+        device = self.selected_device
+        channel = self.selected_channel
+        self.messages.ShowNewMessages(lambda shown: shared.new_channel_messages(device, channel, shown),
+                                      lambda: shared.get_channel_messages(device, channel))
+
+    def _load_older_if_scrolled_to_top(self):
+        if not self.selected_device or self.selected_channel is None:
+            return
+        if self.messages.GetItemCount() == 0 or self.messages.GetTopItem() != 0:
+            return
+
+        loaded = shared.load_older_channel_messages(self.selected_device, self.selected_channel,
+                                                    shared.message_page_size)
+        if loaded:
+            log.debug(f"Loaded {loaded} older messages")
+            self.messages.SetObjects(shared.get_channel_messages(self.selected_device, self.selected_channel))
+            self.messages.EnsureVisible(loaded)  # Keep the message that was at the top in view
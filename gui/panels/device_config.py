@@ -1,10 +1,14 @@
 import logging
+import threading
 import wx
 import wx.propgrid as wxpg
 
+from common.fleet_config import load_profile, apply_profile, format_report, ProfileError, STATUS_APPLIED
 from gui import shared
+from gui.config_diff import take_snapshot, diff_config, changed_categories, requires_reboot, update_snapshot
+from gui.config_schema import config_schema, KIND_BOOL, KIND_ENUM, KIND_INT
 from gui.gui_events import set_status_bar, EVT_ADD_DEVICE, EVT_REFRESH_PANEL, fake_device_disconnect, EVT_REMOVE_DEVICE, \
-    refresh_specific_panel
+    refresh_specific_panel, fleet_progress, EVT_FLEET_PROGRESS, fleet_done, EVT_FLEET_DONE
 from gui.panels.channel_edit import ChannelEdit
 
 log = logging.getLogger(__name__)
@@ -24,7 +28,12 @@ class DevConfigPanel(wx.Panel):
         self.device_picker.SetSelection(wx.NOT_FOUND)
         self.Bind(wx.EVT_CHOICE, self.onDevicePickerChoice, self.device_picker)
         sizer.Add(dev_picker_label, 0, flag=wx.LEFT)
-        sizer.Add(self.device_picker, 0, wx.BOTTOM | wx.TOP, 2)
+        picker_box = wx.BoxSizer(wx.HORIZONTAL)
+        picker_box.Add(self.device_picker, 0)
+        self.profile_button = wx.Button(self, wx.ID_ANY, label="Apply profile to all...")
+        self.Bind(wx.EVT_BUTTON, self.onProfileButton, self.profile_button)
+        picker_box.Add(self.profile_button, 0, wx.LEFT, 10)
+        sizer.Add(picker_box, 0, wx.BOTTOM | wx.TOP, 2)
         sizer.Add(wx.StaticLine(self, wx.ID_ANY), 0, wx.EXPAND | wx.BOTTOM | wx.TOP, 5)
 
         sizer.Add(wx.StaticText(self, wx.ID_ANY, "User configuration"), 0)
@@ -94,10 +103,16 @@ class DevConfigPanel(wx.Panel):
 
         self.selected_device = None  # Device last selected , so we don't have to call control's method every time
         self.this_node = None
+        self.lc_snapshot = None  # localConfig and moduleConfig as loaded from the device, to find what was changed
+        self.mc_snapshot = None
 
         self.Bind(EVT_REFRESH_PANEL, self.refresh_panel_event)
         self.Bind(EVT_ADD_DEVICE, self.add_device_event)
         self.Bind(EVT_REMOVE_DEVICE, self.remove_device_event)
+        self.Bind(EVT_FLEET_PROGRESS, self.fleet_progress_event)
+        self.Bind(EVT_FLEET_DONE, self.fleet_done_event)
+        self.fleet_timeout = float(shared.config.get("FLEET_TIMEOUT_SECONDS", 120))
+        self.fleet_max_parallel = int(shared.config.get("FLEET_MAX_PARALLEL", 8))
 
     def _reload_user_grid(self):
         log.debug(f"Reloading user grid")
@@ -133,9 +148,8 @@ class DevConfigPanel(wx.Panel):
         if not self.selected_device or not self.this_node:
             return  # Just in case
 
-        self.lc_config_editor.Clear()
-        self._load_config_values(self.this_node.localConfig, self.lc_config_editor)
-        self.lc_config_editor.CollapseAll()
+        self._reload_config_grid(self.this_node.localConfig, self.lc_config_editor)
+        self.lc_snapshot = take_snapshot(self.this_node.localConfig)
 
         return
 
@@ -144,116 +158,102 @@ class DevConfigPanel(wx.Panel):
         if not self.selected_device or not self.this_node:
             return  # Just in case
 
-        self.mc_config_editor.Clear()
-        self._load_config_values(self.this_node.moduleConfig, self.mc_config_editor)
-        self.mc_config_editor.CollapseAll()
+        self._reload_config_grid(self.this_node.moduleConfig, self.mc_config_editor)
+        self.mc_snapshot = take_snapshot(self.this_node.moduleConfig)
+
+        return
+
+    def _reload_config_grid(self, config, grid):
+        # Freeze the grid so it's redrawn once at the end, not once per property
+        grid.Freeze()
+        try:
+            grid.Clear()
+            self._load_config_values(config, grid)
+            grid.CollapseAll()
+        finally:
+            grid.Thaw()
 
         return
 
     def _load_config_values(self, config, grid):
-        # The configuration bits use Google protocol buffers (oh, joy), hence the DESCRIPTOR stuff herein
-        # General format: config.category.setting (e.g. localConfig.bluetooth.fixed_pin = "123456")
-        categories = config.DESCRIPTOR.fields_by_name.keys()  # Get the names of all the categories
-        for cat in categories:
-            if cat == "version":  # Gotta love the exception
-                continue
-            grid.Append(wxpg.PropertyCategory(cat))  # Make it a category in the property grid
-
-            category_settings = getattr(config, cat)
-            setting_keys = category_settings.DESCRIPTOR.fields_by_name  # Get all the settings under this category
-            for setting_key in setting_keys:
-                if setting_key == "version":  # Again
-                    continue
-                setting_value = getattr(category_settings, setting_key)
-                self._add_setting_to_grid(category_settings, setting_key, setting_value, grid, cat)
+        # The configuration bits use Google protocol buffers (oh, joy): config.category.setting
+        # (e.g. localConfig.bluetooth.fixed_pin = "123456"). What each setting looks like comes from the schema
+        # compiled (once per protobuf message type) from the protobuf descriptors.
+        for category in config_schema(config):
+            category_prop = grid.Append(wxpg.PropertyCategory(category.name))  # Make it a category in the grid
+            category_settings = getattr(config, category.name)
+            for setting in category.settings:
+                prop = self._make_setting_property(setting, getattr(category_settings, setting.name))
+                grid.AppendIn(category_prop, prop)
 
         return
 
-    def _add_setting_to_grid(self, config, key, value, grid, category):
+    @staticmethod
+    def _make_setting_property(setting, value):
         # Note: there are duplicate keys across configuration categories, but property names must be unique.
-        # So, create a unique name for each (e.g. Security_isManaged). Labels (the visible text) can be duplicated.
-
-        # Determine the property and editor types
-        if isinstance(value, bool):
-            prop = wxpg.BoolProperty(str(key), f"{category}_{str(key)}", value)
+        # The schema's property names are, e.g. security_is_managed. Labels (the visible text) can be duplicated.
+        if setting.kind == KIND_BOOL:
+            prop = wxpg.BoolProperty(setting.name, setting.property_name, value)
             prop.SetEditor("CheckBox")
-        elif isinstance(value, int):
-            # If the protobuf says this is an enumerated type, get labels and values and make this an EnumProperty
-            if config.DESCRIPTOR.fields_by_name[key].enum_type:
-                labels, label_values = self._get_choices_from_protobuf(key, config.DESCRIPTOR)
-                prop = wxpg.EnumProperty(str(key), f"{category}_{str(key)}", labels, label_values, value)
-            # And if it isn't, then it's a plain ol' integer
-            else:
-                prop = wxpg.IntProperty(str(key), f"{category}_{str(key)}", value)
-                prop.SetEditor("TextCtrl")
-        elif isinstance(value, str):
-            prop = wxpg.StringProperty(str(key), f"{category}_{str(key)}", str(value))
+        elif setting.kind == KIND_ENUM:
+            if setting.choices is None:  # Shared by every grid that shows this setting
+                setting.choices = wxpg.PGChoices(list(setting.labels), list(setting.values))
+            prop = wxpg.EnumProperty(setting.name, setting.property_name, setting.choices, value)
+        elif setting.kind == KIND_INT:
+            prop = wxpg.IntProperty(setting.name, setting.property_name, value)
             prop.SetEditor("TextCtrl")
-        else:  # A new one on us, make it a string for now
-            prop = wxpg.StringProperty(str(key), f"{category}_{str(key)}", str(value))  # default to simple string
+        else:  # A string, or a new one on us: make it a string for now
+            prop = wxpg.StringProperty(setting.name, setting.property_name, str(value))
             prop.SetEditor("TextCtrl")
 
-        # Add the setting to the propertygrid
-        grid.AppendIn(category, prop)
-
-        return
+        return prop
 
     @staticmethod
-    def _get_choices_from_protobuf(key, descriptor):
-        # If this was called, enum_type was already checked for None-ness. Assume it's not none.
-        names = []
-        values = []
-        enum_type = descriptor.fields_by_name[key].enum_type
-
-        for value_text in enum_type.values_by_name:
-            names.append(value_text)
-            values.append(enum_type.values_by_name[value_text].number)
-
-        return names, values
-
-    """
-    A bit about the descriptor and the enum types contained therein:
-    A "field" in this context is the setting name (e.g. 'baud')
-    
-    fields_by_name[field_name].enum_type is None if the field is not an enum type 
-    enum_types_by_name keys are the names of the fields that are enum types (not used in this code but could be handy)
-    
-    config.DESCRIPTOR.fields_by_name[field_name].enum_type:
-       .values_by_name: keys are the text values for just this field
-       .values_by_name['text'].number is the int value of the text e.g. .values_by_name["BAUD_DEFAULT"].number = 0
-       .values_by_number[int].name looks up the name of the int val e.g. values_by_number[0] = "BAUD_DEFAULT"
-    """
-
-    @staticmethod
-    def _get_changed_categories(editor, config):
-        log.debug("Getting changed categories")
-        changed_cats = []  # Categories that have changed settings
+    def _apply_grid_changes(editor, config):
+        # Copy the modified settings in the grid to the config. Returns the settings that couldn't be set.
+        log.debug("Applying grid changes")
+        bad_settings = []
         cat_iterator = editor.GetIterator(wx.propgrid.PG_ITERATE_CATEGORIES)
         while not cat_iterator.AtEnd():
             cat = cat_iterator.GetProperty()
-            cat_modified = False
-
             for child_index in range(cat.GetChildCount()):
                 child = cat.Item(child_index)
                 if editor.IsPropertyModified(child):
                     category_settings = getattr(config, cat.GetName())
-                    setattr(category_settings, child.GetLabel(), child.GetValue())  # Must be the label not the name
-                    cat_modified = True
-
-            if cat_modified:
-                changed_cats.append(cat.GetName())
+                    try:
+                        setattr(category_settings, child.GetLabel(), child.GetValue())  # Must be the label not the name
+                    except (TypeError, ValueError) as e:
+                        log.error(f"Can't set {cat.GetName()}.{child.GetLabel()} to {child.GetValue()}: {e}")
+                        bad_settings.append(f"{cat.GetName()}.{child.GetLabel()}")
             cat_iterator.Next()
 
-        log.debug(f"Found {len(changed_cats)} changed categories")
-        return changed_cats
+        return bad_settings
+
+    def _save_config_changes(self, editor, config, snapshot):
+        # Write the categories that differ from what was loaded from the device, and only reboot if it has to
+        log.debug("Saving config changes")
+        bad_settings = self._apply_grid_changes(editor, config)
+        changes = diff_config(snapshot, config)
+        if not changes:
+            if bad_settings:
+                wx.RichMessageDialog(self, f"Could not set: {', '.join(bad_settings)}",
+                                     style=wx.OK | wx.ICON_ERROR).ShowModal()
+            else:
+                editor.ClearModifiedStatus()  # Settings were changed and changed back
+                wx.RichMessageDialog(self, "No changes made", style=wx.OK | wx.ICON_INFORMATION).ShowModal()
+            return
 
-    def _save_changed_categories(self, changed_cats, editor):
-        log.debug("Saving changed categories")
+        for change in changes:
+            log.info(f"Changed {change}")
+        reboot = requires_reboot(changes)
         saved_cats = []
         error_cats = []
 
-        self.this_node.beginSettingsTransaction()
-        for cat in changed_cats:
+        # Committing a settings transaction always reboots the device, so only use one when a reboot is coming
+        # anyway (then there's one reboot for all the categories). Otherwise write each category on its own.
+        if reboot:
+            self.this_node.beginSettingsTransaction()
+        for cat in changed_categories(changes):
             # noinspection PyBroadException
             try:
                 self.this_node.writeConfig(cat)
@@ -263,32 +263,41 @@ class DevConfigPanel(wx.Panel):
             else:
                 log.info(f"Saved changed category {cat}")
                 saved_cats.append(cat)
-        self.this_node.commitSettingsTransaction()
-
-        if saved_cats:
-            saved = ", ".join(saved_cats)
+        if reboot:
+            self.this_node.commitSettingsTransaction()
+        update_snapshot(snapshot, config, saved_cats)
+
+        changed = "\n".join(f"  {change.category}.{change.name}" for change in changes)
+        saved = ", ".join(saved_cats) if saved_cats else "None"
+        errors = ", ".join(error_cats + bad_settings) if error_cats or bad_settings else "None"
+        if reboot:
+            reconnect = "Device is rebooting, go to Devices panel to reconnect"
         else:
-            saved = "None"
-        if error_cats:
-            errors = ", ".join(error_cats)
-        else:
-            errors = "None"
-        wx.RichMessageDialog(self, f"Saved: {saved}, errors: {errors} \nGo to Devices panel to reconnect",
+            reconnect = "No reboot needed"
+        wx.RichMessageDialog(self, f"Changed:\n{changed}\nSaved: {saved}, errors: {errors}\n{reconnect}",
                              style=wx.OK | wx.ICON_INFORMATION).ShowModal()
 
-        if not error_cats:
+        if not error_cats and not bad_settings:
             editor.ClearModifiedStatus()
 
-        # Assume the node had to reboot, even though it might not be true in all cases.
-        # BLE devices in particular do not trigger the connection down topic, so kludge that.
-        log.info("Device reboot, requesting device disconnect")
-        wx.PostEvent(self.GetTopLevelParent(),
-                     fake_device_disconnect(name=self.selected_device,
-                                            interface=shared.connected_interfaces[self.selected_device]))
-        self.this_node = None
+        if reboot:
+            # BLE devices in particular do not trigger the connection down topic, so kludge that.
+            log.info("Device reboot, requesting device disconnect")
+            wx.PostEvent(self.GetTopLevelParent(),
+                         fake_device_disconnect(name=self.selected_device,
+                                                interface=shared.connected_interfaces[self.selected_device]))
+            self.this_node = None
+        else:
+            wx.PostEvent(self.GetTopLevelParent(), set_status_bar(text=f"Saved {saved}, no reboot needed"))
 
         return
 
+    def _apply_profile(self, profile, interfaces):
+        # Runs on its own thread, see onProfileButton
+        results = apply_profile(profile, interfaces, timeout=self.fleet_timeout, max_parallel=self.fleet_max_parallel,
+                                on_progress=lambda name, text: wx.PostEvent(self, fleet_progress(name=name, text=text)))
+        wx.PostEvent(self, fleet_done(results=results))
+
     # wxPython events
 
     def onDevicePickerChoice(self, event):
@@ -380,11 +389,7 @@ class DevConfigPanel(wx.Panel):
     # noinspection PyUnusedLocal
     def onLCSaveButton(self, event):
         log.debug("localConfig save button event")
-        changed_cats = self._get_changed_categories(self.lc_config_editor, self.this_node.localConfig)
-        if changed_cats:
-            self._save_changed_categories(changed_cats, self.lc_config_editor)
-        else:  # No changed categories
-            wx.RichMessageDialog(self, "No changes made", style=wx.OK | wx.ICON_INFORMATION).ShowModal()
+        self._save_config_changes(self.lc_config_editor, self.this_node.localConfig, self.lc_snapshot)
 
     # noinspection PyUnusedLocal
     def onMCReloadButton(self, event):
@@ -398,11 +403,56 @@ class DevConfigPanel(wx.Panel):
     # noinspection PyUnusedLocal
     def onMCSaveButton(self, event):
         log.debug("moduleConfig save button event")
-        changed_cats = self._get_changed_categories(self.mc_config_editor, self.this_node.moduleConfig)
-        if changed_cats:
-            self._save_changed_categories(changed_cats, self.mc_config_editor)
-        else:  # No changed categories
-            wx.RichMessageDialog(self, "No changes made", style=wx.OK | wx.ICON_INFORMATION).ShowModal()
+        self._save_config_changes(self.mc_config_editor, self.this_node.moduleConfig, self.mc_snapshot)
+
+    # noinspection PyUnusedLocal
+    def onProfileButton(self, event):
+        log.debug("Profile button event")
+        interfaces = dict(shared.connected_interfaces)
+        if not interfaces:
+            wx.RichMessageDialog(self, "No devices are connected", style=wx.OK | wx.ICON_INFORMATION).ShowModal()
+            return
+
+        with wx.FileDialog(self, "Configuration profile", wildcard="JSON files (*.json)|*.json",
+                           style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST) as file_dialog:
+            if file_dialog.ShowModal() != wx.ID_OK:
+                return
+            path = file_dialog.GetPath()
+        try:
+            profile = load_profile(path)
+        except ProfileError as e:
+            wx.RichMessageDialog(self, str(e), style=wx.OK | wx.ICON_ERROR).ShowModal()
+            return
+
+        confirm = wx.RichMessageDialog(self, f"Apply {path} to all {len(interfaces)} connected devices?\n"
+                                             f"Devices that change will reboot.",
+                                       style=wx.OK | wx.CANCEL | wx.ICON_WARNING)
+        if confirm.ShowModal() != wx.ID_OK:
+            return
+        log.info(f"Applying profile {path} to {', '.join(interfaces)}")
+        self.profile_button.Disable()
+        threading.Thread(target=self._apply_profile, args=(profile, interfaces), name="fleet-config",
+                         daemon=True).start()
+
+    def fleet_progress_event(self, event):
+        wx.PostEvent(self.GetTopLevelParent(), set_status_bar(text=f"Profile: {event.name}: {event.text}"))
+
+    def fleet_done_event(self, event):
+        log.debug("Fleet done event")
+        self.profile_button.Enable()
+        wx.PostEvent(self.GetTopLevelParent(), set_status_bar(text="Profile applied"))
+        wx.RichMessageDialog(self, format_report(event.results), style=wx.OK | wx.ICON_INFORMATION).ShowModal()
+
+        # Devices that were written are rebooting. BLE devices in particular do not trigger the connection down
+        # topic, so kludge that, as for a save.
+        for result in event.results:
+            if result.status == STATUS_APPLIED and result.name in shared.connected_interfaces:
+                log.info(f"Device {result.name} reboot, requesting device disconnect")
+                wx.PostEvent(self.GetTopLevelParent(),
+                             fake_device_disconnect(name=result.name,
+                                                    interface=shared.connected_interfaces[result.name]))
+                if result.name == self.selected_device:
+                    self.this_node = None
 
     def add_device_event(self, event):
         log.debug(f"Add device event for {event.name}")
@@ -1,13 +1,18 @@
 import logging
+import threading
 import wx
 from datetime import datetime
 from pubsub import pub
 
 from gui import shared
-from common.mesh_managers import DeviceManager
+from common.mesh_managers import DeviceManager, Unimplemented
+from common.reconnect import STATE_RECONNECTING, STATE_OPEN
 from gui.gui_events import (set_status_bar, EVT_REFRESH_PANEL,
                                update_connection_status, EVT_UPDATE_CONNECTION_STATUS, announce_new_device,
-                               EVT_FAKE_DEVICE_DISCONNECT, EVT_DISCONNECT_DEVICE, remove_device)
+                               EVT_FAKE_DEVICE_DISCONNECT, EVT_DISCONNECT_DEVICE, remove_device,
+                               devices_discovered, EVT_DEVICES_DISCOVERED, discovery_finished, EVT_DISCOVERY_FINISHED,
+                               device_progress, EVT_DEVICE_PROGRESS, device_job_done, EVT_DEVICE_JOB_DONE)
+from gui.device_workers import DeviceWorkers, close_with_timeout
 
 log = logging.getLogger(__name__)
 # log.setLevel(logging.DEBUG)  # Set our own level separately
@@ -21,7 +26,7 @@ class DevicesPanel(wx.Panel):
         device_box = wx.BoxSizer(wx.HORIZONTAL)  # Top part of page: buttons and device list
 
         device_button_box = wx.BoxSizer(wx.VERTICAL)  # Left side of device box: buttons
-        discover_button = wx.Button(self, wx.ID_ANY, "Discover")
+        self.discover_button = wx.Button(self, wx.ID_ANY, "Discover")
         self.discover_ble = wx.CheckBox(self, wx.ID_ANY, "Discover BLE")
         self.discover_serial = wx.CheckBox(self, wx.ID_ANY, "Discover Serial")
         self.discover_tcp = wx.CheckBox(self, wx.ID_ANY, "Discover TCP")
@@ -29,10 +34,10 @@ class DevicesPanel(wx.Panel):
         self.disconnect_button = wx.Button(self, wx.ID_ANY, "Disconnect")
         self.connect_button.Disable()
         self.disconnect_button.Disable()
-        self.Bind(wx.EVT_BUTTON, self.onDiscoverButton, discover_button)
+        self.Bind(wx.EVT_BUTTON, self.onDiscoverButton, self.discover_button)
         self.Bind(wx.EVT_BUTTON, self.onConnectButton, self.connect_button)
         self.Bind(wx.EVT_BUTTON, self.onDisconnectButton, self.disconnect_button)
-        device_button_box.Add(discover_button, 0, wx.ALL, 5)
+        device_button_box.Add(self.discover_button, 0, wx.ALL, 5)
         device_button_box.Add(self.discover_ble)
         device_button_box.Add(self.discover_serial)
         device_button_box.Add(self.discover_tcp)
@@ -101,10 +106,23 @@ class DevicesPanel(wx.Panel):
         device_box.Fit(self)
 
         self.device_manager = DeviceManager()
+        if shared.config.get("AUTO_RECONNECT", "false").lower() == "true":
+            self.device_manager.enable_auto_reconnect(
+                on_reconnected=self._on_reconnected, on_state_change=self._on_reconnect_state,
+                max_delay=float(shared.config.get("RECONNECT_MAX_SECONDS", 120)))
         self.Bind(EVT_REFRESH_PANEL, self.refresh_panel)
         self.Bind(EVT_UPDATE_CONNECTION_STATUS, self.update_connection_status)
         self.Bind(EVT_FAKE_DEVICE_DISCONNECT, self.fake_device_disconnect)
         self.Bind(EVT_DISCONNECT_DEVICE, self.disconnect_device)
+        self.Bind(EVT_DEVICES_DISCOVERED, self.devices_discovered)
+        self.Bind(EVT_DISCOVERY_FINISHED, self.discovery_finished)
+        self.Bind(EVT_DEVICE_PROGRESS, self.device_progress)
+        self.Bind(EVT_DEVICE_JOB_DONE, self.device_job_done)
+        # Connects and disconnects run on a worker per device, so they don't freeze the GUI or wait for each other
+        self.device_workers = DeviceWorkers()
+        self.close_timeout = float(shared.config.get("CLOSE_TIMEOUT_SECONDS", 15))
+        self._discovered_count = 0
+        self._discovery_errors = []
 
         # Non-GUI stuff
         pub.subscribe(self.onConnectionUp, "meshtastic.connection.established")
@@ -181,22 +199,146 @@ class DevicesPanel(wx.Panel):
         if self.device_list.IsSelected(index) and status == "Connected":
             log.debug("Device is selected and connected")
             self._show_device_info(index)
-            self.disconnect_button.Enable()
-            self.connect_button.Disable()
-        else:
-            self.connect_button.Enable()
-            self.disconnect_button.Disable()
+        self._update_buttons()
         self.Layout()
         return
 
+    def _update_buttons(self):
+        # Connect is only for a disconnected device and Disconnect only for a connected one; neither while a
+        # connect or disconnect is under way
+        selected_index = self.device_list.GetFirstSelected()
+        status = self.device_list.GetItemText(selected_index, 1) if selected_index != -1 else None
+        self.connect_button.Enable(status == "Disconnected")
+        self.disconnect_button.Enable(status in ("Connected", "Reconnecting", "Reconnect paused"))
+
+    def _find_device_by_address(self, address):
+        # Device list index of the device with this address, or -1
+        for index in range(self.device_list.GetItemCount()):
+            if self.device_list.GetItemText(index, 3) == address:
+                return index
+        return -1
+
+    def _post(self, event):
+        # Post an event to the panel from a worker thread
+        try:
+            wx.PostEvent(self, event)
+        except RuntimeError:
+            pass  # The panel went away (application closing)
+
+    def _connect(self, dev_type, address):
+        # Runs on the device's worker thread
+        self._post(device_progress(address=address, status="Connecting",
+                                   text=f"Connecting to {dev_type} device {address}, loading its nodes and settings"))
+        interface = None
+        error = None
+        try:
+            log.debug(f"Calling device manager to connect {dev_type} device at {address}")
+            interface = self.device_manager.connect_to_specific_device(dev_type, address)
+        except Exception as e:
+            error = e
+        self._post(device_job_done(action="connect", address=address, name=None, interface=interface, error=error,
+                                   timed_out=False))
+
+    def _on_reconnected(self, dev_type, address, old_interface, interface):
+        # Runs on the reconnect supervisor's thread. The new interface announces itself to the other panels
+        # through the connection established topic; this brings the device list up to date.
+        stats = self.device_manager.reconnect_supervisor.stats().get(address, {})
+        self._post(device_progress(address=address, status="Connected",
+                                   text=f"Reconnected to {dev_type} device {address} "
+                                        f"(reconnect {stats.get('reconnects', '?')}, "
+                                        f"{stats.get('downtime', '?')}s down in total)"))
+        self._post(device_job_done(action="connect", address=address, name=None, interface=interface, error=None,
+                                   timed_out=False))
+
+    def _on_reconnect_state(self, dev_type, address, state):
+        # Runs on the reconnect supervisor's thread
+        if state == STATE_RECONNECTING:
+            self._post(device_progress(address=address, status="Reconnecting",
+                                       text=f"Connection to {dev_type} device {address} lost, reconnecting"))
+        elif state == STATE_OPEN:
+            self._post(device_progress(address=address, status="Reconnect paused",
+                                       text=f"Unable to reconnect to {dev_type} device {address}, "
+                                            f"trying again less often"))
+
+    def _disconnect(self, name, address, interface):
+        # Runs on the device's worker thread
+        self.device_manager.forget_device(interface)  # On purpose, so don't reconnect it
+        self._post(device_progress(address=address, status="Disconnecting", text=f"Disconnecting from {name}"))
+        error = None
+        timed_out = False
+        try:
+            timed_out = not close_with_timeout(interface, self.close_timeout)
+        except Exception as e:
+            error = e
+        self._post(device_job_done(action="disconnect", address=address, name=name, interface=interface,
+                                   error=error, timed_out=timed_out))
+
     def _update_device_name(self, index, name):
         log.debug(f"Update device name to {name} for index {index}")
         self.device_list.SetItem(index, 0, name)
         for col in range(self.device_list.GetColumnCount()):
             self.device_list.SetColumnWidth(col, wx.LIST_AUTOSIZE)
 
+    def _discover(self, device_types):
+        # Runs on its own thread. Results, errors included, go to the GUI thread in events.
+        try:
+            for dev_type, devices, error in self.device_manager.iter_available_devices(device_types):
+                wx.PostEvent(self, devices_discovered(dev_type=dev_type, devices=devices, error=error))
+        except RuntimeError:
+            return  # The panel went away (application closing)
+        except Exception as e:
+            log.error(f"Error discovering devices: {e}")
+            try:
+                wx.PostEvent(self, devices_discovered(dev_type=None, devices=[], error=e))  # Not any one type's
+            except RuntimeError:
+                return
+        try:
+            wx.PostEvent(self, discovery_finished())
+        except RuntimeError:
+            pass
+
+    def _append_discovered_devices(self, discovered_devices):
+        for dev_type, address, name in discovered_devices:
+            if dev_type == "ble":
+                # BLE device name starts with shortname and an underscore
+                self.device_list.Append((name.split("_")[0], "Disconnected", dev_type, address))
+            else:
+                # With other device types, we don't know the short name until we connect
+                self.device_list.Append(("----", "Disconnected", dev_type, address))
+
+        for col in range(self.device_list.GetColumnCount()):
+            self.device_list.SetColumnWidth(col, wx.LIST_AUTOSIZE)
+        self.Layout()  # Columns don't resize until window is jiggled
+
     # === wxPython events
 
+    def devices_discovered(self, event):
+        log.debug(f"Devices discovered event for {event.dev_type}")
+        if event.error is not None:
+            if event.dev_type is None:
+                self._discovery_errors.append(str(event.error))
+                wx.PostEvent(self.GetTopLevelParent(), set_status_bar(text=f"Error discovering devices: {event.error}"))
+            elif not isinstance(event.error, Unimplemented):
+                self._discovery_errors.append(f"{event.dev_type}: {event.error}")
+                wx.PostEvent(self.GetTopLevelParent(),
+                             set_status_bar(text=f"Error discovering {event.dev_type} devices: {event.error}"))
+            return
+        if event.devices:
+            self._discovered_count += len(event.devices)
+            self._append_discovered_devices(event.devices)
+            wx.PostEvent(self.GetTopLevelParent(),
+                         set_status_bar(text=f"Found {len(event.devices)} {event.dev_type} device(s)"))
+
+    # noinspection PyUnusedLocal
+    def discovery_finished(self, event):
+        log.debug("Discovery finished event")
+        self.discover_button.Enable()
+        wx.PostEvent(self.GetTopLevelParent(),
+                     set_status_bar(text=f"Discovery finished, found {self._discovered_count} device(s)"))
+        if self._discovery_errors and not self._discovered_count:
+            wx.RichMessageDialog(self, f"Error discovering devices: {'; '.join(self._discovery_errors)}",
+                                 style=wx.OK | wx.ICON_ERROR).ShowModal()
+
     # noinspection PyUnusedLocal
     def refresh_panel(self, event):
         log.debug(f"Refresh panel")
@@ -235,15 +377,11 @@ class DevicesPanel(wx.Panel):
         if index != -1:
             if self.device_list.IsSelected(index):
                 self._clear_device_info()
-            dev_type = self.device_list.GetItemText(index, 2)
-            if dev_type == "ble":
-                wx.RichMessageDialog(self, "WARNING: BLE device disconnects hang on some platforms, "
-                                           "force-quit the application if the disconnect hangs",
-                                     style=wx.ICON_WARNING | wx.OK).ShowModal()
 
-        shared.connected_interfaces[event.name].close()
-        shared.connected_interfaces.pop(event.name, None)
-        log.info(f"Disconnected device {event.name}")
+        interface = shared.connected_interfaces.get(event.name)
+        if interface is not None:
+            address = self.device_list.GetItemText(index, 3) if index != -1 else event.name
+            self.device_workers.submit(address, self._disconnect, event.name, address, interface)
 
     # noinspection PyUnusedLocal
     def onDiscoverButton(self, event):
@@ -261,27 +399,13 @@ class DevicesPanel(wx.Panel):
                                  style=wx.OK | wx.ICON_ERROR).ShowModal()
             return
 
-        discovered_devices = []
-        try:
-            discovered_devices = self.device_manager.find_all_available_devices(device_types)
-        except Exception as e:
-            wx.RichMessageDialog(self, f"Error discovering devices: {str(e)}", style=wx.OK | wx.ICON_ERROR).ShowModal()
-        finally:
-            if not discovered_devices:
-                return
-
-        for dev_type, address, name in discovered_devices:
-            if dev_type == "ble":
-                # BLE device name starts with shortname and an underscore
-                self.device_list.Append((name.split("_")[0], "Disconnected", dev_type, address))
-            else:
-                # With other device types, we don't know the short name until we connect
-                self.device_list.Append(("----", "Disconnected", dev_type, address))
-
-            for col in range(self.device_list.GetColumnCount()):
-                self.device_list.SetColumnWidth(col, wx.LIST_AUTOSIZE)
-            self.Layout()  # Columns don't resize until window is jiggled
-
+        # Search in the background and add devices to the list as each type's search finishes; some types (BLE)
+        # take several seconds
+        self.discover_button.Disable()
+        self._discovered_count = 0
+        self._discovery_errors = []
+        wx.PostEvent(self.GetTopLevelParent(), set_status_bar(text="Discovering devices..."))
+        threading.Thread(target=self._discover, args=(device_types,), name="discover-devices", daemon=True).start()
         return
 
     # noinspection PyUnusedLocal
@@ -304,25 +428,9 @@ class DevicesPanel(wx.Panel):
                                  style=wx.OK | wx.ICON_ERROR).ShowModal()
             return
 
-        try:
-            log.debug(f"Calling device manager to connect {dev_type} device at {address}")
-            interface = self.device_manager.connect_to_specific_device(dev_type, address)
-        except Exception as e:
-            wx.RichMessageDialog(self, f"Error connecting to device: {str(e)}",
-                                 style=wx.OK | wx.ICON_ERROR).ShowModal()
-            return
-
-        if interface:
-            name = interface.getShortName()
-        else:
-            wx.RichMessageDialog(self, "Connection attempt failed",
-                                 style=wx.OK | wx.ICON_ERROR).ShowModal()
-            return
-        shared.connected_interfaces[name] = interface
-        self._update_device_name(selected_item, name)
-        self._update_connection_status(name, "Connected")
-        log.info(f"Connected device {name}")
-
+        self.device_list.SetItem(selected_item, 1, "Connecting")
+        self._update_buttons()
+        self.device_workers.submit(address, self._connect, dev_type, address)
         return
 
     # noinspection PyUnusedLocal
@@ -335,33 +443,24 @@ class DevicesPanel(wx.Panel):
 
         name = self.device_list.GetItemText(selected_item, 0)
         dev_type = self.device_list.GetItemText(selected_item, 2)
+        address = self.device_list.GetItemText(selected_item, 3)
+        interface = shared.connected_interfaces.get(name)
+        if interface is None:
+            wx.RichMessageDialog(self, f"Device {name} is not connected", style=wx.OK | wx.ICON_ERROR).ShowModal()
+            return
 
-        # Warn about BLE disconnect bug (might be Mac-specific)
-        if dev_type == "ble":
-            wx.RichMessageDialog(self, "WARNING: BLE device disconnects hang on some platforms, "
-                                       "force-quit the application if the disconnect hangs",
-                                 style=wx.ICON_WARNING | wx.OK).ShowModal()
-        elif dev_type == "tcp":
+        if dev_type == "tcp":
             # TCP devices lose a lot of their info after a close(), so we need to fire the device cleanup
             # events before closing.
             wx.PostEvent(self, update_connection_status(name=name, status="Disconnected"))
             wx.PostEvent(self.GetTopLevelParent(), set_status_bar(text=f"Connection to {name} closed"))
-            wx.PostEvent(self.GetTopLevelParent(), remove_device(name=name,
-                                                                 interface=shared.connected_interfaces[name]))
-
-        try:
-            shared.connected_interfaces[name].close()
-        except Exception as e:
-            wx.RichMessageDialog(self, f"Error disconnecting from device: {str(e)}",)
-            return
+            wx.PostEvent(self.GetTopLevelParent(), remove_device(name=name, interface=interface))
 
+        # close() runs on the device's worker, with a time limit since BLE disconnects hang on some platforms
+        self.device_list.SetItem(selected_item, 1, "Disconnecting")
+        self._update_buttons()
         self._clear_device_info()
-
-        # Remove the old interface object but don't close the associated windows. If a reconnect happens, the
-        # key (name) will still be the same, so all the windows will still match up with the new object
-        shared.connected_interfaces.pop(name, None)
-        log.info(f"Disconnected device {name}")
-
+        self.device_workers.submit(address, self._disconnect, name, address, interface)
         return
 
     # noinspection PyUnusedLocal
@@ -369,13 +468,7 @@ class DevicesPanel(wx.Panel):
         log.debug(f"Device selected event")
         selected_index = event.GetIndex()
         selected_short_name = self.device_list.GetItemText(selected_index, 0)
-        selected_status = self.device_list.GetItemText(selected_index, 1)
-        if selected_status == "Connected":
-            self.connect_button.Disable()
-            self.disconnect_button.Enable()
-        else:
-            self.connect_button.Enable()
-            self.disconnect_button.Disable()
+        self._update_buttons()
         # We won't have an interface object for this device if it hasn't connected at least once
         if selected_short_name in shared.connected_interfaces:
             self._show_device_info(selected_index)
@@ -388,6 +481,55 @@ class DevicesPanel(wx.Panel):
         self.disconnect_button.Disable()
         self._clear_device_info()
 
+    def device_progress(self, event):
+        log.debug(f"Device progress event for {event.address}: {event.status}")
+        index = self._find_device_by_address(event.address)
+        if index != -1:
+            self.device_list.SetItem(index, 1, event.status)
+            self._update_buttons()
+        wx.PostEvent(self.GetTopLevelParent(), set_status_bar(text=event.text))
+
+    def device_job_done(self, event):
+        log.debug(f"Device {event.action} finished for {event.address}")
+        index = self._find_device_by_address(event.address)
+        if event.action == "connect":
+            interface = event.interface
+            if event.error is not None or not interface:
+                if index != -1:
+                    self.device_list.SetItem(index, 1, "Disconnected")
+                    self._update_buttons()
+                wx.PostEvent(self.GetTopLevelParent(), set_status_bar(text=f"Connection to {event.address} failed"))
+                message = f"Error connecting to device: {event.error}" if event.error else "Connection attempt failed"
+                wx.RichMessageDialog(self, message, style=wx.OK | wx.ICON_ERROR).ShowModal()
+                return
+            name = interface.getShortName()
+            shared.connected_interfaces[name] = interface
+            if index != -1:
+                self._update_device_name(index, name)
+            self._update_connection_status(name, "Connected")
+            log.info(f"Connected device {name}")
+            return
+
+        # Disconnect. Remove the old interface object but don't close the associated windows. If a reconnect
+        # happens, the key (name) will still be the same, so all the windows will still match up with the new object
+        if shared.connected_interfaces.get(event.name) is event.interface:
+            shared.connected_interfaces.pop(event.name, None)
+        if index != -1:
+            self.device_list.SetItem(index, 1, "Disconnected")
+            if self.device_list.IsSelected(index):
+                self._clear_device_info()
+            self._update_buttons()
+        if event.timed_out:
+            log.warning(f"Timed out disconnecting from {event.name}, leaving it to finish in the background")
+            wx.PostEvent(self.GetTopLevelParent(),
+                         set_status_bar(text=f"Disconnect from {event.name} timed out, treating it as disconnected"))
+        elif event.error is not None:
+            wx.RichMessageDialog(self, f"Error disconnecting from device: {event.error}",
+                                 style=wx.OK | wx.ICON_ERROR).ShowModal()
+        else:
+            wx.PostEvent(self.GetTopLevelParent(), set_status_bar(text=f"Disconnected from {event.name}"))
+            log.info(f"Disconnected device {event.name}")
+
     # === Meshtastic pub/sub topic handlers
     """
     IMPORTANT NOTE: See README.md for important details about handling Meshtastic pub/sub messages.
@@ -412,7 +554,8 @@ class DevicesPanel(wx.Panel):
         if not short_name:
             return
 
-        wx.PostEvent(self, update_connection_status(name=short_name, status="Disconnected"))
+        status = "Reconnecting" if self.device_manager.is_reconnecting(interface) else "Disconnected"
+        wx.PostEvent(self, update_connection_status(name=short_name, status=status))
         wx.PostEvent(self.GetTopLevelParent(), set_status_bar(text=f"Connection lost to {short_name}"))
         wx.PostEvent(self.GetTopLevelParent(), remove_device(name=short_name, interface=interface))
         return
@@ -1,12 +1,13 @@
 import logging
-import csv
 import wx
 from datetime import datetime
-from ObjectListView3 import ObjectListView, ColumnDefn
+from ObjectListView3 import ColumnDefn
 
+from common.message_buffers import DirectMessage
 from gui import shared
-from gui.gui_events import EVT_REFRESH_PANEL, EVT_PROCESS_RECEIVED_MESSAGE, EVT_ADD_DEVICE, EVT_CHILD_CLOSED, refresh_panel, \
+from gui.gui_events import EVT_REFRESH_PANEL, EVT_PROCESS_RECEIVED_MESSAGE, EVT_ADD_DEVICE, EVT_CHILD_CLOSED, \
     refresh_specific_panel, EVT_REMOVE_DEVICE
+from gui.panels.message_list import MessageList
 from gui.panels.node_convo_frame import NodeConvoFrame
 
 log = logging.getLogger(__name__)
@@ -42,16 +43,18 @@ class DirectMessagesPanel(wx.Panel):
         message_button_box.Add(self.convo_button)
         sizer.Add(message_button_box, 0, wx.TOP | wx.BOTTOM, 5)
 
-        self.messages = ObjectListView(self, wx.ID_ANY, style=wx.LC_REPORT | wx.SUNKEN_BORDER)
+        self.messages = MessageList(self, wx.ID_ANY, style=wx.LC_REPORT | wx.SUNKEN_BORDER)
         self.messages.SetColumns([
             ColumnDefn("Timestamp", "left", 150, "timestamp", isEditable=False),
-            ColumnDefn("From", "left", 50, "from", isEditable=False),
-            ColumnDefn("To", "left", 50, "to", isEditable=False),
+            ColumnDefn("From", "left", 50, "from_node", isEditable=False),
+            ColumnDefn("To", "left", 50, "to_node", isEditable=False),
             ColumnDefn("", "left", -1, "message", isEditable=False),
         ])
         self.messages.SetEmptyListMsg("No messages")
         self.Bind(wx.EVT_LIST_ITEM_SELECTED, self.onMessageSelected, self.messages)
         self.Bind(wx.EVT_LIST_ITEM_DESELECTED, self.onMessageDeselected, self.messages)
+        self.messages.Bind(wx.EVT_SCROLLWIN, self.onMessageListScroll)
+        self.messages.Bind(wx.EVT_MOUSEWHEEL, self.onMessageListScroll)
         sizer.Add(self.messages, 4, wx.EXPAND | wx.TOP | wx.BOTTOM, 5)
 
         self.SetSizer(sizer)
@@ -67,32 +70,46 @@ class DirectMessagesPanel(wx.Panel):
         self.active_subpanels = []  # List of active node conversation frames that will get refreshed on new messages
         self.selected_device = None  # Device last selected , so we don't have to call control's method every time
 
-    def _find_nodeid_from_shortname(self, shortname):
-        log.debug(f"Finding nodeid from shortname {shortname}")
-        # Brute force for now: shuffle through the interface's node list looking for the shortname
-        for node, node_info in shared.connected_interfaces[self.selected_device].nodes.items():
-            if node_info.get("user", {}).get("shortName", None) == shortname:
-                return node
-        return None
+    def _show_new_messages(self):
+        device = self.selected_device
+        if not device:
+            self.messages.SetObjects([])
+            return
+        self.messages.ShowNewMessages(lambda shown: shared.new_direct_messages(device, shown),
+                                      lambda: shared.get_direct_messages(device))
+
+    def _load_older_if_scrolled_to_top(self):
+        if not self.selected_device:
+            return
+        if self.messages.GetItemCount() == 0 or self.messages.GetTopItem() != 0:
+            return
+
+        loaded = shared.load_older_direct_messages(self.selected_device, shared.message_page_size)
+        if loaded:
+            log.debug(f"Loaded {loaded} older messages")
+            self.messages.SetObjects(shared.get_direct_messages(self.selected_device), preserveSelection=True)
+            self.messages.EnsureVisible(loaded)  # Keep the message that was at the top in view
 
     # === wxPython events
 
     def onDevicePickerChoice(self, evt):
         log.debug("Device picker choice event")
+        if self.selected_device:
+            shared.release_direct_view(self.selected_device)
         self.selected_device = self.msg_device_picker.GetString(evt.GetSelection())
-        self.messages.SetObjects(shared.direct_messages[self.selected_device])
+        self.messages.SetObjects(shared.get_direct_messages(self.selected_device))
         if self.messages.GetItemCount() > 0:
             self.messages.EnsureVisible(self.messages.GetItemCount() - 1)
 
     # noinspection PyUnusedLocal
     def onQuickMsgButton(self, evt):
         log.debug("Quick message button event")
-        selected_item = self.messages.GetFirstSelected()
-        if self.messages[selected_item]["from"] != self.selected_device:  # Remote node name could be in either column
-            selected_sender = self.messages[selected_item]["from"]
+        selected_message = self.messages.GetObjectAt(self.messages.GetFirstSelected())
+        if selected_message.from_node != self.selected_device:  # Remote node name could be in either column
+            selected_sender = selected_message.from_node
         else:
-            selected_sender = self.messages[selected_item]["to"]
-        sender_node_id = self._find_nodeid_from_shortname(selected_sender)
+            selected_sender = selected_message.to_node
+        sender_node_id = shared.find_nodeid_from_shortname(self.selected_device, selected_sender)
         if not sender_node_id:
             wx.RichMessageDialog(self, f"Sender {selected_sender} not found in device node list, cannot send message",
                                  style=wx.OK | wx.ICON_ERROR).ShowModal()
@@ -115,29 +132,26 @@ class DirectMessagesPanel(wx.Panel):
             return
 
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        message_dict = {"timestamp": now, "from": self.selected_device, "to": selected_sender,
-                        "message": text_to_send}
-        shared.direct_messages[self.selected_device].append(message_dict)
-        self.messages.SetObjects(shared.direct_messages[self.selected_device], preserveSelection=True)
-        self.messages.EnsureVisible(self.messages.GetItemCount() - 1)
-        shared.node_conversations[self.selected_device][selected_sender].append(message_dict)
+        message = DirectMessage(now, self.selected_device, selected_sender, text_to_send)
+        shared.add_direct_message(self.selected_device, selected_sender, message)
+        self._show_new_messages()
         for child in self.active_subpanels:
-            wx.PostEvent(child, refresh_panel())
+            shared.refresh_scheduler.mark_dirty(child)
         wx.PostEvent(self.GetTopLevelParent(), refresh_specific_panel(panel_name="node"))
 
         log_dict = {"device": self.selected_device, "remote": selected_sender, "timestamp": now,
                        "from": self.selected_device, "to": selected_sender, "message": text_to_send}
-        self._log_message(log_dict)
+        shared.log_direct_message(log_dict)
 
     # noinspection PyUnusedLocal
     def onConvoButton(self, evt):
         log.debug("Conversation view button event")
-        selected_item = self.messages.GetFirstSelected()
-        if self.messages[selected_item]["from"] != self.selected_device:  # Remote node name could be in either column
-            selected_sender = self.messages[selected_item]["from"]
+        selected_message = self.messages.GetObjectAt(self.messages.GetFirstSelected())
+        if selected_message.from_node != self.selected_device:  # Remote node name could be in either column
+            selected_sender = selected_message.from_node
         else:
-            selected_sender = self.messages[selected_item]["to"]
-        sender_node_id = self._find_nodeid_from_shortname(selected_sender)
+            selected_sender = selected_message.to_node
+        sender_node_id = shared.find_nodeid_from_shortname(self.selected_device, selected_sender)
         if not sender_node_id:
             wx.RichMessageDialog(self, f"Sender {selected_sender} not found in device node list, cannot send message",
                                  style=wx.OK | wx.ICON_ERROR).ShowModal()
@@ -174,28 +188,27 @@ class DirectMessagesPanel(wx.Panel):
         self.convo_button.Disable()
         self.messages_label.SetLabel("Messages")
 
+    def onMessageListScroll(self, evt):
+        evt.Skip()  # Let the list scroll first, then see if it got to the top
+        wx.CallAfter(self._load_older_if_scrolled_to_top)
+
     # noinspection PyUnusedLocal
     def refresh_panel_event(self, event):
         log.debug("Refresh panel event")
-        self.messages.SetObjects(shared.direct_messages[self.selected_device], preserveSelection=True)
-        item_count = self.messages.GetItemCount()
-        if item_count > 0:
-            self.messages.EnsureVisible(item_count - 1)
+        self._show_new_messages()
         for child in self.active_subpanels:
-            wx.PostEvent(child, refresh_panel())
+            shared.refresh_scheduler.mark_dirty(child)
 
     def add_device_event(self, evt):
         log.debug(f"Add device event for {evt.name}")
         device_name = evt.name
 
-        # Add the new device to the message buffer and device picker
-        if device_name not in shared.direct_messages:
-            shared.direct_messages[device_name] = []
+        # Add the new device to the device picker
         self.msg_device_picker.Append(device_name)
         if self.msg_device_picker.GetCount() == 1:  # this is the first device, auto-select it
             self.selected_device = device_name
             self.msg_device_picker.Select(0)
-            self.messages.SetObjects(shared.direct_messages[device_name])
+            self.messages.SetObjects(shared.get_direct_messages(device_name))
             if self.messages.GetItemCount() > 0:
                 self.messages.EnsureVisible(self.messages.GetItemCount() - 1)
 
@@ -207,6 +220,7 @@ class DirectMessagesPanel(wx.Panel):
         if index != wx.NOT_FOUND:
             self.msg_device_picker.Delete(index)
         if self.selected_device == device_name:
+            shared.release_direct_view(device_name)
             self.selected_device = None
             self.messages.SetObjects([])
 
@@ -216,31 +230,20 @@ class DirectMessagesPanel(wx.Panel):
         sender = event.sender
         timestamp = event.timestamp
         text = event.message
-        message_dict = {"timestamp": timestamp, "from": sender, "to": device, "message": text}
 
-        # Add message to this panel's "all direct messages" buffer
-        if device not in shared.direct_messages:
-            shared.direct_messages[device] = []
-        shared.direct_messages[device].append(message_dict)
+        # Add message to the shared direct message buffers (all messages and per-node conversation)
+        shared.add_direct_message(device, sender, DirectMessage(timestamp, sender, device, text))
         if device == self.selected_device:
-            self.messages.SetObjects(shared.direct_messages[device], preserveSelection=True)
-            self.messages.EnsureVisible(self.messages.GetItemCount() - 1)
-
-        # Add message to the shared node_conversations buffer
-        if device not in shared.node_conversations:
-            shared.node_conversations[device] = {}
-        if sender not in shared.node_conversations[device]:
-            shared.node_conversations[device][sender] = []
-        shared.node_conversations[device][sender].append(message_dict)
+            shared.refresh_scheduler.mark_dirty(self)
 
         # Tell child windows to update themselves
         for child in self.active_subpanels:
-            wx.PostEvent(child, refresh_panel())
+            shared.refresh_scheduler.mark_dirty(child)
 
         # Log the message
         log_dict = {"device": device, "remote": sender, "timestamp": timestamp,
                        "from": sender, "to": device, "message": text}
-        self._log_message(log_dict)
+        shared.log_direct_message(log_dict)
 
     def child_closed_event(self, event):
         log.debug("Child conversation window closed event")
@@ -248,10 +251,3 @@ class DirectMessagesPanel(wx.Panel):
             self.active_subpanels.remove(event.child)
         except ValueError:
             log.error("Child conversation window is not in active child list")
-
-    @staticmethod
-    def _log_message(message_dict):
-        log.debug("Logging message")
-        with (open(shared.config.get("DIRECT_MESSAGE_LOG", "direct-messages.csv"), "a") as lf):
-            csv.DictWriter(lf, fieldnames=["device", "remote", "timestamp", "from", "to", "message"],
-                           quoting=csv.QUOTE_ALL).writerow(message_dict)
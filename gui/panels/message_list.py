@@ -0,0 +1,40 @@
+# Message list control shared by the channel message, direct message and conversation views
+import logging
+
+from ObjectListView3 import FastObjectListView
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+
+class MessageList(FastObjectListView):
+    # A virtual list, so the control only ever renders the rows on screen. Messages are always shown in arrival
+    # order, so the list isn't sortable, and a new message can be appended without rebuilding the whole list
+    # the way SetObjects (or FastObjectListView.AddObjects, which re-indexes every object) does.
+    def __init__(self, *args, **kwargs):
+        kwargs["sortable"] = False
+        FastObjectListView.__init__(self, *args, **kwargs)
+
+    def AppendObjects(self, messages):
+        # Add messages to the end of the list, redrawing only the new rows
+        first = len(self.modelObjects)
+        self.modelObjects.extend(messages)  # With no filter, innerList is modelObjects
+        if self.objectToIndexMap is not None:
+            for index, message in enumerate(messages, first):
+                self.objectToIndexMap[message] = index
+        self.SetItemCount(len(self.modelObjects))
+        if first < len(self.modelObjects):
+            self.RefreshItems(first, len(self.modelObjects) - 1)
+
+    def ShowNewMessages(self, get_new, get_all):
+        # Bring the list up to date with its messages and scroll to the newest one.
+        # get_new(shown) returns the messages that arrived after the ones the list shows, or None if the list
+        # has to be reloaded (e.g. its buffer was trimmed); get_all() returns all the messages the list should show.
+        new = get_new(self.modelObjects)
+        if new is None:
+            log.debug("Message list out of step with its messages, reloading it")
+            self.SetObjects(get_all(), preserveSelection=True)
+        else:
+            self.AppendObjects(new)
+        if self.GetItemCount() > 0:
+            self.EnsureVisible(self.GetItemCount() - 1)
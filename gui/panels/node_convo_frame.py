@@ -1,12 +1,13 @@
 # "Conversation view" of direct messages between a local local_node_name and a remote node
 import logging
-import csv
 import wx
-from ObjectListView3 import ObjectListView, ColumnDefn
+from ObjectListView3 import ColumnDefn
 from datetime import datetime
 
+from common.message_buffers import DirectMessage
 from gui import shared
-from gui.gui_events import child_closed, EVT_REFRESH_PANEL, refresh_panel, refresh_specific_panel
+from gui.gui_events import child_closed, EVT_REFRESH_PANEL, refresh_specific_panel
+from gui.panels.message_list import MessageList
 
 log = logging.getLogger(__name__)
 # log.setLevel(logging.DEBUG)  # Set our own level separately
@@ -31,16 +32,18 @@ class NodeConvoFrame(wx.Frame):
         messages_label = wx.StaticText(self, wx.ID_ANY, "Messages")
         sizer.Add(messages_label, 0, wx.LEFT | wx.BOTTOM | wx.LEFT, 5)
 
-        self.messages = ObjectListView(self, wx.ID_ANY, style=wx.LC_REPORT | wx.SUNKEN_BORDER)
+        self.messages = MessageList(self, wx.ID_ANY, style=wx.LC_REPORT | wx.SUNKEN_BORDER)
         self.messages.SetColumns([
             ColumnDefn("Timestamp", "left", 150, "timestamp", isEditable=False),
-            ColumnDefn("From", "left", 50, "from", isEditable=False),
-            ColumnDefn("To", "left", 50, "to", isEditable=False),
+            ColumnDefn("From", "left", 50, "from_node", isEditable=False),
+            ColumnDefn("To", "left", 50, "to_node", isEditable=False),
             ColumnDefn("", "left", -1, "message", isEditable=False),
         ])
         self.messages.SetEmptyListMsg("No messages")
-        self.messages.SetObjects(shared.node_conversations[self.local_node_name][self.remote_node_name],
+        self.messages.SetObjects(shared.get_node_conversation(self.local_node_name, self.remote_node_name),
                                  preserveSelection=True)
+        self.messages.Bind(wx.EVT_SCROLLWIN, self.onMessageListScroll)
+        self.messages.Bind(wx.EVT_MOUSEWHEEL, self.onMessageListScroll)
         sizer.Add(self.messages, 4, wx.EXPAND)
 
         send_sizer = wx.BoxSizer(wx.HORIZONTAL)
@@ -82,34 +85,46 @@ class NodeConvoFrame(wx.Frame):
         self.send_text.Clear()
 
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        message_dict = {"timestamp": now, "from": self.local_node_name, "to": self.remote_node_name,
-                        "message": text_to_send}
-        shared.node_conversations[self.local_node_name][self.remote_node_name].append(message_dict)
-        self.messages.SetObjects(shared.node_conversations[self.local_node_name][self.remote_node_name],
-                                 preserveSelection=True)
-        self.messages.EnsureVisible(self.messages.GetItemCount() - 1)
+        message = DirectMessage(now, self.local_node_name, self.remote_node_name, text_to_send)
+        shared.add_direct_message(self.local_node_name, self.remote_node_name, message)
+        self._show_new_messages()
 
-        shared.direct_messages[self.local_node_name].append(message_dict)
-        wx.PostEvent(self.GetParent(), refresh_panel())
+        shared.refresh_scheduler.mark_dirty(self.GetParent())
         wx.PostEvent(self.app_frame, refresh_specific_panel(panel_name="dm"))
         wx.PostEvent(self.app_frame, refresh_specific_panel(panel_name="node"))
 
         log_dict = {"device": self.local_node_name, "remote": self.remote_node_name, "timestamp": now,
                        "from": self.local_node_name, "to": self.remote_node_name, "message": text_to_send}
-        self._log_message(log_dict)
+        shared.log_direct_message(log_dict)
 
         return
 
-    @staticmethod
-    def _log_message(message_dict):
-        log.debug("Logging message")
-        with (open(shared.config.get("DIRECT_MESSAGE_LOG", "direct-messages.csv"), "a") as lf):
-            csv.DictWriter(lf, fieldnames=["device", "remote", "timestamp", "from", "to", "message"],
-                           quoting=csv.QUOTE_ALL).writerow(message_dict)
+    def onMessageListScroll(self, evt):
+        evt.Skip()  # Let the list scroll first, then see if it got to the top
+        wx.CallAfter(self._load_older_if_scrolled_to_top)
+
+    def _show_new_messages(self):
+        device = self.local_node_name
+        remote = self.remote_node_name
+        self.messages.ShowNewMessages(lambda shown: shared.new_conversation_messages(device, remote, shown),
+                                      lambda: shared.get_node_conversation(device, remote))
+
+    def _load_older_if_scrolled_to_top(self):
+        if self.messages.GetItemCount() == 0 or self.messages.GetTopItem() != 0:
+            return
+
+        loaded = shared.load_older_conversation_messages(self.local_node_name, self.remote_node_name,
+                                                         shared.message_page_size)
+        if loaded:
+            log.debug(f"Loaded {loaded} older messages")
+            self.messages.SetObjects(shared.get_node_conversation(self.local_node_name, self.remote_node_name),
+                                     preserveSelection=True)
+            self.messages.EnsureVisible(loaded)  # Keep the message that was at the top in view
 
     # noinspection PyUnusedLocal
     def closeEvent(self, event):
         log.debug("Frame close event")
+        shared.release_conversation_view(self.local_node_name, self.remote_node_name)
         # Tell parent this window is closing
         wx.PostEvent(self.GetParent(), child_closed(child=self))
         self.Destroy()
@@ -117,8 +132,4 @@ class NodeConvoFrame(wx.Frame):
     # noinspection PyUnusedLocal
     def refresh_panel_event(self, event):
         log.debug("Refresh panel event")
-        self.messages.SetObjects(shared.node_conversations[self.local_node_name][self.remote_node_name],
-                                 preserveSelection=True)
-        item_count = self.messages.GetItemCount()
-        if item_count > 0:
-            self.messages.EnsureVisible(item_count - 1)
+        self._show_new_messages()
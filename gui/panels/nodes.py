@@ -2,11 +2,12 @@ import logging
 import wx
 from datetime import datetime
 
-from ObjectListView3 import ObjectListView, ColumnDefn
+from ObjectListView3 import FastObjectListView, ColumnDefn
 
 from gui import shared
+from gui.node_model import NodeListModel, NODE_ADDED, NODE_CHANGED
 from gui.gui_events import (EVT_REFRESH_PANEL, EVT_ADD_DEVICE, EVT_NODE_UPDATED, EVT_CHILD_CLOSED,
-                               EVT_PROCESS_RECEIVED_MESSAGE, refresh_panel, EVT_REMOVE_DEVICE, fake_device_disconnect)
+                               EVT_PROCESS_RECEIVED_MESSAGE, EVT_REMOVE_DEVICE, fake_device_disconnect)
 from gui.panels.node_convo_frame import NodeConvoFrame
 
 log = logging.getLogger(__name__)
@@ -29,7 +30,7 @@ class NodesPanel(wx.Panel):
         sizer.Add(wx.StaticLine(self, wx.ID_ANY), 0, wx.EXPAND | wx.BOTTOM | wx.TOP, 5)
 
         self.node_list_label = wx.StaticText(self, wx.ID_ANY, "Nodes")
-        self.node_list = ObjectListView(self, style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
+        self.node_list = FastObjectListView(self, style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
         self.node_list.SetMinSize(wx.Size(-1, 300))
         self.node_list.SetMaxSize(wx.Size(-1, 300))
         self.node_list.SetColumns([
@@ -91,14 +92,14 @@ class NodesPanel(wx.Panel):
         self.selected_device = None  # Device last selected , so we don't have to call control's method every time
         self.selected_node = None  # Ditto for node last selected
         self.active_subpanels = []  # List of active node conversation frames that will get refreshed on new messages
-        self.node_data = []  # Abbreviated node data for node list
+        self.node_model = NodeListModel()  # Rows of the node list, for the selected device
 
     # === Helpers and utilities
 
     def _show_node_info(self, device_index):
         # TODO: Update this info once every minute or so using a timer event
         log.debug(f"Showing node info for device at index {device_index}")
-        nodeid = self.node_list.GetItemText(device_index, 0)
+        nodeid = self.node_list.GetObjectAt(device_index).nodeid
 
         node = shared.connected_interfaces[self.selected_device].nodes.get(nodeid, None)
         if not node:
@@ -152,20 +153,33 @@ class NodesPanel(wx.Panel):
             return
 
         # Populate the node list
-        self.node_data = []
-        for nodeid, data in shared.connected_interfaces[self.selected_device].nodes.items():
-            node_data_row = {
-                "nodeid": nodeid,
-                "name": data.get("user", {}).get("shortName", "????"),
-                "longname": data.get("user", {}).get("longName", "Unknown"),
-            }
-            self.node_data.append(node_data_row)
-        self.node_list.SetObjects(self.node_data)
-
-        # Update node count
+        self.node_list.SetObjects(self.node_model.load(shared.connected_interfaces[self.selected_device].nodes))
+        self._update_node_count()
+
+    def _update_node_count(self):
         self.node_list_label.SetLabel(f"Nodes ({self.node_list.GetItemCount()})")
         self.Layout()
 
+    def _update_node_row(self, nodeid, node):
+        # Apply one node's update to the list, touching only its row. Selection and scroll position are kept.
+        change, row = self.node_model.update(nodeid, node)
+        if change == NODE_ADDED:
+            selected = self.node_list.GetSelectedObjects()
+            self.node_list.AddObject(row)  # Goes at the end, or in sorted position if the list is sorted
+            if selected and self.node_list.GetSortColumn() is not None:
+                self.node_list.SelectObjects(selected)  # Sorting may have moved the selected row
+            self._update_node_count()
+        elif change == NODE_CHANGED:
+            self.node_list.RefreshObject(row)
+        if row in self.node_list.GetSelectedObjects():
+            self._show_node_info(self.node_list.GetFirstSelected())  # Details like battery level may have changed
+
+    def _remove_node_row(self, nodeid):
+        row = self.node_model.remove(nodeid)
+        if row is not None:
+            self.node_list.RemoveObject(row)
+            self._update_node_count()
+
     # === wxPython events
 
     def onDevicePickerChoice(self, evt):
@@ -189,15 +203,9 @@ class NodesPanel(wx.Panel):
     # noinspection PyUnusedLocal
     def onConvoButton(self, evt):
         log.debug("Conversation view button event")
-        selected_node = self.node_list.GetFirstSelected()
-        node_id = self.node_list.GetItemText(selected_node, 0)
-        node_name = self.node_list.GetItemText(selected_node, 1)
-
-        # Make sure the per-node message buffer is populated enough for the conversation frame to work
-        if self.selected_device not in shared.node_conversations:
-            shared.node_conversations[self.selected_device] = {}
-        if node_name not in shared.node_conversations[self.selected_device]:
-            shared.node_conversations[self.selected_device][node_name] = []
+        selected_node = self.node_list.GetSelectedObject()
+        node_id = selected_node.nodeid
+        node_name = selected_node.name
 
         log.debug(f"Opening conversation view for {node_name} nodeid {node_id}")
         node_convo_frame = NodeConvoFrame(self, self.GetTopLevelParent(),
@@ -213,8 +221,8 @@ class NodesPanel(wx.Panel):
         if confirm == wx.ID_OK:
             log.info(f"Resetting node database on device {self.selected_device}")
             shared.connected_interfaces[self.selected_device].getNode("^local").resetNodeDb()
-            self.node_data = []
-            self.node_list.SetObjects(self.node_data)
+            self.node_model.clear()
+            self.node_list.SetObjects([])
             # Some device types may not generate a node-down pubsub event. Assume this node just rebooted,
             # and fake the disconnect
             wx.PostEvent(self.GetTopLevelParent(),
@@ -226,10 +234,10 @@ class NodesPanel(wx.Panel):
     # noinspection PyUnusedLocal
     def refresh_panel_event(self, event):
         log.debug("Refresh panel event")
-        self.node_list.SetObjects(self.node_data)
+        self.node_list.RefreshObjects()
         self.Layout()
         for child in self.active_subpanels:
-            wx.PostEvent(child, refresh_panel())
+            shared.refresh_scheduler.mark_dirty(child)
 
     # noinspection PyUnusedLocal
     def add_device_event(self, evt):
@@ -255,8 +263,8 @@ class NodesPanel(wx.Panel):
             self.msg_device_picker.Delete(index)
         if self.selected_device == device_name:
             self.selected_device = None
-            self.node_data = []
-            self.node_list.SetObjects(self.node_data)
+            self.node_model.clear()
+            self.node_list.SetObjects([])
             self.node_list_label.SetLabel("Nodes")
             self._clear_node_info()
             self.reset_node_db_button.Disable()
@@ -285,8 +293,12 @@ class NodesPanel(wx.Panel):
             log.error(f"Device name: {device_name}, node number: {node_num}, "
                   f"short_name: {short_name}, long_name: {long_name}")
 
-        # Rather than fiddle around trying to see if the node data already exists in the list, just reload it
-        self._populate_node_list()
+        # Update just this node's row in the list
+        if node_id and device_name == self.selected_device:
+            if node_id in shared.connected_interfaces[device_name].nodes:
+                self._update_node_row(node_id, node)
+            else:
+                self._remove_node_row(node_id)  # Gone from the device's node database
 
         return
 
@@ -295,7 +307,7 @@ class NodesPanel(wx.Panel):
         log.debug("Receive message event")
         # direct_messages panel will handle updating the shared message buffer, just tell children to refresh
         for child in self.active_subpanels:
-            wx.PostEvent(child, refresh_panel())
+            shared.refresh_scheduler.mark_dirty(child)
 
     # noinspection PyUnusedLocal
     def child_closed_event(self, event):
@@ -0,0 +1,58 @@
+# Coalescing, rate-limited panel refreshes
+# Rather than posting a refresh event to a panel every time something changes, callers mark the panel dirty.
+# A timer then sends each dirty panel one refresh event, at most rate_hz times a second, no matter how many
+# times it was marked in between.
+
+import logging
+
+import wx
+
+from gui.gui_events import refresh_panel
+
+log = logging.getLogger(__name__)
+# log.setLevel(logging.DEBUG)  # Set our own level separately
+
+
+class RefreshScheduler:
+    # Must only be used from the GUI thread. owner is the window that owns the timer (normally the main frame).
+    def __init__(self, owner, rate_hz=10):
+        self.interval_ms = int(1000 / rate_hz) if rate_hz > 0 else 0  # 0 = refresh immediately, no coalescing
+
+        self.requests = 0  # Times anything was marked dirty
+        self.refreshes = 0  # Refresh events actually sent
+
+        self._dirty = {}  # key = (window, event class), in the order they were marked. Value unused.
+        self._timer = wx.Timer(owner)
+        owner.Bind(wx.EVT_TIMER, self._on_timer, self._timer)
+
+    def mark_dirty(self, window, event_class=refresh_panel):
+        # Ask for window to get an event_class event on the next tick
+        self.requests += 1
+        if not self.interval_ms:
+            self._send(window, event_class)
+            return
+        self._dirty[(window, event_class)] = None
+        if not self._timer.IsRunning():
+            self._timer.StartOnce(self.interval_ms)
+
+    def stop(self):
+        self._timer.Stop()
+        self._dirty = {}
+        log.info(f"Refresh scheduler stopped: {self.requests} refresh requests, {self.refreshes} refreshes")
+
+    # === Helpers and private functions
+
+    # noinspection PyUnusedLocal
+    def _on_timer(self, event):
+        # A refresh can mark other windows dirty (e.g. a panel refreshing its child windows). Those are handled
+        # in this same tick, and merged with anything already waiting.
+        while self._dirty:
+            window, event_class = next(iter(self._dirty))
+            del self._dirty[(window, event_class)]
+            self._send(window, event_class)
+
+    def _send(self, window, event_class):
+        if not window:
+            return  # Window was destroyed after it was marked
+        self.refreshes += 1
+        window.GetEventHandler().ProcessEvent(event_class())
@@ -1,6 +1,12 @@
 # Data and functions shared between different parts of the GUI app
 
 import logging
+import sys
+import threading
+
+from common.log_reader import read_rows_backward
+from common.node_index import NodeIndex
+from common.message_buffers import DirectMessageTable, ChannelMessage, DirectMessage
 
 log = logging.getLogger(__name__)
 # log.setLevel(logging.DEBUG)  # Set our own level separately
@@ -13,42 +19,27 @@ config = {}
 
 # Mesh interface objects for connected mesh devices
 connected_interfaces = {}  # key = device shortname, value = MeshInterface object for that device
+refresh_scheduler = None  # gui.refresh_scheduler.RefreshScheduler, created by the main frame
+node_indexes = {}  # key = device shortname, value = common.node_index.NodeIndex of that device's nodes
+node_indexes_lock = threading.Lock()  # The ingest worker adds to node_indexes too, see get_node_index
 
 # Message buffers
-node_conversations = {}  # Direct messages grouped by device and remote node shortname
+direct_messages = DirectMessageTable()  # Direct messages, stored once and viewed by device and by remote node
 """
-Either "from" or "to" can be the remote
-node name, based on which direction that particular message was going
-{local node (device) shortname:
-    {remote node shortname:[           
-        {"Timestamp": timestamp,
-         "From": from,
-         "To": to,
-         "Message": message}
-        ]
-    }
-}
-e.g. node_conversations["OJB1"]["nrdW"][0]["message"]
-"""
-direct_messages = {}  # Direct messages grouped by device
-"""
-Simpler buffer for all direct messages regardless of node. 
-{devicename:[           
-    {"Timestamp": timestamp,
-     "From": from,
-     "To": to,
-     "Message": message}
-    ]
-}
+Each direct message is a common.message_buffers.DirectMessage record:
+    .timestamp (.time as integer seconds), .from_node, .to_node, .message
+Either from_node or to_node can be the remote node name, based on which direction that particular message was going.
+
+direct_messages.device_messages(devicename) lists all direct messages on a device regardless of node, and
+direct_messages.conversation_messages(devicename, remote) lists the conversation with one remote node
+e.g. direct_messages.conversation_messages("OJB1", "nrdW")[0].message
 """
 channel_messages = {}  # Non-direct messages (sent to ^all) grouped by device and channel
 """
-channel_messages[devicename][channel] is a list of messages: 
+channel_messages[devicename][channel] is a list of common.message_buffers.ChannelMessage records:
 {devicename:
-    {channel name:[           
-        {"Timestamp": timestamp,
-         "Sender": sender,
-         "Message": message}
+    {channel name:[
+        ChannelMessage(.timestamp (.time as integer seconds), .sender, .message)
         ]
     }
 }
@@ -86,17 +77,336 @@ node_database = {}
 # Channel roles: channel_roles[integer_role_value] is the string value of the role
 channel_roles = ["DISABLED", "PRIMARY", "SECONDARY"]
 
+# Message log files
+channel_log_fields = ["device", "channel", "timestamp", "sender", "message"]
+direct_log_fields = ["device", "remote", "timestamp", "from", "to", "message"]
+message_log_writer = None  # common.log_writer.LogWriter shared by all panels, created at startup
+
+# Optional SQLite message store (common.message_store.MessageStore), opened at startup if MESSAGE_DB is set.
+# When it is open, the message buffers above stay empty and views query the store for their newest
+# message_window messages instead.
+message_store = None
+message_window = 500
+
+# Tail-first loading. When message_load_limit is set, startup loads only that many of the newest messages per
+# channel and per device (direct messages), and older history is paged in from the log as views scroll back.
+message_load_limit = 0  # 0 = load everything at startup
+message_page_size = 100  # Messages paged in per scroll back
+history_cursors = {}  # key = ("channel", device, channel), ("direct", device) or ("conversation", device, remote)
+                      # value = log offset of older history, or None to find it by counting back from the end
+unread_log_offsets = {}  # key = "channel" or "direct", value = log offset startup loading stopped at (default 0)
+view_windows = {}  # With the message store: key as for history_cursors, value = messages shown (default message_window)
+
+# Caps on messages held in memory (0 = no cap). Older messages are dropped from memory ("spilled", since they
+# are still in the message logs) and paged back in from the logs if a view scrolls back to them.
+max_channel_messages = 5000  # Per device and channel
+max_direct_messages = 10000  # Per device
+max_conversation_messages = 2000  # Per device and remote node
+spilled_counts = {}  # key as for history_cursors, value = number of that view's messages spilled to the log
+paged_views = set()  # Keys (as for history_cursors) of views showing history paged in from the logs. Their buffers
+                     # aren't trimmed, so the paged-in messages don't vanish while being read, until the view is
+                     # released (see release_channel_view etc.)
+
 # === Shared functions ===
 
 def find_longname_from_shortname(device, shortname):
     log.debug(f"Finding a node's longname from shortname {shortname}")
-    # Brute force for now: shuffle through the interface's node list looking for the shortname
-    for node_id, node_info in connected_interfaces[device].nodes.items():
-        if node_info.get("user", {}).get("shortName", None) == shortname:
-            longname = node_info.get("user", {}).get("longName", None)
-            if longname:
-                return longname
-            else:
-                return f"Meshtastic {shortname}"  # Node was found but has no longname
+    node = _find_node_from_shortname(device, shortname)
+    if node:
+        longname = node.get("user", {}).get("longName", None)
+        if longname:
+            return longname
+        else:
+            return f"Meshtastic {shortname}"  # Node was found but has no longname
 
     return f"Meshtastic {shortname}"  # Node was not found
+
+def find_nodeid_from_shortname(device, shortname):
+    log.debug(f"Finding nodeid from shortname {shortname}")
+    node = _find_node_from_shortname(device, shortname)
+    if node is None:
+        return None
+    if len(node_indexes[device].nodes_with_shortname(shortname)) > 1:
+        log.warning(f"More than one node on {device} has shortname {shortname}, using the most recently heard")
+    return node.get("user", {}).get("id", None)
+
+def get_node_index(device, interface) -> NodeIndex:
+    # The device's node index, built from the interface's node database the first time it's needed.
+    # Called from both the GUI thread and the ingest worker thread.
+    index = node_indexes.get(device)
+    if index is None:
+        with node_indexes_lock:
+            index = node_indexes.get(device)
+            if index is None:
+                index = node_indexes[device] = NodeIndex(interface.nodes)
+    return index
+
+def forget_node_index(device):
+    # The device disconnected (or reconnected): its node index is built afresh the next time it's needed
+    with node_indexes_lock:
+        node_indexes.pop(device, None)
+
+def _find_node_from_shortname(device, shortname):
+    index = node_indexes.get(device)
+    if index is None:
+        return None
+    return index.by_shortname(shortname)
+
+def log_channel_message(message_dict):
+    # Append a channel message to the channel message log (buffered, see common/log_writer.py)
+    message_log_writer.write(config.get("CHANNEL_MESSAGE_LOG", "channel-messages.csv"), channel_log_fields,
+                             message_dict)
+
+def log_direct_message(message_dict):
+    # Append a direct message to the direct message log (buffered, see common/log_writer.py)
+    message_log_writer.write(config.get("DIRECT_MESSAGE_LOG", "direct-messages.csv"), direct_log_fields,
+                             message_dict)
+
+# Message buffer access. Panels go through these rather than the buffers themselves,
+# so they work the same whether messages live in memory or in the message store.
+
+def add_channel_message(device, channel, message):
+    # message is a ChannelMessage
+    if message_store:
+        message_store.add_channel_message(device, channel, message.timestamp, message.sender, message.message)
+        return
+    buffer = channel_messages.setdefault(sys.intern(device), {}).setdefault(sys.intern(channel), [])
+    buffer.append(message)
+    if (max_channel_messages and len(buffer) > _trim_at(max_channel_messages) and
+            ("channel", device, channel) not in paged_views):
+        excess = len(buffer) - max_channel_messages
+        del buffer[:excess]
+        _spilled(("channel", device, channel), excess)
+
+def get_channel_messages(device, channel, newest=0) -> list:
+    # newest: only return this many of the newest messages (0 = all of them)
+    # Like the other get_ functions, this returns a new list, never the buffer itself: a message list keeps the
+    # list it's given, and mustn't see the buffer grow or get trimmed behind its back.
+    if message_store:
+        return message_store.channel_messages(device, channel,
+                                              newest or view_windows.get(("channel", device, channel), message_window))
+    buffer = channel_messages.get(device, {}).get(channel, [])
+    return buffer[-newest:] if newest else buffer[:]
+
+def new_channel_messages(device, channel, shown):
+    # The messages that arrived after those a view shows (shown, oldest first), or None if the view has to be
+    # reloaded with get_channel_messages (its messages aren't simply the start of what there is now)
+    if message_store:
+        return _stored_after(shown, lambda after_id: message_store.channel_messages_after(device, channel, after_id))
+    buffer = channel_messages.get(device, {}).get(channel, [])
+    return _resident_after(shown, len(buffer), lambda newest: buffer[-newest:])
+
+def channel_message_count(device, channel) -> int:
+    if message_store:
+        return message_store.channel_count(device, channel)
+    return len(channel_messages.get(device, {}).get(channel, ()))
+
+def add_direct_message(device, remote, message):
+    # message is a DirectMessage
+    if message_store:
+        message_store.add_direct_message(device, remote, message.timestamp, message.from_node, message.to_node,
+                                         message.message)
+        return
+    direct_messages.append(sys.intern(device), sys.intern(remote), message)
+    if (max_direct_messages and direct_messages.device_length(device) > _trim_at(max_direct_messages) and
+            ("direct", device) not in paged_views):
+        _spilled(("direct", device), direct_messages.trim_device(device, max_direct_messages))
+    if (max_conversation_messages and
+            direct_messages.conversation_length(device, remote) > _trim_at(max_conversation_messages) and
+            ("conversation", device, remote) not in paged_views):
+        _spilled(("conversation", device, remote), direct_messages.trim_conversation(device, remote,
+                                                                                     max_conversation_messages))
+
+def get_direct_messages(device, newest=0) -> list:
+    if message_store:
+        return message_store.direct_messages(device, newest or view_windows.get(("direct", device), message_window))
+    return direct_messages.device_messages(device, -newest)
+
+def new_direct_messages(device, shown):
+    # As new_channel_messages, for get_direct_messages
+    if message_store:
+        return _stored_after(shown, lambda after_id: message_store.direct_messages_after(device, after_id))
+    return _resident_after(shown, direct_messages.device_length(device),
+                           lambda newest: direct_messages.device_messages(device, -newest))
+
+def direct_message_count(device) -> int:
+    if message_store:
+        return message_store.direct_count(device)
+    return direct_messages.device_length(device)
+
+def get_node_conversation(device, remote, newest=0) -> list:
+    if message_store:
+        return message_store.conversation_messages(device, remote, newest or
+                                                   view_windows.get(("conversation", device, remote), message_window))
+    return direct_messages.conversation_messages(device, remote, -newest)
+
+def new_conversation_messages(device, remote, shown):
+    # As new_channel_messages, for get_node_conversation
+    if message_store:
+        return _stored_after(shown,
+                             lambda after_id: message_store.conversation_messages_after(device, remote, after_id))
+    return _resident_after(shown, direct_messages.conversation_length(device, remote),
+                           lambda newest: direct_messages.conversation_messages(device, remote, -newest))
+
+def node_conversation_count(device, remote) -> int:
+    if message_store:
+        return message_store.conversation_count(device, remote)
+    return direct_messages.conversation_length(device, remote)
+
+def message_counts() -> dict:
+    # Messages held in memory vs. spilled to the message logs
+    return {"channel_resident": sum(len(buffer) for channels in channel_messages.values()
+                                    for buffer in channels.values()),
+            "channel_spilled": sum(count for key, count in spilled_counts.items() if key[0] == "channel"),
+            "direct_resident": direct_messages.resident_count(),
+            "direct_spilled": sum(count for key, count in spilled_counts.items() if key[0] == "direct"),
+            "conversation_spilled": sum(count for key, count in spilled_counts.items() if key[0] == "conversation")}
+
+def _resident_after(shown, count, get_newest):
+    # If the buffer (count messages, get_newest(n) returns the newest n) has only grown at the end since the view
+    # was filled, the messages added since. The buffer's records are the ones the view holds, so the view's
+    # newest message is found by identity.
+    new_count = count - len(shown)
+    if not shown or new_count < 0:
+        return None
+    newest = get_newest(new_count + 1)
+    if len(newest) != new_count + 1 or newest[0] is not shown[-1]:
+        return None  # Trimmed, or older history was paged in
+    return newest[1:]
+
+def _stored_after(shown, get_after):
+    # The store hands out new records for every query, so the view's newest message is found by its row id
+    if not shown:
+        return None
+    return get_after(shown[-1].id)
+
+def _trim_at(cap) -> int:
+    # Buffers are trimmed back to their cap once they pass it by an eighth, rather than one message at a time,
+    # so a steady stream of messages doesn't shift the whole buffer for every new one
+    return cap + cap // 8
+
+def _spilled(key, count):
+    if not count:
+        return
+    spilled_counts[key] = spilled_counts.get(key, 0) + count
+    history_cursors[key] = None  # The view's oldest message moved, so the old cursor would leave a gap
+
+# Paging in older history. Each returns the number of messages added to the front of the view's buffer.
+
+def load_older_channel_messages(device, channel, count) -> int:
+    log.debug(f"Loading older channel messages for {device} {channel}")
+    if message_store:
+        return _grow_view_window(("channel", device, channel), count,
+                                 lambda: get_channel_messages(device, channel))
+
+    older = []
+    for row in _older_log_rows(("channel", device, channel), config.get("CHANNEL_MESSAGE_LOG", "channel-messages.csv"),
+                               channel_log_fields, lambda r: r["device"] == device and r["channel"] == channel, count):
+        older.append(ChannelMessage(row["timestamp"], row["sender"], row["message"]))
+    older.reverse()
+    buffer = channel_messages.setdefault(sys.intern(device), {}).setdefault(sys.intern(channel), [])
+    buffer[:0] = older
+    return _paged_in(("channel", device, channel), len(older))
+
+def load_older_direct_messages(device, count) -> int:
+    log.debug(f"Loading older direct messages for {device}")
+    if message_store:
+        return _grow_view_window(("direct", device), count, lambda: get_direct_messages(device))
+
+    older = []
+    for row in _older_log_rows(("direct", device), config.get("DIRECT_MESSAGE_LOG", "direct-messages.csv"),
+                               direct_log_fields, lambda r: r["device"] == device, count):
+        older.append(DirectMessage(row["timestamp"], row["from"], row["to"], row["message"]))
+    older.reverse()
+    direct_messages.prepend_device(device, older)
+    return _paged_in(("direct", device), len(older))
+
+def load_older_conversation_messages(device, remote, count) -> int:
+    log.debug(f"Loading older conversation messages for {device} {remote}")
+    if message_store:
+        return _grow_view_window(("conversation", device, remote), count,
+                                 lambda: get_node_conversation(device, remote))
+
+    older = []
+    for row in _older_log_rows(("conversation", device, remote),
+                               config.get("DIRECT_MESSAGE_LOG", "direct-messages.csv"), direct_log_fields,
+                               lambda r: r["device"] == device and r["remote"] == remote, count):
+        older.append(DirectMessage(row["timestamp"], row["from"], row["to"], row["message"]))
+    older.reverse()
+    direct_messages.prepend_conversation(device, remote, older)
+    return _paged_in(("conversation", device, remote), len(older))
+
+# Releasing views. Called when a message list stops showing a view (another one is picked, or it's closed), so its
+# buffer can be trimmed back to its cap again and, with the message store, it goes back to message_window messages.
+
+def release_channel_view(device, channel):
+    _release_view(("channel", device, channel))
+
+def release_direct_view(device):
+    _release_view(("direct", device))
+
+def release_conversation_view(device, remote):
+    _release_view(("conversation", device, remote))
+
+def _paged_in(key, count) -> int:
+    if count:
+        paged_views.add(key)
+    return count
+
+def _release_view(key):
+    paged_views.discard(key)
+    view_windows.pop(key, None)
+
+def _grow_view_window(key, count, get_view) -> int:
+    before = len(get_view())
+    view_windows[key] = view_windows.get(key, message_window) + count
+    return len(get_view()) - before
+
+def _older_log_rows(key, filename, fieldnames, wanted, count):
+    # Generator yielding up to <count> wanted rows, newest first, from the log history before this view's cursor
+    cursor = _history_cursor(key)
+    if cursor == 0:
+        return  # Already at the start of the log
+
+    skip = 0
+    if cursor is None:
+        # Find where the view's history starts by counting its resident messages back from the end of the log
+        if message_log_writer:
+            message_log_writer.flush(filename)
+        skip = _resident_length(key)
+
+    found = 0
+    try:
+        for offset, row in read_rows_backward(filename, fieldnames, cursor):
+            if wanted(row):
+                if skip:
+                    skip -= 1
+                    continue
+                yield row
+                found += 1
+                cursor = offset
+                if found == count:
+                    break
+        else:
+            cursor = 0
+    except FileNotFoundError:
+        cursor = 0
+    history_cursors[key] = cursor
+    if key in spilled_counts:
+        spilled_counts[key] = max(0, spilled_counts[key] - found)
+
+def _history_cursor(key):
+    if key in history_cursors:
+        return history_cursors[key]
+    if key[0] == "conversation":
+        # Conversations were loaded along with their device's direct messages. If that load stopped short
+        # of the start of the log, count back to find where this conversation's history begins.
+        return None if unread_log_offsets.get("direct", 0) else 0
+    return unread_log_offsets.get(key[0], 0)
+
+def _resident_length(key) -> int:
+    if key[0] == "channel":
+        return len(channel_messages.get(key[1], {}).get(key[2], []))
+    if key[0] == "direct":
+        return direct_messages.device_length(key[1])
+    return direct_messages.conversation_length(key[1], key[2])
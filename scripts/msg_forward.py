@@ -1,111 +1,240 @@
 # Forward direct messages to email, and log all messages
 
+import argparse
 import logging
 import os
+import signal
 import sys
+import threading
+import time
 from pubsub import pub
-from enum import Enum, unique
 
 import survey
 from dotenv import load_dotenv
 
 from common.mesh_managers import DeviceManager, InterfaceError, Unimplemented
-from common.email_interface import send_email
+from common.reconnect import STATE_OPEN
+from common.email_interface import EmailSender
+from common.email_spool import EmailSpool
+from common.email_digest import EmailDigest
+from common.packet_parser import PacketParser, MessageType
 
-# Since we don't get constants or #DEFINEs in Python, we make due with enumerations
-@unique
-class MessageType(Enum):  # Define constants for message type, since they will be used in several places
-    DIRECT_MESSAGE = "Direct"  # A message sent directly to a node
-    BROADCAST_MESSAGE = "Broadcast"  # A message sent to "^all" on a channel
-    PASSTHRU_MESSAGE = "Passthru"  # A message destined for another specific node; we should never see this
+packet_parser = PacketParser()  # Caches each interface's node ID and shortname
+email_sender = None  # Sends forwarded messages in the background, set up in main()
+email_digest = None  # Batches forwarded messages into digests, if EMAIL_DIGEST_SECONDS is set
 
-# === Event handlers ===
+forwarding_engine = None  # Handles incoming messages, set up in main()
 
-# Incoming message
-def onIncomingMessage(packet, interface):
-    # TODO: Move packet parsing to a separate function, this is getting a bit long
-    msg_log_name = os.getenv("MSG_LOG_NAME")  # Where the messages themselves get logged (flat file)
+log = logging.getLogger(__name__)
 
-    log = logging.getLogger(__name__)
-    log.info("Received incoming message")
-    log.debug(packet)
+# === Message handling ===
 
-    my_node_id = interface.getMyNodeInfo().get("user", {}).get("id", "unknown")
-    our_shortname = interface.getShortName()
+class ForwardingEngine:
+    # Logs every incoming text message and forwards direct messages to email. Settings are read once (and again
+    # by reload()), and the message log is kept open, so each message costs the same however many arrive.
+    # The message log is written through a buffer, flushed at most flush_seconds after a message is written.
+    #
+    # The time spent on each message is totalled by stage: parse (packet to TextMessage), log (console and
+    # message log) and forward (handing direct messages to the email sender or digest).
+    stages = ("parse", "log", "forward")
 
-    text_message = packet.get("decoded", {}).get("text", "Unknown text")
+    def __init__(self, forwarder, parser, flush_seconds=1.0):
+        self.forwarder = forwarder  # EmailSender or EmailDigest
+        self.parser = parser
+        self.flush_seconds = flush_seconds
 
-    if "raw" in packet and hasattr(packet["raw"], "channel"):
-        channel = packet["raw"].channel
-    else:
-        channel = "Unknown"
+        self.messages = 0
+        self.forwarded = 0
+        self.stage_seconds = dict.fromkeys(self.stages, 0.0)
+        self.stage_max = dict.fromkeys(self.stages, 0.0)
 
-    if "fromId" in packet and packet["fromId"] is not None:
-        from_shortname = interface.nodes[packet["fromId"]].get("user", {}).get("shortName", "Unknown")
-        from_longname = interface.nodes[packet["fromId"]].get("user", {}).get("longName", "Unknown")
-    else:
-        from_shortname = "unknown"
-        from_longname = "unknown"
-
-    to_id = packet.get("toId", "Unknown ToId")
-    if to_id == my_node_id:
-        message_type = MessageType.DIRECT_MESSAGE
-    elif to_id == "^all":
-        message_type = MessageType.BROADCAST_MESSAGE
-    else:
-        message_type = MessageType.PASSTHRU_MESSAGE  # Belt and suspenders, we shouldn't see one of these
-
-    msg_line = (f"Text Message on interface {our_shortname} channel {channel}:\n"
-                f"   From node {from_longname} ({from_shortname}) type {message_type.value}:\n"
-                f"   {text_message}")
-    log.debug(msg_line)
-    print(msg_line)
-    with open(msg_log_name, "a") as f:
-        f.write(msg_line)
-
-    if message_type == MessageType.DIRECT_MESSAGE:
-        print("forwarding to email")
-        log.info("forwarding to email")
-        try:
-            # TODO: Probably better to get these values in email_interface
-            smtp_server = os.getenv("SMTP_SERVER")
-            smtp_sender = os.getenv("SMTP_SENDER")
-            smtp_password = os.getenv("SMTP_PASSWORD")
-            email_from_address = os.getenv("EMAIL_FROM_ADDRESS")
-            email_to_address = os.getenv("EMAIL_TO_ADDRESS")
-            send_email(smtp_server, smtp_sender, smtp_password,
-                       email_from_address, email_to_address,
-                       f"Mesh: direct message from {from_longname}", msg_line)
-            del smtp_password
-        except Exception as e:
-            log.error(e)
-            print(f"Forward to email failed; exception {e}")
+        self.msg_log_name = None
+        self.email_from_address = None
+        self.email_to_address = None
+        self._msg_log = None
+        self._flush_timer = None
+        self._lock = threading.Lock()  # Messages arrive on each device's reader thread
+        self._load_settings()
+
+    def reload(self):
+        # Reread settings from .env, reopening the message log if it moved
+        load_dotenv(override=True)
+        self._load_settings()
+
+    def handle(self, packet, interface):
+        log.info("Received incoming message")
+        log.debug(packet)
+
+        start = time.perf_counter()
+        message = self.parser.parse(packet, interface)
+        if message.from_id is not None:
+            from_shortname = message.from_shortname or "Unknown"
+            from_longname = message.from_longname or "Unknown"
         else:
-            print("Message forwarded")
-            log.info("Message forwarded")
+            from_shortname = "unknown"
+            from_longname = "unknown"
+        msg_line = (f"Text Message on interface {message.device} channel {message.channel}:\n"
+                    f"   From node {from_longname} ({from_shortname}) type {message.message_type.value}:\n"
+                    f"   {message.text}")
+        parsed = time.perf_counter()
+
+        log.debug(msg_line)
+        print(msg_line)
+        with self._lock:
+            self.messages += 1
+            if self._msg_log:  # None if MSG_LOG_NAME isn't set, or after close()
+                self._msg_log.write(msg_line + "\n")
+                if self._flush_timer is None:
+                    self._flush_timer = threading.Timer(self.flush_seconds, self.flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+        logged = time.perf_counter()
+
+        if message.message_type == MessageType.DIRECT_MESSAGE:
+            print("forwarding to email")
+            log.info("forwarding to email")
+            # Only queued here, the sender thread does the SMTP work so we don't hold up the radio reader thread
+            if self.forwarder.send(self.email_from_address, self.email_to_address,
+                                   f"Mesh: direct message from {from_longname}", msg_line):
+                self.forwarded += 1
+                print("Message queued for forwarding")
+            else:
+                print("Forward to email failed; unable to queue it")
+        forwarded = time.perf_counter()
+
+        with self._lock:
+            self._time_stage("parse", parsed - start)
+            self._time_stage("log", logged - parsed)
+            self._time_stage("forward", forwarded - logged)
+
+    def flush(self):
+        with self._lock:
+            self._flush_timer = None
+            if self._msg_log:
+                self._msg_log.flush()
+
+    def close(self):
+        with self._lock:
+            if self._flush_timer:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._close_msg_log()
+        log.info(f"Forwarding engine closed: {self.stats()}")
+
+    def stats(self) -> dict:
+        # Message counts, and average and longest time per stage in microseconds
+        stats = {"messages": self.messages, "forwarded": self.forwarded}
+        for stage in self.stages:
+            average = self.stage_seconds[stage] / self.messages if self.messages else 0.0
+            stats[f"{stage}_us"] = round(average * 1e6, 1)
+            stats[f"{stage}_max_us"] = round(self.stage_max[stage] * 1e6, 1)
+        return stats
+
+    # === Helpers and private functions
+
+    def _load_settings(self):
+        with self._lock:
+            self.email_from_address = os.getenv("EMAIL_FROM_ADDRESS")
+            self.email_to_address = os.getenv("EMAIL_TO_ADDRESS")
+            msg_log_name = os.getenv("MSG_LOG_NAME")  # Where the messages themselves get logged (flat file)
+            if msg_log_name != self.msg_log_name:
+                self._close_msg_log()
+                self.msg_log_name = msg_log_name
+                if msg_log_name:
+                    self._msg_log = open(msg_log_name, "a", buffering=64 * 1024)
+        log.info(f"Forwarding settings loaded: message log {self.msg_log_name}, email to {self.email_to_address}")
+
+    # Callers must hold self._lock for these
+
+    def _time_stage(self, stage, seconds):
+        self.stage_seconds[stage] += seconds
+        if seconds > self.stage_max[stage]:
+            self.stage_max[stage] = seconds
+
+    def _close_msg_log(self):
+        if self._msg_log:
+            self._msg_log.close()
+            self._msg_log = None
+
+# === Event handlers ===
+
+# Incoming message
+def onIncomingMessage(packet, interface):
+    forwarding_engine.handle(packet, interface)
 
 def onConnectionUp(interface):
     print(f"Connection established on interface {interface.getShortName()}")
     return
 
 def onConnectionDown(interface):
-    print(f"Connection lost on interface {interface.getShortName()}")
+    print(f"Connection lost on interface {interface.getShortName()}")  # DeviceManager reconnects, in daemon mode
     return
 
-def main():
-    load_dotenv()
-    app_log_name = os.getenv("APP_LOG_NAME")  # Application log messages (logger)
+# === Daemon mode ===
 
-    logging.basicConfig(level=logging.INFO, format='%(levelname)s: [%(name)s] %(module)s.%(funcName)s %(message)s',
-                        filename=app_log_name, filemode='a')  # Configure root logger
-    log = logging.getLogger(__name__)
-    log.setLevel(logging.DEBUG)  # Set our own level separately
-    logging.getLogger("bleak").setLevel(logging.INFO)  # Turn off BLE debug info
-    # Sadly, meshtastic logging runs from the root logger, so there's likely no way to set that separately
+def run_daemon(device_manager):
+    # Forward messages from every configured device (FORWARD_DEVICES), or every device we can find, until
+    # SIGTERM or SIGINT
+    stopping = threading.Event()
+    def onSignal(signum, frame):
+        log.info(f"Received signal {signum}, shutting down")
+        stopping.set()
+    signal.signal(signal.SIGTERM, onSignal)
+    signal.signal(signal.SIGINT, onSignal)
+    if hasattr(signal, "SIGHUP"):  # Not on Windows
+        signal.signal(signal.SIGHUP, lambda signum, frame: forwarding_engine.reload())
 
-    device_manager = DeviceManager()
+    devices = _configured_devices(device_manager)
+    if devices is None:
+        log.debug("Finding all devices")
+        devices = device_manager.find_all_available_devices()
+    if not devices:
+        print("No devices found, exiting")
+        log.error("No devices found")
+        return 1
+
+    # Each device is connected in the background, retried until it connects, and reconnected if it drops
+    names = {(interface_type, address): name for interface_type, address, name in devices}
+    close_timeout = float(os.getenv("CLOSE_TIMEOUT_SECONDS", "15"))
+
+    def onConnected(interface_type, address, old_interface, interface):
+        print(f"Connected to {interface_type} device {names[(interface_type, address)]}")
 
-    # Find all available devices and list them
+    def onStateChange(interface_type, address, state):
+        if state == STATE_OPEN:
+            print(f"Can't reach {interface_type} device {names[(interface_type, address)]}, trying less often")
+
+    device_manager.enable_auto_reconnect(on_reconnected=onConnected, on_state_change=onStateChange,
+                                         base_delay=float(os.getenv("RECONNECT_SECONDS", "10")),
+                                         max_delay=float(os.getenv("RECONNECT_MAX_SECONDS", "300")),
+                                         close_timeout=close_timeout)
+    for interface_type, address, name in devices:
+        device_manager.connect_supervised(interface_type, address)
+    print(f"Forwarding messages from {len(devices)} devices: {', '.join(names.values())}")
+
+    stopping.wait()
+
+    # Close all the connections at once, but don't let a hung close() keep us from exiting
+    print("Disconnecting")
+    deadline = time.monotonic() + close_timeout
+    supervisor = device_manager.reconnect_supervisor
+    # No more reconnects. Wait for any in progress to finish (one connecting now closes its own new connection), so
+    # interfaces() holds every connection still open.
+    if not supervisor.stop(timeout=max(0.0, deadline - time.monotonic())):
+        log.warning("Timed out waiting for reconnects to finish")
+    closers = []
+    for interface in supervisor.interfaces():
+        closer = threading.Thread(target=_close_quietly, args=(interface,), name="close", daemon=True)
+        closer.start()
+        closers.append((interface, closer))
+    for interface, closer in closers:
+        closer.join(max(0.0, deadline - time.monotonic()))
+        if closer.is_alive():
+            log.warning(f"Timed out disconnecting from {interface.getShortName()}")
+    return 0
+
+def run_interactive(device_manager):
+    # Pick one device from the ones we can find and forward its messages until told to quit
     log.debug("Finding all devices")
     devices = device_manager.find_all_available_devices()
     shortnames = [name for (typ, address, name) in devices]
@@ -113,12 +242,7 @@ def main():
         index = survey.routines.select('Choose a device: ', options=shortnames, focus_mark = '> ')
     else:
         print("No devices found, exiting")
-        sys.exit(1)
-
-    # Subscribe to relevant pubsub topics
-    pub.subscribe(onConnectionUp, "meshtastic.connection.established")
-    pub.subscribe(onConnectionDown, "meshtastic.connection.lost")
-    pub.subscribe(onIncomingMessage, "meshtastic.receive.text")
+        return 1
 
     # Connect to the selected device
     (interface_type, address, name) = devices[index]
@@ -127,7 +251,13 @@ def main():
         interface = device_manager.connect_to_specific_device(interface_type, address)
         response = ""
         while response != "quit":
-            response = survey.routines.input("Enter 'quit' to exit or anything else to be ignored\n")
+            response = survey.routines.input("Enter 'quit' to exit, 'status' for forwarding status, 'reload' to "
+                                             "reload settings or anything else to be ignored\n")
+            if response == "status":
+                print(f"Messages: {forwarding_engine.stats()}")
+                print(f"Email forwarding: {email_sender.stats()}")
+            elif response == "reload":
+                forwarding_engine.reload()
     except Unimplemented:
         print(f"Unimplemented interface type: {interface_type}")
     except InterfaceError as e:
@@ -138,6 +268,88 @@ def main():
         if interface:
             print(f"Disconnecting from {interface.getShortName()}")
             interface.close()  # *** close() hangs on disconnect at the present time
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Forward direct messages to email, and log all messages")
+    parser.add_argument("--daemon", action="store_true",
+                        help="run without prompts, forwarding from every device in FORWARD_DEVICES "
+                             "(or every device found) until stopped with SIGTERM")
+    args = parser.parse_args()
+
+    load_dotenv()
+    app_log_name = os.getenv("APP_LOG_NAME")  # Application log messages (logger)
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: [%(name)s] %(module)s.%(funcName)s %(message)s',
+                        filename=app_log_name, filemode='a')  # Configure root logger
+    log = logging.getLogger(__name__)
+    log.setLevel(logging.DEBUG)  # Set our own level separately
+    logging.getLogger("bleak").setLevel(logging.INFO)  # Turn off BLE debug info
+    # Sadly, meshtastic logging runs from the root logger, so there's likely no way to set that separately
+
+    # Forwarded messages are spooled to disk first, so they aren't lost if the SMTP server is unreachable
+    # (or we exit) before they're sent. EMAIL_SPOOL_DIR= (empty) keeps them in memory only.
+    spool_dir = os.getenv("EMAIL_SPOOL_DIR", "email_spool")
+    global email_sender
+    email_sender = EmailSender(os.getenv("SMTP_SERVER"), os.getenv("SMTP_SENDER"), os.getenv("SMTP_PASSWORD"),
+                               port=int(os.getenv("SMTP_PORT", "465")),
+                               use_ssl=os.getenv("SMTP_SSL", "true").lower() == "true",
+                               max_queue=int(os.getenv("EMAIL_QUEUE_SIZE", "100")),
+                               idle_seconds=float(os.getenv("SMTP_IDLE_SECONDS", "60")),
+                               spool=EmailSpool(spool_dir) if spool_dir else None,
+                               max_retry_seconds=float(os.getenv("EMAIL_MAX_RETRY_SECONDS", "300")))
+    digest_seconds = float(os.getenv("EMAIL_DIGEST_SECONDS", "0"))
+    if digest_seconds > 0:
+        global email_digest
+        email_digest = EmailDigest(email_sender, window_seconds=digest_seconds,
+                                   max_messages=int(os.getenv("EMAIL_DIGEST_MAX_MESSAGES", "20")),
+                                   max_latency_seconds=float(os.getenv("EMAIL_DIGEST_MAX_LATENCY", "300")),
+                                   subject_format="Mesh: {count} direct messages")
+    global forwarding_engine
+    forwarding_engine = ForwardingEngine(email_digest or email_sender, packet_parser)
+
+    device_manager = DeviceManager()
+
+    # Subscribe to relevant pubsub topics
+    pub.subscribe(onConnectionUp, "meshtastic.connection.established")
+    pub.subscribe(onConnectionDown, "meshtastic.connection.lost")
+    pub.subscribe(onIncomingMessage, "meshtastic.receive.text")
+
+    try:
+        if args.daemon:
+            status = run_daemon(device_manager)
+        else:
+            status = run_interactive(device_manager)
+    finally:
+        forwarding_engine.close()
+        if email_digest:
+            email_digest.close()  # Sends what it's holding, before the sender stops
+        print("Sending any queued email" if email_sender.spool is None else "Stopping email forwarding")
+        email_sender.close()
+    sys.exit(status)
+
+# === Helpers and private functions
+
+def _close_quietly(interface):
+    try:
+        interface.close()  # *** close() hangs on disconnect at the present time (BLE)
+    except Exception as e:
+        log.warning(f"Error closing {interface.getShortName()}: {e}")
+
+def _configured_devices(device_manager):
+    # Devices listed in FORWARD_DEVICES (type:address,type:address...), as (type, address, name) tuples like
+    # find_all_available_devices() gives. None if FORWARD_DEVICES isn't set.
+    setting = os.getenv("FORWARD_DEVICES", "").strip()
+    if not setting:
+        return None
+    devices = []
+    for entry in setting.split(","):
+        interface_type, _, address = entry.strip().partition(":")
+        if interface_type not in device_manager.supported_interface_types or not address:
+            raise InterfaceError(f"FORWARD_DEVICES entry {entry} must be type:address, with type one of "
+                                 f"{str(device_manager.supported_interface_types)}")
+        devices.append((interface_type, address, address))
+    return devices
 
 if __name__ == "__main__":
     main()
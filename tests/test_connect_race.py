@@ -0,0 +1,102 @@
+# DeviceManager's racing connects, with fake devices that take a set time to connect
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+try:
+    from common import mesh_managers
+except ImportError:  # pubsub and meshtastic aren't installed
+    mesh_managers = None
+
+
+class FakeInterface:
+    def __init__(self, name):
+        self.name = name
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+
+@unittest.skipIf(mesh_managers is None, "needs pubsub and meshtastic")
+class RaceConnectTest(unittest.TestCase):
+    def make_device_manager(self, connect_seconds):
+        # connect_seconds: key = (type, address) of each device found, value = how long it takes to connect
+        # (None: it fails)
+        self.interfaces = {}
+
+        def iter_available_devices(interface_types):
+            for i_type in interface_types:
+                yield i_type, [(t, address, address) for t, address in connect_seconds if t == i_type], None
+
+        def connect(interface_type, address):
+            seconds = connect_seconds[(interface_type, address)]
+            if seconds is None:
+                time.sleep(0.01)
+                raise OSError("Device not found")
+            interface = self.interfaces[address] = FakeInterface(address)
+            time.sleep(seconds)
+            return interface
+
+        device_manager = mesh_managers.DeviceManager()
+        for name, replacement in (("iter_available_devices", iter_available_devices),
+                                  ("connect_to_specific_device", connect)):
+            patcher = mock.patch.object(device_manager, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return device_manager
+
+    def assert_closed(self, address):
+        self.assertTrue(self.interfaces[address].closed.wait(5), f"{address} wasn't closed")
+
+    def test_first_to_connect_wins_on_one_type(self):
+        device_manager = self.make_device_manager({("tcp", "slow"): 0.3, ("tcp", "fast"): 0.0, ("tcp", "gone"): None})
+
+        self.assertEqual(device_manager.connect_to_first_device_on_type("tcp").name, "fast")
+        self.assert_closed("slow")
+
+    def test_preferred_type_connecting_within_grace_is_kept(self):
+        device_manager = self.make_device_manager({("serial", "usb"): 0.2, ("tcp", "radio"): 0.0})
+
+        interface = device_manager.connect_to_first_available_device(["serial", "tcp"], priority_grace=2.0)
+        self.assertEqual(interface.name, "usb")
+        self.assert_closed("radio")
+        self.assertFalse(interface.closed.is_set())
+
+    def test_preferred_type_too_slow_for_grace_loses(self):
+        device_manager = self.make_device_manager({("serial", "usb"): 0.5, ("tcp", "radio"): 0.0})
+
+        started = time.monotonic()
+        interface = device_manager.connect_to_first_available_device(["serial", "tcp"], priority_grace=0.1)
+        self.assertEqual(interface.name, "radio")
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assert_closed("usb")
+
+    def test_preferred_type_is_kept_without_waiting(self):
+        device_manager = self.make_device_manager({("serial", "usb"): 0.0, ("tcp", "radio"): 0.5})
+
+        started = time.monotonic()
+        interface = device_manager.connect_to_first_available_device(["serial", "tcp"], priority_grace=2.0)
+        self.assertEqual(interface.name, "usb")
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assert_closed("radio")
+
+    def test_no_wait_once_a_preferred_type_has_failed(self):
+        device_manager = self.make_device_manager({("serial", "usb"): None, ("tcp", "radio"): 0.0})
+
+        started = time.monotonic()
+        interface = device_manager.connect_to_first_available_device(["serial", "tcp"], priority_grace=2.0)
+        self.assertEqual(interface.name, "radio")
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_timeout_with_no_connection(self):
+        device_manager = self.make_device_manager({("tcp", "slow"): 0.5})
+
+        self.assertIsNone(device_manager.connect_to_first_device_on_type("tcp", timeout=0.1))
+        self.assert_closed("slow")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+# EmailDigest with a fake sender and a fake clock
+
+import threading
+import unittest
+
+from common.email_digest import EmailDigest
+
+
+class FakeSender:
+    def __init__(self):
+        self.sent = []  # of (to address, subject, body)
+
+    def send(self, from_address, to_address, subject, body):
+        self.sent.append((to_address, subject, body))
+        return True
+
+
+class FakeTime:
+    # clock and wait for a digest. The digest's worker waits until advance() moves the clock on, and advance()
+    # returns once the worker has caught up and is waiting again.
+    def __init__(self):
+        self.now = 0.0
+        self.waits = []
+        self._turn = threading.Condition()
+        self._waiting = False
+        self._stopped = False
+
+    def clock(self):
+        return self.now
+
+    def wait(self, seconds):
+        with self._turn:
+            self.waits.append(seconds)
+            self._waiting = True
+            self._turn.notify_all()
+            self._turn.wait_for(lambda: not self._waiting or self._stopped)
+
+    def advance(self, seconds):
+        with self._turn:
+            assert self._turn.wait_for(lambda: self._waiting, 5)
+            self.now += seconds
+            self._waiting = False
+            self._turn.notify_all()
+            assert self._turn.wait_for(lambda: self._waiting, 5)
+
+    def stop(self):
+        # Let the worker run freely from now on, e.g. so the digest can close
+        with self._turn:
+            self._stopped = True
+            self._turn.notify_all()
+
+
+class EmailDigestTest(unittest.TestCase):
+    def make_digest(self, **options):
+        self.sender = FakeSender()
+        self.time = FakeTime()
+        digest = EmailDigest(self.sender, clock=self.time.clock, wait=self.time.wait, **options)
+        self.addCleanup(digest.close, 1.0)
+        self.addCleanup(self.time.stop)
+        return digest
+
+    def sent_subjects(self):
+        return [subject for to_address, subject, body in self.sender.sent]
+
+    def test_sent_once_things_go_quiet(self):
+        digest = self.make_digest(window_seconds=60)
+        digest.send("mesh", "a@example.com", "Message 1", "Hello")
+        self.time.advance(30)
+        digest.send("mesh", "a@example.com", "Message 2", "Hello again")
+        self.time.advance(59)  # 59s since the last message
+        self.assertEqual(self.sender.sent, [])
+
+        self.time.advance(1)
+        self.assertEqual(self.sent_subjects(), ["2 messages"])
+        to_address, subject, body = self.sender.sent[0]
+        self.assertEqual(to_address, "a@example.com")
+        self.assertIn("Message 1\nHello", body)
+        self.assertIn("Message 2\nHello again", body)
+        self.assertEqual(self.time.waits[-2:], [1.0, None])
+
+    def test_single_message_is_sent_as_it_came(self):
+        digest = self.make_digest(window_seconds=60)
+        digest.send("mesh", "a@example.com", "Message 1", "Hello")
+        self.time.advance(60)
+
+        self.assertEqual(self.sender.sent, [("a@example.com", "Message 1", "Hello")])
+
+    def test_sent_when_full(self):
+        digest = self.make_digest(window_seconds=60, max_messages=3, subject_format="Mesh: {count} messages")
+        for n in range(1, 4):
+            self.assertTrue(digest.send("mesh", "a@example.com", f"Message {n}", "Hello"))
+
+        self.assertEqual(self.sent_subjects(), ["Mesh: 3 messages"])  # Straight away, without waiting
+        self.assertEqual(digest.digests, 1)
+
+    def test_steady_trickle_is_sent_after_max_latency(self):
+        digest = self.make_digest(window_seconds=60, max_latency_seconds=150)
+        for n in range(1, 4):
+            self.time.advance(0 if n == 1 else 50)
+            digest.send("mesh", "a@example.com", f"Message {n}", "Hello")
+        self.time.advance(49)
+        self.assertEqual(self.sender.sent, [])  # 149s since the first message, but only 49s since the last
+
+        self.time.advance(1)
+        self.assertEqual(self.sent_subjects(), ["3 messages"])
+
+    def test_recipients_get_separate_digests(self):
+        digest = self.make_digest(window_seconds=60)
+        digest.send("mesh", "a@example.com", "Message 1", "Hello")
+        self.time.advance(30)
+        digest.send("mesh", "b@example.com", "Message 2", "Hello")
+        self.time.advance(30)
+        self.assertEqual(self.sender.sent, [("a@example.com", "Message 1", "Hello")])
+
+        self.time.advance(30)
+        self.assertEqual(self.sender.sent[1], ("b@example.com", "Message 2", "Hello"))
+
+    def test_close_sends_whatever_is_waiting(self):
+        digest = self.make_digest(window_seconds=60)
+        digest.send("mesh", "a@example.com", "Message 1", "Hello")
+        digest.send("mesh", "a@example.com", "Message 2", "Hello")
+        digest.send("mesh", "b@example.com", "Message 3", "Hello")
+
+        self.time.stop()
+        digest.close(1.0)
+        self.assertEqual(sorted(self.sent_subjects()), ["2 messages", "Message 3"])
+
+        digest.send("mesh", "a@example.com", "Message 4", "Hello")  # After closing, sent as it comes
+        self.assertEqual(self.sent_subjects()[-1], "Message 4")
+        self.assertEqual((digest.messages, digest.digests), (3, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
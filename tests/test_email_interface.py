@@ -0,0 +1,180 @@
+# EmailSender against a stand-in SMTP server on localhost
+
+import os
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+
+from common.email_interface import EmailSender
+from common.email_spool import EmailSpool
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    # Just enough SMTP for smtplib. Replies can be changed while the server runs:
+    #   rcpt_reply: reply to RCPT TO, e.g. "550 No such user"
+    #   auth_reply: reply to AUTH
+    #   drop_after_message: close the connection after each message is accepted
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.port = self.server_address[1]
+        self.rcpt_reply = "250 OK"
+        self.auth_reply = "235 Authenticated"
+        self.drop_after_message = False
+        self.messages = []
+        self.connections = 0
+        self.quits = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply("220 localhost fake SMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip().upper()
+            if command.startswith("EHLO"):
+                self.reply("250-localhost", "250-AUTH PLAIN", "250 8BITMIME")
+            elif command.startswith("HELO") or command.startswith("MAIL") or command.startswith("RSET") or \
+                    command.startswith("NOOP"):
+                self.reply("250 OK")
+            elif command.startswith("AUTH"):
+                self.reply(server.auth_reply)
+            elif command.startswith("RCPT"):
+                self.reply(server.rcpt_reply)
+            elif command.startswith("DATA"):
+                self.reply("354 Go ahead")
+                data = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line == b".\r\n":
+                        break
+                    data.append(data_line)
+                server.messages.append(b"".join(data).decode())
+                self.reply("250 Queued")
+                if server.drop_after_message:
+                    return
+            elif command.startswith("QUIT"):
+                server.quits += 1
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Not implemented")
+
+    def reply(self, *lines):
+        self.wfile.write("".join(f"{line}\r\n" for line in lines).encode())
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+class EmailSenderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServer()
+        self.senders = []
+
+    def tearDown(self):
+        for sender in self.senders:
+            sender.close(timeout=5)
+        self.server.stop()
+
+    def make_sender(self, **options):
+        options.setdefault("idle_seconds", 30)
+        options.setdefault("retry_seconds", 0.05)
+        sender = EmailSender("127.0.0.1", None, None, port=self.server.port, use_ssl=False, timeout=5, **options)
+        self.senders.append(sender)
+        return sender
+
+    def make_spool(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return EmailSpool(directory.name)
+
+    def test_keeps_one_session_open(self):
+        sender = self.make_sender()
+        for i in range(3):
+            self.assertTrue(sender.send("from@example.com", "to@example.com", f"Message {i}", "Hello"))
+        self.assertTrue(wait_for(lambda: sender.sent == 3))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(sender.connects, 1)
+
+    def test_reconnects_after_dropped_session(self):
+        self.server.drop_after_message = True
+        sender = self.make_sender()
+        sender.send("from@example.com", "to@example.com", "First", "Hello")
+        self.assertTrue(wait_for(lambda: sender.sent == 1))
+        sender.send("from@example.com", "to@example.com", "Second", "Hello")
+        self.assertTrue(wait_for(lambda: sender.sent == 2))
+        self.assertEqual(sender.failed, 0)
+        self.assertEqual(sender.connects, 2)
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_closes_idle_session(self):
+        sender = self.make_sender(idle_seconds=0.2)
+        sender.send("from@example.com", "to@example.com", "Subject", "Hello")
+        self.assertTrue(wait_for(lambda: sender.sent == 1))
+        self.assertTrue(wait_for(lambda: self.server.quits == 1))
+        sender.send("from@example.com", "to@example.com", "Later", "Hello")
+        self.assertTrue(wait_for(lambda: sender.sent == 2))
+        self.assertEqual(sender.connects, 2)
+
+    def test_refused_recipient_is_not_retried(self):
+        self.server.rcpt_reply = "550 No such user"
+        spool = self.make_spool()
+        sender = self.make_sender(spool=spool)
+        sender.send("from@example.com", "nobody@example.com", "Subject", "Hello")
+        self.assertTrue(wait_for(lambda: sender.failed == 1))
+        self.assertEqual(spool.depth(), 0)
+        self.assertEqual(len(os.listdir(spool.failed_directory)), 1)
+        self.assertEqual(sender.retries, 0)
+
+    def test_temporary_refusal_is_retried(self):
+        self.server.rcpt_reply = "451 Greylisted, try again later"
+        spool = self.make_spool()
+        sender = self.make_sender(spool=spool)
+        sender.send("from@example.com", "to@example.com", "Subject", "Hello")
+        self.assertTrue(wait_for(lambda: sender.retries >= 2))
+        self.assertEqual(spool.depth(), 1)
+        self.assertEqual(sender.failed, 0)
+
+        self.server.rcpt_reply = "250 OK"
+        self.assertTrue(wait_for(lambda: sender.sent == 1))
+        self.assertTrue(wait_for(lambda: spool.depth() == 0))  # Counted as sent just before it leaves the spool
+        self.assertEqual(os.listdir(spool.failed_directory), [])
+
+    def test_login_failure_keeps_mail_spooled(self):
+        self.server.auth_reply = "535 Authentication failed"
+        spool = self.make_spool()
+        sender = EmailSender("127.0.0.1", "user", "password", port=self.server.port, use_ssl=False, timeout=5,
+                             spool=spool, retry_seconds=0.05)
+        self.senders.append(sender)
+        sender.send("from@example.com", "to@example.com", "Subject", "Hello")
+        self.assertTrue(wait_for(lambda: sender.retries >= 2))
+        self.assertEqual(spool.depth(), 1)
+        self.assertEqual(sender.failed, 0)
+
+        self.server.auth_reply = "235 Authenticated"
+        self.assertTrue(wait_for(lambda: sender.sent == 1))
+        self.assertTrue(wait_for(lambda: spool.depth() == 0))  # Counted as sent just before it leaves the spool
+
+
+if __name__ == "__main__":
+    unittest.main()
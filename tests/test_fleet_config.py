@@ -0,0 +1,151 @@
+# Applying configuration profiles, to fake devices
+
+import threading
+import unittest
+
+try:
+    from meshtastic.protobuf import channel_pb2, localonly_pb2
+    from common import fleet_config
+    from common.fleet_config import ProfileError, STATUS_APPLIED, STATUS_FAILED, STATUS_TIMED_OUT, STATUS_UNCHANGED
+except ImportError:  # meshtastic (and protobuf) aren't installed
+    fleet_config = None
+
+
+class FakeNode:
+    # Just enough of meshtastic's Node: its configuration, with the writes recorded
+    def __init__(self, fail_on=None, block=None):
+        self.localConfig = localonly_pb2.LocalConfig()
+        self.localConfig.lora.hop_limit = 3
+        self.moduleConfig = localonly_pb2.LocalModuleConfig()
+        self.channels = [channel_pb2.Channel(index=index) for index in range(8)]
+        self.fail_on = fail_on  # Raise when this category is written
+        self.block = block  # An Event to wait on before committing
+        self.writes = []
+        self.committed = False
+
+    def beginSettingsTransaction(self):
+        self.writes.append("begin")
+
+    def writeConfig(self, category):
+        if category == self.fail_on:
+            raise OSError("Device went away")
+        self.writes.append(category)
+
+    def writeChannel(self, index):
+        self.writes.append(f"channel {index}")
+
+    def commitSettingsTransaction(self):
+        if self.block:
+            self.block.wait(5)
+        self.committed = True
+
+
+class FakeInterface:
+    def __init__(self, node):
+        self.localNode = node
+
+
+@unittest.skipIf(fleet_config is None, "needs meshtastic")
+class ValidateProfileTest(unittest.TestCase):
+    def assert_invalid(self, profile, message):
+        with self.assertRaises(ProfileError) as raised:
+            fleet_config.validate_profile(profile)
+        self.assertIn(message, str(raised.exception))
+
+    def test_valid_profile(self):
+        fleet_config.validate_profile({"localConfig": {"lora": {"region": "US", "hop_limit": 5}},
+                                       "moduleConfig": {"mqtt": {"enabled": False}},
+                                       "channels": [{"index": 1, "role": "SECONDARY", "settings": {"name": "ops"}}]})
+
+    def test_invalid_profiles(self):
+        self.assert_invalid([], "must be a JSON object")
+        self.assert_invalid({"radio": {}}, "Unknown profile sections: radio")
+        self.assert_invalid({"localConfig": {}}, "no settings or channels")
+        self.assert_invalid({"localConfig": {"radio": {}}}, "localConfig has no category radio")
+        self.assert_invalid({"localConfig": {"lora": 3}}, "localConfig.lora must be an object")
+        self.assert_invalid({"localConfig": {"lora": {"hop_count": 3}}}, "localConfig.lora")
+        self.assert_invalid({"localConfig": {"lora": {"region": "MARS"}}}, "localConfig.lora")
+        self.assert_invalid({"channels": {"index": 1}}, "channels must be a list")
+        self.assert_invalid({"channels": [{"index": 8}]}, "an index from 0 to 7")
+        self.assert_invalid({"channels": [{"index": 1}, {"index": 1}]}, "Channel 1 is in the profile more than once")
+        self.assert_invalid({"channels": [{"index": 1, "role": "BOSS"}]}, "channel 1")
+
+
+@unittest.skipIf(fleet_config is None, "needs meshtastic")
+class ApplyProfileTest(unittest.TestCase):
+    profile = {"localConfig": {"lora": {"hop_limit": 5}, "device": {"rebroadcast_mode": "LOCAL_ONLY"}},
+               "channels": [{"index": 1, "role": "SECONDARY", "settings": {"name": "ops"}}]}
+
+    def test_changes_are_written_in_one_transaction(self):
+        node = FakeNode()
+
+        result, = fleet_config.apply_profile(self.profile, {"radio": FakeInterface(node)})
+
+        self.assertEqual(result.status, STATUS_APPLIED)
+        self.assertEqual((result.categories, result.channels), (["lora", "device"], [1]))
+        self.assertEqual(node.writes, ["begin", "lora", "device", "channel 1"])
+        self.assertTrue(node.committed)
+        self.assertEqual(node.localConfig.lora.hop_limit, 5)
+        self.assertEqual(node.channels[1].settings.name, "ops")
+
+    def test_matching_device_is_left_alone(self):
+        node = FakeNode()
+        fleet_config.apply_profile(self.profile, {"radio": FakeInterface(node)})
+        node.writes = []
+        node.committed = False
+
+        result, = fleet_config.apply_profile(self.profile, {"radio": FakeInterface(node)})
+
+        self.assertEqual(result.status, STATUS_UNCHANGED)
+        self.assertEqual(node.writes, [])
+        self.assertFalse(node.committed)
+
+    def test_failed_write_puts_the_local_copy_back(self):
+        node = FakeNode(fail_on="device")
+
+        result, = fleet_config.apply_profile(self.profile, {"radio": FakeInterface(node)})
+
+        self.assertEqual(result.status, STATUS_FAILED)
+        self.assertIn("Device went away", result.error)
+        self.assertFalse(node.committed)
+        self.assertEqual(node.localConfig.lora.hop_limit, 3)  # Written before the failure, but put back
+        self.assertEqual(node.localConfig.device, localonly_pb2.LocalConfig().device)
+        self.assertEqual(node.channels[1].settings.name, "")
+
+    def test_device_with_no_configuration_fails(self):
+        node = FakeNode()
+        node.localConfig = None
+
+        result, = fleet_config.apply_profile(self.profile, {"radio": FakeInterface(node)})
+
+        self.assertEqual(result.status, STATUS_FAILED)
+        self.assertIn("No configuration", result.error)
+
+    def test_slow_device_times_out_on_its_own(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        slow, fast = FakeNode(block=release), FakeNode()
+        progress = []
+
+        results = fleet_config.apply_profile(self.profile, {"slow": FakeInterface(slow), "fast": FakeInterface(fast)},
+                                             timeout=0.2, on_progress=lambda name, text: progress.append((name, text)))
+
+        self.assertEqual([(result.name, result.status) for result in results],
+                         [("slow", STATUS_TIMED_OUT), ("fast", STATUS_APPLIED)])
+        self.assertIn(("slow", STATUS_TIMED_OUT), progress)
+        self.assertIn(("fast", STATUS_APPLIED), progress)
+
+    def test_format_report(self):
+        results = [fleet_config.DeviceResult("a", STATUS_APPLIED, categories=["lora"], channels=[1], seconds=2.04),
+                   fleet_config.DeviceResult("b", STATUS_UNCHANGED, seconds=0.5),
+                   fleet_config.DeviceResult("c", STATUS_FAILED, error="OSError: gone", seconds=1.0)]
+
+        self.assertEqual(fleet_config.format_report(results).splitlines(),
+                         ["Profile applied to 3 devices: 1 applied, 1 unchanged, 1 failed, 0 timed out",
+                          "a: applied (lora, channel 1) in 2.0s",
+                          "b: unchanged in 0.5s",
+                          "c: failed: OSError: gone in 1.0s"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+# IngestPipeline queue policies, with the worker held up so items back up in the queue
+
+import threading
+import time
+import unittest
+
+from common.ingest import IngestPipeline, POLICY_COALESCE, POLICY_DROP_OLDEST
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class IngestPipelineTest(unittest.TestCase):
+    def make_pipeline(self, policy=POLICY_COALESCE):
+        # The worker takes one item at a time, and holds on to "blocker" until released
+        self.release = threading.Event()
+        self.delivered = []
+
+        def parse(item):
+            if item == "blocker":
+                self.release.wait(5)
+                return None
+            return item
+
+        def deliver(batch):
+            self.delivered.extend(batch)
+            pipeline.batch_done()
+
+        pipeline = IngestPipeline(parse, deliver, max_queue=3, policy=policy, batch_size=1, batch_seconds=0)
+        self.addCleanup(pipeline.close, 1.0)
+        self.addCleanup(self.release.set)
+        pipeline.submit("blocker")
+        self.assertTrue(wait_for(lambda: pipeline.depth == 0))
+        return pipeline
+
+    def finish(self, pipeline, count):
+        self.release.set()
+        self.assertTrue(wait_for(lambda: len(self.delivered) == count))
+
+    def test_node_updates_make_room_for_messages(self):
+        pipeline = self.make_pipeline()
+        pipeline.submit("text 1")
+        pipeline.submit("node a", key="a")
+        pipeline.submit("node b", key="b")
+        self.assertTrue(pipeline.submit("node c", key="c"))  # Drops node a
+        self.assertTrue(pipeline.submit("text 2"))  # Drops node b
+        self.assertTrue(pipeline.submit("text 3"))  # Drops node c
+        self.assertFalse(pipeline.submit("node d", key="d"))  # Only messages left, so the update gives way
+
+        self.finish(pipeline, 3)
+        self.assertEqual(self.delivered, ["text 1", "text 2", "text 3"])
+        self.assertEqual((pipeline.dropped, pipeline.dropped_unkeyed), (4, 0))
+
+    def test_messages_dropped_only_as_a_last_resort(self):
+        pipeline = self.make_pipeline()
+        for n in range(1, 5):
+            pipeline.submit(f"text {n}")
+
+        self.finish(pipeline, 3)
+        self.assertEqual(self.delivered, ["text 2", "text 3", "text 4"])
+        self.assertEqual(pipeline.stats()["dropped_unkeyed"], 1)
+
+    def test_coalesced_update_keeps_its_place(self):
+        pipeline = self.make_pipeline()
+        pipeline.submit("node a v1", key="a")
+        pipeline.submit("text 1")
+        pipeline.submit("node a v2", key="a")
+        pipeline.submit("node b", key="b")
+
+        self.finish(pipeline, 3)
+        self.assertEqual(self.delivered, ["node a v2", "text 1", "node b"])
+        self.assertEqual((pipeline.coalesced, pipeline.dropped), (1, 0))
+
+    def test_drop_oldest_ignores_keys(self):
+        pipeline = self.make_pipeline(POLICY_DROP_OLDEST)
+        pipeline.submit("text 1")
+        pipeline.submit("node a", key="a")
+        pipeline.submit("node b", key="b")
+        pipeline.submit("node c", key="c")
+
+        self.finish(pipeline, 3)
+        self.assertEqual(self.delivered, ["node a", "node b", "node c"])
+        self.assertEqual(pipeline.dropped_unkeyed, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+# Message lists and the shared message buffers they show
+
+import csv
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from common.message_buffers import ChannelMessage
+from common.message_store import MessageStore
+from gui import shared
+
+try:
+    import wx
+    from ObjectListView3 import ColumnDefn
+    from gui.panels.message_list import MessageList
+except ImportError:  # wxPython and ObjectListView3 aren't installed
+    wx = None
+
+
+def channel_message(n):
+    return ChannelMessage(f"2026-10-18 12:{n // 60:02d}:{n % 60:02d}", "nrdW", f"Message {n}")
+
+
+def use_empty_buffers(test, max_channel_messages=8):
+    # Give a test its own in-memory buffers
+    for name, value in (("channel_messages", {}), ("spilled_counts", {}), ("history_cursors", {}),
+                        ("paged_views", set()), ("view_windows", {}), ("message_store", None),
+                        ("max_channel_messages", max_channel_messages)):
+        patcher = mock.patch.object(shared, name, value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+def add_messages(first, last):
+    for n in range(first, last):
+        shared.add_channel_message("OJB1", "ops", channel_message(n))
+
+
+class SharedBufferTest(unittest.TestCase):
+    def setUp(self):
+        use_empty_buffers(self)
+
+    def test_views_get_a_copy_of_the_buffer(self):
+        add_messages(0, 3)
+        shown = shared.get_channel_messages("OJB1", "ops")
+        add_messages(3, 10)  # Past the cap, so the buffer is trimmed
+
+        self.assertEqual([message.message for message in shown], ["Message 0", "Message 1", "Message 2"])
+        self.assertEqual(shared.channel_message_count("OJB1", "ops"), 8)
+        self.assertIsNot(shared.get_channel_messages("OJB1", "ops"), shared.channel_messages["OJB1"]["ops"])
+
+    def test_new_messages_after_those_shown(self):
+        add_messages(0, 3)
+        shown = shared.get_channel_messages("OJB1", "ops")
+        self.assertEqual(shared.new_channel_messages("OJB1", "ops", shown), [])
+        add_messages(3, 5)
+        new = shared.new_channel_messages("OJB1", "ops", shown)
+        self.assertEqual([message.message for message in new], ["Message 3", "Message 4"])
+
+        add_messages(5, 10)  # Trims the buffer, so the view has to be reloaded
+        self.assertIsNone(shared.new_channel_messages("OJB1", "ops", shown + new))
+
+    def test_paged_in_history_is_kept_until_the_view_is_released(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        log_name = os.path.join(directory.name, "channel-messages.csv")
+        with open(log_name, "w", newline="") as lf:
+            writer = csv.DictWriter(lf, fieldnames=shared.channel_log_fields, quoting=csv.QUOTE_ALL)
+            for n in range(20):
+                message = channel_message(n)
+                writer.writerow({"device": "OJB1", "channel": "ops", "timestamp": message.timestamp,
+                                 "sender": message.sender, "message": message.message})
+        patcher = mock.patch.object(shared, "config", {"CHANNEL_MESSAGE_LOG": log_name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        add_messages(10, 20)  # Trimmed to the newest 8
+        buffer = shared.channel_messages["OJB1"]["ops"]
+        self.assertEqual(buffer[0].message, "Message 12")
+
+        self.assertEqual(shared.load_older_channel_messages("OJB1", "ops", 4), 4)
+        add_messages(20, 25)  # Past the point the buffer would be trimmed, but the view is reading old messages
+        self.assertEqual(buffer[0].message, "Message 8")
+        self.assertEqual(len(buffer), 17)
+
+        shared.release_channel_view("OJB1", "ops")
+        add_messages(25, 26)
+        self.assertEqual(len(buffer), 8)
+        self.assertEqual(buffer[0].message, "Message 18")
+
+
+class StoredMessagesTest(unittest.TestCase):
+    def setUp(self):
+        store = MessageStore(":memory:")
+        self.addCleanup(store.close)
+        for name, value in (("message_store", store), ("message_window", 4), ("view_windows", {})):
+            patcher = mock.patch.object(shared, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_only_messages_added_since_are_fetched(self):
+        add_messages(0, 6)
+        shown = shared.get_channel_messages("OJB1", "ops")
+        self.assertEqual([message.message for message in shown], [f"Message {n}" for n in range(2, 6)])
+        shared.add_channel_message("OJB1", "other", channel_message(6))
+        add_messages(7, 9)
+
+        new = shared.new_channel_messages("OJB1", "ops", shown)
+        self.assertEqual([message.message for message in new], ["Message 7", "Message 8"])
+        self.assertEqual(shared.new_channel_messages("OJB1", "ops", shown + new), [])
+        self.assertIsNone(shared.new_channel_messages("OJB1", "ops", []))
+
+    def test_count_is_not_capped_at_the_window(self):
+        add_messages(0, 10)
+        self.assertEqual(shared.channel_message_count("OJB1", "ops"), 10)
+        self.assertEqual(len(shared.get_channel_messages("OJB1", "ops")), 4)
+
+
+@unittest.skipIf(wx is None, "needs wxPython and ObjectListView3")
+class MessageListTest(unittest.TestCase):
+    def setUp(self):
+        use_empty_buffers(self)
+        self.app = wx.App(False)
+        frame = wx.Frame(None)
+        self.addCleanup(frame.Destroy)
+        self.messages = MessageList(frame, wx.ID_ANY, style=wx.LC_REPORT)
+        self.messages.SetColumns([ColumnDefn("", "left", -1, "message", isEditable=False)])
+
+    def show_new_messages(self):
+        self.messages.ShowNewMessages(lambda shown: shared.new_channel_messages("OJB1", "ops", shown),
+                                      lambda: shared.get_channel_messages("OJB1", "ops"))
+
+    def test_new_messages_are_appended(self):
+        add_messages(0, 3)
+        self.messages.SetObjects(shared.get_channel_messages("OJB1", "ops"))
+        add_messages(3, 5)
+
+        with mock.patch.object(self.messages, "SetObjects") as set_objects:
+            self.show_new_messages()
+        set_objects.assert_not_called()
+
+        buffer = shared.channel_messages["OJB1"]["ops"]
+        self.assertIsNot(self.messages.modelObjects, buffer)
+        self.assertEqual(self.messages.GetItemCount(), 5)
+        self.assertEqual(self.messages.GetIndexOf(buffer[-1]), 4)
+        self.assertEqual(self.messages.GetObjectAt(3), buffer[3])
+
+    def test_trimmed_buffer_reloads_the_list(self):
+        add_messages(0, 8)
+        self.messages.SetObjects(shared.get_channel_messages("OJB1", "ops"))
+        add_messages(8, 10)  # Trims the buffer back to 8
+
+        self.show_new_messages()
+
+        buffer = shared.channel_messages["OJB1"]["ops"]
+        self.assertEqual(self.messages.modelObjects, buffer)
+        self.assertEqual(self.messages.GetItemCount(), 8)
+        self.assertEqual(self.messages.GetIndexOf(buffer[0]), 0)
+        self.assertEqual(self.messages.GetIndexOf(buffer[-1]), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
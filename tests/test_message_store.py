@@ -0,0 +1,86 @@
+# Importing the CSV message logs into the SQLite message store
+
+import csv
+import os
+import tempfile
+import unittest
+
+from common.message_store import MessageStore
+
+channel_log_fields = ["device", "channel", "timestamp", "sender", "message"]
+
+
+def channel_row(n, channel="ops"):
+    return {"device": "OJB1", "channel": channel, "timestamp": f"2026-10-18 12:00:{n:02d}", "sender": "nrdW",
+            "message": f"Message {n}"}
+
+
+class LogImportTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log_name = os.path.join(directory.name, "channel-messages.csv")
+        self.store = MessageStore(os.path.join(directory.name, "messages.db"))
+        self.addCleanup(self.store.close)
+
+    def write_rows(self, rows, mode="a"):
+        with open(self.log_name, mode, newline="") as lf:
+            csv.DictWriter(lf, fieldnames=channel_log_fields, quoting=csv.QUOTE_ALL).writerows(rows)
+
+    def import_log(self) -> int:
+        return self.store.import_channel_log(self.log_name, channel_log_fields)
+
+    def stored_messages(self) -> list:
+        return [message.message for message in self.store.channel_messages("OJB1", "ops", 100)]
+
+    def test_imports_only_rows_added_since(self):
+        self.write_rows([channel_row(0), channel_row(1)])
+        self.assertEqual(self.import_log(), 2)
+        self.write_rows([channel_row(2)])  # e.g. by msg_forward while the GUI wasn't running
+
+        self.assertEqual(self.import_log(), 1)
+        self.assertEqual(self.import_log(), 0)
+        self.assertEqual(self.stored_messages(), ["Message 0", "Message 1", "Message 2"])
+
+    def test_rows_already_in_the_store_are_skipped(self):
+        self.write_rows([channel_row(0)])
+        self.import_log()
+        # The GUI writes a message to both the store and the log
+        row = channel_row(1)
+        self.store.add_channel_message(row["device"], row["channel"], row["timestamp"], row["sender"], row["message"])
+        self.write_rows([row, channel_row(2)])
+
+        self.assertEqual(self.import_log(), 1)
+        self.assertEqual(self.stored_messages(), ["Message 0", "Message 1", "Message 2"])
+
+    def test_replaced_log_is_imported_from_the_start(self):
+        self.write_rows([channel_row(0), channel_row(1)])
+        self.import_log()
+        os.remove(self.log_name)
+        self.write_rows([channel_row(1), channel_row(3)], mode="w")
+
+        self.assertEqual(self.import_log(), 1)
+        self.assertEqual(self.stored_messages(), ["Message 0", "Message 1", "Message 3"])
+
+    def test_row_still_being_written_waits_for_the_next_import(self):
+        self.write_rows([channel_row(0)])
+        with open(self.log_name, "a") as lf:
+            lf.write('"OJB1","ops","2026-10-18 12:00:01","nrdW","Mess')
+
+        self.assertEqual(self.import_log(), 1)
+        with open(self.log_name, "a") as lf:
+            lf.write('age 1"\r\n')
+        self.assertEqual(self.import_log(), 1)
+        self.assertEqual(self.stored_messages(), ["Message 0", "Message 1"])
+
+    def test_multi_line_messages(self):
+        row = channel_row(0)
+        row["message"] = "Line 1\nLine 2"
+        self.write_rows([row, channel_row(1)])
+
+        self.assertEqual(self.import_log(), 2)
+        self.assertEqual(self.stored_messages(), ["Line 1\nLine 2", "Message 1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
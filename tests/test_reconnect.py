@@ -0,0 +1,243 @@
+# ReconnectSupervisor (and DeviceManager's use of it) with fake interfaces and a fake clock
+
+import threading
+import unittest
+from unittest import mock
+
+from common.reconnect import ReconnectSupervisor, STATE_RECONNECTING, STATE_OPEN, STATE_CONNECTED
+
+try:
+    from common import mesh_managers
+except ImportError:  # pubsub and meshtastic aren't installed
+    mesh_managers = None
+
+
+class FakeInterface:
+    def __init__(self, name):
+        self.name = name
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+    def getShortName(self):
+        return self.name
+
+
+class FakeTime:
+    # clock and wait for a supervisor: waiting just moves the clock on
+    def __init__(self):
+        self.now = 0.0
+        self.waits = []
+        self.on_wait = None  # Called with the number of waits so far, before each wait returns
+
+    def clock(self):
+        return self.now
+
+    def wait(self, seconds):
+        self.waits.append(seconds)
+        self.now += seconds
+        if self.on_wait:
+            self.on_wait(len(self.waits))
+        return False
+
+
+class FakeConnect:
+    # Fails (alternately returning None and raising, like the real connect functions can) a given number of times,
+    # then returns a new FakeInterface
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = []
+
+    def __call__(self, interface_type, address):
+        self.calls.append((interface_type, address))
+        if len(self.calls) <= self.failures:
+            if len(self.calls) % 2:
+                return None
+            raise OSError("Device not found")
+        return FakeInterface(f"new{len(self.calls)}")
+
+
+class ReconnectSupervisorTest(unittest.TestCase):
+    def make_supervisor(self, connect, **options):
+        self.time = FakeTime()
+        self.reconnected = []
+        self.states = []
+        options.setdefault("base_delay", 2.0)
+        supervisor = ReconnectSupervisor(connect, on_reconnected=lambda *args: self.reconnected.append(args),
+                                         on_state_change=lambda *args: self.states.append(args[2]),
+                                         clock=self.time.clock, wait=self.time.wait, random=lambda: 0.0,
+                                         close_timeout=1.0, **options)
+        self.addCleanup(supervisor.stop, 1.0)
+        return supervisor
+
+    def test_reconnects_with_backoff(self):
+        connect = FakeConnect(failures=3)
+        supervisor = self.make_supervisor(connect)
+        old = FakeInterface("old")
+        supervisor.watch(old, "tcp", "radio")
+
+        self.assertTrue(supervisor.connection_lost(old))
+        supervisor.join(5)
+
+        self.assertEqual(self.time.waits, [2.0, 4.0, 8.0, 16.0])
+        self.assertTrue(old.closed.is_set())
+        self.assertEqual(len(self.reconnected), 1)
+        interface_type, address, old_interface, new_interface = self.reconnected[0]
+        self.assertEqual((interface_type, address, old_interface), ("tcp", "radio", old))
+        self.assertTrue(supervisor.is_watched(new_interface))
+        self.assertFalse(supervisor.is_watched(old))
+        self.assertEqual(self.states, [STATE_RECONNECTING, STATE_CONNECTED])
+        stats = supervisor.stats()["radio"]
+        self.assertEqual((stats["reconnects"], stats["attempts"], stats["failures"]), (1, 4, 0))
+        self.assertEqual(stats["downtime"], 30.0)
+
+    def test_circuit_opens_after_repeated_failures(self):
+        connect = FakeConnect(failures=5)
+        supervisor = self.make_supervisor(connect, max_delay=5.0, failure_threshold=4, cooldown=300.0)
+        old = FakeInterface("old")
+        supervisor.watch(old, "tcp", "radio")
+
+        supervisor.connection_lost(old)
+        supervisor.join(5)
+
+        # Capped at max_delay, then once every cooldown once the circuit is open
+        self.assertEqual(self.time.waits, [2.0, 4.0, 5.0, 5.0, 300.0, 300.0])
+        self.assertEqual(self.states, [STATE_RECONNECTING, STATE_OPEN, STATE_CONNECTED])
+        self.assertEqual(supervisor.stats()["radio"]["state"], STATE_CONNECTED)
+
+    def test_unwatched_device_is_not_reconnected(self):
+        connect = FakeConnect(failures=100)
+        supervisor = self.make_supervisor(connect)
+        old = FakeInterface("old")
+        supervisor.watch(old, "tcp", "radio")
+        self.time.on_wait = lambda waits: waits == 3 and supervisor.unwatch(old)
+
+        supervisor.connection_lost(old)
+        supervisor.join(5)
+
+        self.assertEqual(len(connect.calls), 2)  # Gave up at the third attempt
+        self.assertEqual(self.reconnected, [])
+        self.assertFalse(supervisor.is_watched(old))
+        self.assertFalse(supervisor.connection_lost(old))
+
+    def test_supervise_retries_first_connect(self):
+        connect = FakeConnect(failures=2)
+        supervisor = self.make_supervisor(connect)
+
+        supervisor.supervise("serial", "/dev/ttyUSB0")
+        supervisor.join(5)
+
+        self.assertEqual(self.time.waits, [0.0, 4.0, 8.0])  # The first try is straight away, and counts as a failure
+        self.assertEqual(len(self.reconnected), 1)
+        self.assertIsNone(self.reconnected[0][2])
+        new_interface = self.reconnected[0][3]
+        self.assertEqual(supervisor.interfaces(), [new_interface])
+        self.assertEqual(supervisor.stats()["/dev/ttyUSB0"]["reconnects"], 0)
+
+    def test_stop_interrupts_waiting(self):
+        supervisor = ReconnectSupervisor(FakeConnect(failures=100), base_delay=60.0)
+        old = FakeInterface("old")
+        supervisor.watch(old, "tcp", "radio")
+        supervisor.connection_lost(old)
+
+        supervisor.stop(timeout=5)
+
+        self.assertEqual(supervisor.stats()["radio"]["attempts"], 0)
+        self.assertFalse(supervisor.connection_lost(old))
+
+    def test_stop_during_connect_waits_for_it(self):
+        # The reconnect connects after stop() has started: stop() waits for it, and it closes its new connection
+        connecting = threading.Event()
+        release = threading.Event()
+        new_interface = FakeInterface("new")
+
+        def connect(interface_type, address):
+            connecting.set()
+            release.wait(5)
+            return new_interface
+
+        supervisor = self.make_supervisor(connect)
+        old = FakeInterface("old")
+        supervisor.watch(old, "tcp", "radio")
+        supervisor.connection_lost(old)
+        self.assertTrue(connecting.wait(5))
+
+        threading.Timer(0.1, release.set).start()
+        self.assertTrue(supervisor.stop(timeout=5))
+
+        self.assertEqual(supervisor.interfaces(), [])
+        self.assertTrue(new_interface.closed.is_set())
+        self.assertEqual(self.reconnected, [])
+
+    def test_stop_times_out_on_a_hung_connect(self):
+        connecting = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def connect(interface_type, address):
+            connecting.set()
+            release.wait(5)
+            return FakeInterface("new")
+
+        supervisor = self.make_supervisor(connect)
+        connected = FakeInterface("connected")
+        supervisor.watch(connected, "tcp", "other")
+        supervisor.supervise("tcp", "radio")
+        self.assertTrue(connecting.wait(5))
+
+        self.assertFalse(supervisor.stop(timeout=0.1))
+        self.assertEqual(supervisor.interfaces(), [connected])
+
+
+@unittest.skipIf(mesh_managers is None, "needs pubsub and meshtastic")
+class DeviceManagerReconnectTest(unittest.TestCase):
+    def setUp(self):
+        self.time = FakeTime()
+        self.connect = FakeConnect(failures=0)
+        patcher = mock.patch.object(mesh_managers.tcp, "make_connection_and_return",
+                                    lambda address: self.connect("tcp", address))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reconnected = []
+        self.device_manager = mesh_managers.DeviceManager()
+        self.device_manager.enable_auto_reconnect(on_reconnected=lambda *args: self.reconnected.append(args),
+                                                  clock=self.time.clock, wait=self.time.wait, random=lambda: 0.0,
+                                                  close_timeout=1.0)
+        self.addCleanup(self.device_manager.reconnect_supervisor.stop, 1.0)
+
+    def test_lost_connection_is_reconnected(self):
+        interface = self.device_manager.connect_to_specific_device("tcp", "radio")
+        self.assertTrue(self.device_manager.is_reconnecting(interface))
+
+        self.device_manager.onConnectionDown(interface)
+        self.device_manager.reconnect_supervisor.join(5)
+
+        self.assertEqual(len(self.connect.calls), 2)
+        self.assertTrue(interface.closed.is_set())
+        new_interface = self.reconnected[0][3]
+        self.assertTrue(self.device_manager.is_reconnecting(new_interface))
+
+    def test_forgotten_device_is_not_reconnected(self):
+        interface = self.device_manager.connect_to_specific_device("tcp", "radio")
+
+        self.device_manager.forget_device(interface)
+        self.device_manager.onConnectionDown(interface)
+        self.device_manager.reconnect_supervisor.join(5)
+
+        self.assertEqual(len(self.connect.calls), 1)
+        self.assertEqual(self.reconnected, [])
+        self.assertFalse(self.device_manager.is_reconnecting(interface))
+
+    def test_connect_supervised_retries_until_connected(self):
+        self.connect.failures = 3
+
+        self.device_manager.connect_supervised("tcp", "radio")
+        self.device_manager.reconnect_supervisor.join(5)
+
+        self.assertEqual(len(self.connect.calls), 4)
+        self.assertEqual(self.device_manager.reconnect_supervisor.interfaces(), [self.reconnected[0][3]])
+
+
+if __name__ == "__main__":
+    unittest.main()